@@ -0,0 +1,424 @@
+import os
+import time
+import asyncio
+import logging
+from decimal import Decimal
+
+from Bank_Balance_Replace_V2 import (
+    tbl_name, DIGIT_SLOTS, CHOICE_SLOTS, get_slots, get_slot_value, build_slot, get_session_attributes, try_again_later,
+    isValid_Word, isValid_Pin, isValid_AccountNumber, isValid_AccountType, pin_lockout_result,
+    get_caller_phone_number, phone_lookup_params, single_account, saved_caller_lookup, save_caller_lookup,
+    account_summary_params, describe_accounts, transactions_page_params, saved_transactions_cursor, describe_transactions_page
+)
+from Bank_Capture import capture_turns
+from Bank_Card_Replacement import outbox_tbl_name, replacement_job, publish_jobs
+from Bank_Cards import CardPoolExhausted, issue_card
+from Bank_Digits import normalize_digit_slots
+from Bank_Funnel import filled_slots, record_turn
+from Bank_Fuzzy import normalize_choice_slots
+from Bank_Idempotency import run_idempotent_async, idempotency_tbl_name
+from Bank_Pin_Attempts import reserve_pin_attempt_async, pin_attempt_failed, release_pin_attempt_async, pin_attempts_tbl_name
+from Bank_Responses import close, elicit_intent, elicit_slot, delegate, build_validation_result, message, render, text_message
+from Bank_Session import save_session_state, mark_verified, get_verified_account
+from Bank_Store import (
+    submit_io, is_store_failure, invocation_deadline, has_time_for, bounded_wait, customer_tbl_name, transactions_tbl_name
+)
+from Bank_Store_Async import WriteBehind, get_async_store
+from Bank_Warmup import handle_warmups
+
+
+#Configure logger
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+
+
+#One event loop per container so the aiobotocore client and its connections survive between invocations
+_event_loop = asyncio.new_event_loop()
+
+#Most a turn waits on its write-behind tasks before answering Lex
+WRITE_BEHIND_WAIT = float(os.environ.get('BANK_WRITE_BEHIND_WAIT', '0.2'))
+
+
+''' --- Validation Functions --- '''
+
+
+async def validate_account_slots(slots, store, account_type, sessionId=None):
+    '''Shared accountNumber / pin checks. One account read serves the existence check and the pin check'''
+
+    accountNumber = get_slot_value(slots, 'accountNumber')
+    pin = get_slot_value(slots, 'pin')
+
+    if accountNumber is None:
+        return {'isValid': True}
+
+    if not isValid_AccountNumber(accountNumber):
+        return build_validation_result(False, 'accountNumber', 'account_number_invalid', accountType=account_type)
+
+    #Start the read now, the pin format check below overlaps with it
+    account_read = asyncio.ensure_future(store.get_account_item(tbl_name, accountNumber))
+
+    pin_is_valid = pin is None or isValid_Pin(pin)
+
+    #The attempt is charged alongside the account read, before the Pin is compared
+    reservation = None
+    if pin is not None and pin_is_valid:
+        reservation = asyncio.ensure_future(reserve_pin_attempt_async(store, accountNumber, sessionId))
+
+    item = await account_read
+    if item is None:
+        #No account, no compare: the charge is given back rather than left to count as a wrong PIN
+        attempt = await reservation if reservation is not None else None
+        if attempt is not None:
+            await release_pin_attempt_async(store, attempt)
+        return build_validation_result(False, 'accountNumber', 'account_number_unknown', accountNumber=accountNumber)
+
+    if not pin_is_valid:
+        return build_validation_result(False, 'pin', 'pin_invalid')
+    if pin is None:
+        return {'isValid': True}
+
+    attempt = await reservation
+    if attempt is None:
+        return pin_lockout_result()
+
+    if Decimal(pin) != item['Pin']:
+        if pin_attempt_failed(attempt):
+            return pin_lockout_result()
+        return build_validation_result(False, 'pin', 'pin_incorrect')
+
+    await release_pin_attempt_async(store, attempt)
+
+    return {'isValid': True}
+
+
+async def validate_balance_information(slots, store, sessionId=None):
+
+    accountType = get_slot_value(slots, 'accountType')
+
+    if accountType and not isValid_AccountType(accountType):
+        return build_validation_result(False, 'accountType', 'balance_account_type_unclear')
+
+    return await validate_account_slots(slots, store, accountType or 'bank', sessionId)
+
+
+async def validate_replace_card_information(slots, store, sessionId=None):
+
+    firstName = get_slot_value(slots, 'firstName')
+
+    if firstName and not isValid_Word(firstName):
+        return build_validation_result(False, 'firstName', 'first_name_unclear')
+
+    return await validate_account_slots(slots, store, 'bank', sessionId)
+
+
+
+""" --- Helper Functions --- """
+
+
+async def get_caller_account(intent_request, store):
+    '''Bank_Balance_Replace_V2.get_caller_account on the async store'''
+
+    phoneNumber = get_caller_phone_number(intent_request)
+    if phoneNumber is None:
+        return None
+
+    lookup = saved_caller_lookup(intent_request, phoneNumber)
+    if lookup is None:
+        #Only a convenience, the caller can still say the account number
+        if not has_time_for():
+            return None
+        response = await store.request(tbl_name, 'query', **phone_lookup_params(phoneNumber))
+        lookup = save_caller_lookup(intent_request, phoneNumber, single_account(response))
+
+    return lookup['accountNumber']
+
+
+async def prefill_account_number(intent_request, slots, store):
+    '''Fills an empty accountNumber slot from the caller's phone so only the PIN is left to ask for'''
+
+    if get_slot_value(slots, 'accountNumber') is not None:
+        return False
+
+    accountNumber = await get_caller_account(intent_request, store)
+    if accountNumber is None:
+        return False
+
+    slots['accountNumber'] = build_slot(accountNumber)
+
+    return True
+
+
+async def describe_balances(store, accountNumber):
+    '''Every account for customers with several, otherwise the one asked about. Balances come from the table'''
+
+    item = await store.get_account_item(tbl_name, accountNumber)
+
+    accounts = None
+    if item is not None and 'CustomerId' in item:
+        accounts = (await store.request(customer_tbl_name, 'query', **account_summary_params(item['CustomerId'])))['Items']
+
+    summary = describe_accounts(accounts)
+    if summary is not None:
+        return summary
+
+    #Straight from the table, not the warm cache: ledger postings from other containers change it
+    item = await store.get_item(tbl_name, {'AccountNumber': Decimal(accountNumber)}, consistent_read=True)
+    balance = item['Account Balance'] if item is not None else False
+    logger.info(f'balance={balance}')
+
+    return render('balance', 'PlainText', balance=balance)
+
+
+async def read_transactions(intent_request, store, accountNumber, continue_listing):
+
+    cursor = saved_transactions_cursor(intent_request, accountNumber, continue_listing)
+    response = await store.request(transactions_tbl_name, 'query', **transactions_page_params(accountNumber, cursor))
+
+    return describe_transactions_page(intent_request, accountNumber, cursor, response['Items'], response.get('LastEvaluatedKey'))
+
+
+async def get_account_fields(store, accountNumber, *fields):
+    '''Several attributes from one read of the account: the warm cache, then the table'''
+
+    item = await store.get_account_item(tbl_name, accountNumber)
+
+    return [item[field] if item is not None else False for field in fields]
+
+
+async def run_dialog_hook(intent_request, store, validator, verify=True):
+    '''Validates the turn's slots, delegating to Lex once they are good'''
+
+    intent_name = intent_request['sessionState']['intent']['name']
+    session_attributes = get_session_attributes(intent_request)
+    slots = get_slots(intent_request)
+
+    #Known caller numbers pre-fill accountNumber, leaving only the PIN to collect
+    await prefill_account_number(intent_request, slots, store)
+
+    validation_result = await validator(slots, store, intent_request['sessionId'])
+    logger.info('validation_result is {} for the non-empty slots in {}'.format(validation_result['isValid'], slots))
+
+    if validation_result.get('lockedOut'):
+        return close(intent_name, session_attributes, 'Failed', validation_result['message'])
+
+    if not validation_result['isValid']:
+        slots[validation_result['violatedSlot']] = None
+        return elicit_slot(
+            intent_name,
+            slots,
+            validation_result['violatedSlot'],
+            session_attributes,
+            validation_result['message'],
+            reason=validation_result['reason']
+        )
+
+    #Lets RecentTransactions skip re-identification later in the call
+    if verify and get_slot_value(slots, 'pin') is not None:
+        mark_verified(intent_request, get_slot_value(slots, 'accountNumber'))
+
+    return delegate(intent_name, slots, session_attributes)
+
+
+
+""" --- Functions that control the bot's behavior --- """
+
+
+async def Greeting(intent_request, store, background):
+
+    intent_name = intent_request['sessionState']['intent']['name']
+    session_attributes = get_session_attributes(intent_request)
+    slots = get_slots(intent_request)
+
+    firstName = get_slot_value(slots, 'firstName')
+
+    if intent_request['invocationSource'] == 'DialogCodeHook':
+        #Look the caller up by phone number while we are still greeting them
+        await get_caller_account(intent_request, store)
+
+        if firstName and not isValid_Word(firstName):
+            slots['firstName'] = None
+            return elicit_slot(
+                intent_name,
+                slots,
+                'firstName',
+                session_attributes,
+                message('first_name_unclear'),
+                reason='first_name_unclear'
+            )
+
+        return delegate(intent_name, slots, session_attributes)
+
+    return elicit_intent(session_attributes, message('greeting', firstName=firstName))
+
+
+async def CheckBalance(intent_request, store, background):
+
+    intent_name = intent_request['sessionState']['intent']['name']
+    session_attributes = get_session_attributes(intent_request)
+    slots = get_slots(intent_request)
+
+    if intent_request['invocationSource'] == 'DialogCodeHook':
+        return await run_dialog_hook(intent_request, store, validate_balance_information)
+
+    balances = await describe_balances(store, get_slot_value(slots, 'accountNumber'))
+
+    return close(intent_name, session_attributes, 'Fulfilled', message('balance_closing', balances=balances))
+
+
+async def FollowupCheckBalance(intent_request, store, background):
+
+    if intent_request['invocationSource'] == 'DialogCodeHook':
+        return await run_dialog_hook(intent_request, store, validate_balance_information)
+
+    return await CheckBalance(intent_request, store, background)
+
+
+async def ReplaceCard(intent_request, store, background):
+
+    intent_name = intent_request['sessionState']['intent']['name']
+    session_attributes = get_session_attributes(intent_request)
+    slots = get_slots(intent_request)
+
+    if intent_request['invocationSource'] == 'DialogCodeHook':
+        return await run_dialog_hook(intent_request, store, validate_replace_card_information, verify=False)
+
+    accountNumber = get_slot_value(slots, 'accountNumber')
+
+    #Claiming a new card block is a sync store call, so it runs on the I/O pool next to the account read
+    try:
+        (cardToken, cardNumber), (email_address, street_address) = await asyncio.gather(
+            asyncio.wrap_future(submit_io(issue_card)),
+            get_account_fields(store, accountNumber, 'Email Address', 'Street Address')
+        )
+    except CardPoolExhausted:
+        logger.warning('card pool exhausted, replacement not recorded')
+        return close(intent_name, session_attributes, 'Failed', message('card_unavailable'))
+
+    logger.info(f'email address={email_address}, street_address={street_address}')
+
+    #The reply only waits on the outbox write, the workers mail the card and send the email
+    job = replacement_job(accountNumber, cardToken, cardNumber, get_slot_value(slots, 'firstName'), email_address, street_address)
+    await store.put_item(outbox_tbl_name, job)
+    publish_jobs([job['JobId']])
+
+    reply = message('card_replaced', email=email_address, lastFour=cardNumber[-4:], street=street_address)
+
+    return close(intent_name, session_attributes, 'Fulfilled', reply)
+
+
+
+async def RecentTransactions(intent_request, store, background):
+
+    intent_name = intent_request['sessionState']['intent']['name']
+    session_attributes = get_session_attributes(intent_request)
+    slots = get_slots(intent_request)
+
+    #"next five" / "more" carries on from the saved cursor instead of starting at the newest transaction
+    continue_listing = get_slot_value(slots, 'page') == 'next'
+
+    if intent_request['invocationSource'] == 'DialogCodeHook':
+        #Caller already gave account number and PIN this call (e.g. in CheckBalance): answer right away
+        verified = get_verified_account(intent_request)
+        if verified is not None and get_slot_value(slots, 'accountNumber') in (None, verified):
+            output = await read_transactions(intent_request, store, verified, continue_listing)
+            return close(intent_name, session_attributes, 'Fulfilled', text_message(output))
+
+        return await run_dialog_hook(intent_request, store, validate_balance_information)
+
+    output = await read_transactions(intent_request, store, get_slot_value(slots, 'accountNumber'), continue_listing)
+
+    return close(intent_name, session_attributes, 'Fulfilled', text_message(output))
+
+
+
+''' --- INTENTS --- '''
+
+
+INTENT_HANDLERS = {
+    'Greeting': Greeting,
+    'CheckBalance': CheckBalance,
+    'FollowupCheckBalance': FollowupCheckBalance,
+    'ReplaceCard': ReplaceCard,
+    'RecentTransactions': RecentTransactions,
+}
+
+
+async def dispatch(intent_request, store, background):
+
+    intent_name = intent_request['sessionState']['intent']['name']
+
+    logger.info(f'intent_name={intent_name}')
+
+    handler = INTENT_HANDLERS.get(intent_name)
+    if handler is None:
+        raise Exception('Intent with name ' + intent_name + ' not supported')
+
+    return await handler(intent_request, store, background)
+
+
+
+''' --- MAIN handler --- '''
+
+
+async def handle_turn(event, store, background):
+    '''One Lex turn: dispatch, then fold per-turn state back into the response'''
+
+    #Spoken and keypad digits become plain digit strings before any validator sees them
+    normalize_digit_slots(event, DIGIT_SLOTS)
+    normalize_choice_slots(event, CHOICE_SLOTS)
+
+    filled = filled_slots(event)
+
+    response = await dispatch(event, store, background)
+
+    #Write-behind tasks overlapped with the turn, they only need to be done before we reply
+    await background.drain(bounded_wait(WRITE_BEHIND_WAIT))
+
+    try:
+        record_turn(event, response, filled)
+    except Exception as err:
+        logger.info(f'funnel metrics skipped: {err!r}')
+
+    save_session_state(event)
+
+    return response
+
+
+async def async_lambda_handler(event, context, store=None):
+
+    bot_name = event['bot']['name']
+    userMessage = event['inputTranscript'] #string
+    inputType = event['inputMode'] #DTMF | Speech | Text
+
+    logger.info(f'event.bot.name={bot_name}, userMessage={userMessage}, inputType={inputType}')
+
+    store = store or get_async_store()
+    background = WriteBehind()
+
+    with invocation_deadline(context):
+        #Lex retries fulfillment on timeout, a retried turn gets the first attempt's response back
+        try:
+            return await run_idempotent_async(event, lambda request: handle_turn(request, store, background))
+        except Exception as err:
+            if not is_store_failure(err):
+                raise err
+            #Throttled, out of time, or the circuit is open: answer now rather than let Lex time out
+            logger.info(f'shedding turn: {err!r}')
+            await background.drain(bounded_wait(WRITE_BEHIND_WAIT))
+            return try_again_later(event)
+
+
+#Tables whose connections a keep-warm ping opens
+WARM_TABLES = (tbl_name, customer_tbl_name, transactions_tbl_name, outbox_tbl_name, idempotency_tbl_name, pin_attempts_tbl_name)
+
+
+#Keep-warm pings are answered before anything reads the Lex fields
+@handle_warmups(WARM_TABLES)
+@capture_turns
+def lambda_handler(event, context):
+
+    # By default, treat the user request as coming from the America/New_York time zone.
+    os.environ['TZ'] = 'America/New_York'
+    time.tzset()
+
+    return _event_loop.run_until_complete(async_lambda_handler(event, context))
@@ -6,6 +6,23 @@ import logging
 import uuid 
 from decimal import Decimal
 
+from Bank_Capture import capture_turns
+from Bank_Card_Replacement import record_card_replacement
+from Bank_Cards import CardPoolExhausted, issue_card
+from Bank_Digits import normalize_digit_slots
+from Bank_Funnel import run_tracked
+from Bank_Fuzzy import ACCOUNT_TYPES, PAGE_CHOICES, normalize_choice_slots
+from Bank_Idempotency import run_idempotent, idempotency_tbl_name
+from Bank_Pin_Attempts import reserve_pin_attempt, pin_attempt_failed, release_pin_attempt, pin_attempts_tbl_name
+from Bank_Responses import close, elicit_intent, elicit_slot, delegate, build_validation_result, message, render, text_message
+from Bank_Session import get_session_state, save_session_state, mark_verified, get_verified_account
+from Bank_Ledger import get_balance
+from Bank_Store import (
+    get_table, get_cached_item, is_store_failure, invocation_deadline, has_time_for, PHONE_INDEX_NAME,
+    accounts_tbl_name, customer_tbl_name, transactions_tbl_name
+)
+from Bank_Warmup import handle_warmups
+
 from boto3 import session
 
 
@@ -14,9 +31,20 @@ logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
 
-#Initialize DynamoDB resource
-dyn_resource = boto3.resource('dynamodb')
-tbl_name = 'BankAccountsNew'
+#DynamoDB tables (set BANK_STORE=local to use the in-memory stand-in from Bank_Store)
+tbl_name = accounts_tbl_name
+
+#Transactions read out per page of the mini-statement
+TRANSACTIONS_PAGE_SIZE = 5
+
+#Slots callers answer with digits, normalized from speech / DTMF before validation
+DIGIT_SLOTS = ('accountNumber', 'pin')
+
+#Enumerated slots, resolved to their canonical choice even when slightly misheard
+CHOICE_SLOTS = {'accountType': ACCOUNT_TYPES, 'page': PAGE_CHOICES}
+
+#Attributes Amazon Connect may use to pass the caller's number (ANI) to the bot
+PHONE_ATTRIBUTES = ('CustomerNumber', 'callerPhoneNumber')
 
 
 """ --- Generic functions used to simplify interaction with Amazon Lex --- """
@@ -33,118 +61,42 @@ def get_slots(intent_request):
 #         return None 
 
 
-def get_session_attributes(intent_request):
-    sessionState = intent_request['sessionState']
-    if 'sessionAttributes' in sessionState:
-        return sessionState['sessionAttributes']
-    
-    return {}
-
-
-def close(intent_name, session_attributes, fulfillment_state, message):
-    '''Closes/Ends current Lex session with customer'''
-
-    response = {
-        'sessionState': {
-            'dialogAction': {
-                'type': 'Close'           
-            },
-            'sessionAttributes': session_attributes,
-            'intent': {
-                'confirmationState': 'Confirmed',
-                'name': intent_name,
-                'state': fulfillment_state
-            }
-        },
-        'messages': [
-            message
-        ],
-    }
+def get_slot_value(slots, slotName):
+    '''interpretedValue of a slot, or None if Lex has not filled it yet'''
 
-    return response
-    
+    slot = try_ex(lambda: slots[slotName])
+    if slot is None:
+        return None
 
+    return try_ex(lambda: slot['value']['interpretedValue'])
 
-def elicit_intent(session_attributes, message):
-    '''Informs Amazon Lex that the user is expected to respond with an utterance that includes an intent. '''
-    
-    return {
-        'sessionState':{
-            'dialogAction':{
-                'type':'ElicitIntent',
-                'slotToElicit': None
-            },
-            'sessionAttributes': session_attributes
-        },
-        'messages': [message] if message != None else None
-    }
 
+def build_slot(value):
+    '''Slot in the shape Lex sends it, for slots the bot fills in itself'''
 
-def confirm_intent(session_attributes, intent_name, slots, message):
-    '''Informs Amazon Lex that the user is expected to give a yes or no answer to confirm or deny the current intent'''
     return {
-        'messages': [
-            message
-        ],
-        'sessionState': {
-            'sessionAttributes': session_attributes,
-            'dialogAction': {
-                'type': 'ConfirmIntent'
-            },
-            'intent': {
-                'name': intent_name,
-                'slots': slots
-            }
+        'shape': 'Scalar',
+        'value': {
+            'originalValue': value,
+            'interpretedValue': value,
+            'resolvedValues': [value]
         }
     }
 
 
-def elicit_slot(intent_name, slots, violated_slot, session_attributes, message):
-    '''Re-prompts user to provide a slot value in the response'''
-    return {
-        'sessionState':{
-            'sessionAttributes': session_attributes,
-            'dialogAction':{
-                'slotToElicit': violated_slot,
-                'type':'ElicitSlot'
-            },
-            'intent':{
-                'confirmationState': 'Denied',
-                'name':intent_name,
-                'slots':slots,
-                'state':'InProgress'
-            }
-        },
-        'messages': [message] if message != None else None
-    }
+def get_session_attributes(intent_request):
+    '''Flat Lex session attributes. Structured state lives in Bank_Session.get_session_state'''
 
+    #setdefault so anything written here (e.g. the packed session state) reaches the response
+    return intent_request['sessionState'].setdefault('sessionAttributes', {})
 
-def delegate(intent_name, slots, session_attributes):
-    '''Directs Amazon Lex to choose the next course of action based on the bot configuration. '''
-    return {
-        'sessionState':{
-            'sessionAttributes': session_attributes,
-            'dialogAction':{
-                'type':'Delegate'
-            },
-            'intent':{
-                'name':intent_name,
-                'slots': slots
-            }
-        }
-    }
 
+def try_again_later(intent_request):
+    '''Degraded but valid reply for when the account tables are shedding load'''
 
-def build_validation_result(is_valid, violated_slot, message_content):
+    intent_name = intent_request['sessionState']['intent']['name']
 
-    return {
-        'isValid': is_valid,
-        'violatedSlot': violated_slot,
-        'message':{
-            'contentType':'PlainText',
-            'content': message_content
-        }
-    }
+    return close(intent_name, get_session_attributes(intent_request), 'Failed', message('try_again_account'))
 
 
 
@@ -191,9 +143,8 @@ def isValid_AccountNumber(accountNumber):
 
 def isValid_AccountType(accountType):
 
-    account_types = ['checking', 'savings', 'checkings','saving']
-
-    return accountType.lower() in account_types
+    #Near-misses ("savins", "check in") count too, see Bank_Fuzzy
+    return ACCOUNT_TYPES.is_valid(accountType)
 
 
 
@@ -202,19 +153,38 @@ def validate_account_dynamodb(table_name, accountNumber):
     
     if accountNumber is None: return False
 
-    table = dyn_resource.Table(table_name)
+    #Reads through the warm cache, so the Pin check and fulfillment reads that follow reuse this item
+    return get_cached_item(table_name, {'AccountNumber': Decimal(accountNumber)}) is not None
 
-    try:
-        response = table.get_item(Key={
-            'AccountNumber': Decimal(accountNumber)
-        })['Item']
-    except KeyError:
-        return False
 
-    return True
+def pin_lockout_result():
+    '''Validation result for a caller out of PIN attempts. Handlers end the intent on it instead of re-asking'''
+
+    result = build_validation_result(False, 'pin', 'pin_locked')
+    result['lockedOut'] = True
+
+    return result
+
+
+def check_pin(accountNumber, user_pin, sessionId=None):
+    '''Checks a well-formed pin against the account and its retry budget. None if it is correct'''
+
+    #The attempt is charged before the Pin is read, so callers out of attempts never get a compare
+    attempt = reserve_pin_attempt(accountNumber, sessionId)
+    if attempt is None:
+        return pin_lockout_result()
+
+    if Decimal(user_pin) != get_item_dynamodb(accountNumber, 'Pin'):
+        if pin_attempt_failed(attempt):
+            return pin_lockout_result()
+        return build_validation_result(False, 'pin', 'pin_incorrect')
+
+    release_pin_attempt(attempt)
 
+    return None
 
-def validate_balance_information(slots):
+
+def validate_balance_information(slots, sessionId=None):
 
     table_name = tbl_name 
 
@@ -227,46 +197,36 @@ def validate_balance_information(slots):
 
 
     if accountType and not isValid_AccountType(accountType['value']['interpretedValue']):
-        return build_validation_result(
-            False,
-            'accountType',
-            'Sorry I did not understand. Would you like to get the account balance for your Checking account or your Savings account?'
-        )
+        return build_validation_result(False, 'accountType', 'balance_account_type_unclear')
     
     if accountNumber:
         if not isValid_AccountNumber(accountNumber['value']['interpretedValue']):
             return build_validation_result(
                 False,
                 'accountNumber',
-                'Sorry this is not a valid account number. Please enter your twelve digit {} account number'.format(accountType['value']['interpretedValue'])
+                'account_number_invalid',
+                accountType=accountType['value']['interpretedValue'] if accountType else 'bank'
             )
         if not validate_account_dynamodb(table_name, accountNumber['value']['interpretedValue']):
             return build_validation_result(
                 False,
                 'accountNumber',
-                'Sorry but the account number {} does not exist in our database. Please enter your twelve digit account number.'.format(accountNumber['value']['interpretedValue'])
+                'account_number_unknown',
+                accountNumber=accountNumber['value']['interpretedValue']
             )
 
-##TODO: Add a counter (perhaps to sessionAttributes) to put a cap on retries for Pin Number.  
     if pin:
         user_pin = pin['value']['interpretedValue']
         logger.info(f'pin={pin} and user_pin={user_pin}')
         if not isValid_Pin(user_pin):
-            return build_validation_result(
-                False,
-                'pin',
-                'Sorry this is not a valid pin. Please enter your four digit pin number.'
-            )
-        if Decimal(user_pin) != get_item_dynamodb(accountNumber['value']['interpretedValue'], 'Pin'):
-            return build_validation_result(
-                False,
-                'pin',
-                'The pin number entered is incorrect. Please enter your four digit pin number.'
-            )
+            return build_validation_result(False, 'pin', 'pin_invalid')
+        pin_result = check_pin(accountNumber['value']['interpretedValue'], user_pin, sessionId)
+        if pin_result is not None:
+            return pin_result
     
     return {'isValid':True}
 
-def validate_followup_information(slots):
+def validate_followup_information(slots, sessionId=None):
     
     
     table_name = tbl_name 
@@ -284,58 +244,44 @@ def validate_followup_information(slots):
         response = None
 
         if firstName and isValid_Word(firstName['value']['interpretedValue']):
-            return build_validation_result(
-                False,
-                'firstName',
-                "Sorry, I did not understand, May you repeat your first name to me once again."
-        )
+            return build_validation_result(False, 'firstName', 'first_name_unclear')
 
         return response
 
 
     if accountType and not isValid_AccountType(accountType['value']['interpretedValue']):
-        return build_validation_result(
-            False,
-            'accountType',
-            'Sorry I did not understand. Would you like to get the account balance for your Checking account or your Savings account?'
-        )
+        return build_validation_result(False, 'accountType', 'balance_account_type_unclear')
     
     if accountNumber:
         if not isValid_AccountNumber(accountNumber['value']['interpretedValue']):
             return build_validation_result(
                 False,
                 'accountNumber',
-                'Sorry this is not a valid account number. Please enter your twelve digit {} account number'.format(accountType['value']['interpretedValue'])
+                'account_number_invalid',
+                accountType=accountType['value']['interpretedValue'] if accountType else 'bank'
             )
         if not validate_account_dynamodb(table_name, accountNumber['value']['interpretedValue']):
             return build_validation_result(
                 False,
                 'accountNumber',
-                'Sorry but the account number {} does not exist in our database. Please enter your twelve digit account number.'.format(accountNumber['value']['interpretedValue'])
+                'account_number_unknown',
+                accountNumber=accountNumber['value']['interpretedValue']
             )
 
-##TODO: Add a counter (perhaps to sessionAttributes) to put a cap on retries for Pin Number.  
     if pin:
         user_pin = pin['value']['interpretedValue']
         logger.info(f'pin={pin} and user_pin={user_pin}')
         if not isValid_Pin(user_pin):
-            return build_validation_result(
-                False,
-                'pin',
-                'Sorry this is not a valid pin. Please enter your four digit pin number.'
-            )
-        if Decimal(user_pin) != get_item_dynamodb(accountNumber['value']['interpretedValue'], 'Pin'):
-            return build_validation_result(
-                False,
-                'pin',
-                'The pin number entered is incorrect. Please enter your four digit pin number.'
-            )
+            return build_validation_result(False, 'pin', 'pin_invalid')
+        pin_result = check_pin(accountNumber['value']['interpretedValue'], user_pin, sessionId)
+        if pin_result is not None:
+            return pin_result
     
     return {'isValid':True}
 
 
 
-def validate_replace_card_information(slots):
+def validate_replace_card_information(slots, sessionId=None):
 
     table_name = tbl_name 
 
@@ -347,43 +293,29 @@ def validate_replace_card_information(slots):
     logger.info(f'accountNumber={accountNumber}, pin={pin}')
 
     if firstName and not isValid_Word(firstName['value']['interpretedValue']):
-        return build_validation_result(
-            False,
-            'firstName',
-            "I did not understand. May you repeat your first name to me once again."
-        )
+        return build_validation_result(False, 'firstName', 'first_name_unclear')
 
     
     if accountNumber:
         if not isValid_AccountNumber(accountNumber['value']['interpretedValue']):
-            return build_validation_result(
-                False,
-                'accountNumber',
-                'Sorry this is not a valid account number. Please enter your twelve digit bank account number'
-            )
+            return build_validation_result(False, 'accountNumber', 'account_number_invalid', accountType='bank')
 
         if not validate_account_dynamodb(table_name, accountNumber['value']['interpretedValue']):
             return build_validation_result(
                 False,
                 'accountNumber',
-                'Sorry but the account number {} does not exist in our database. Please enter your twelve digit account number.'.format(accountNumber['value']['interpretedValue'])
+                'account_number_unknown',
+                accountNumber=accountNumber['value']['interpretedValue']
             )
 
     if pin:
         user_pin = pin['value']['interpretedValue']
         logger.info(f'pin={pin} and user_pin={user_pin}')
         if not isValid_Pin(user_pin):
-            return build_validation_result(
-                False,
-                'pin',
-                'Sorry this is not a valid pin. Please enter your four digit pin number.'
-            )
-        if Decimal(user_pin) != get_item_dynamodb(accountNumber['value']['interpretedValue'], 'Pin'):
-            return build_validation_result(
-                False,
-                'pin',
-                'The pin number entered is incorrect. Please enter your four digit pin number.'
-            )
+            return build_validation_result(False, 'pin', 'pin_invalid')
+        pin_result = check_pin(accountNumber['value']['interpretedValue'], user_pin, sessionId)
+        if pin_result is not None:
+            return pin_result
     
     return {'isValid':True}
 
@@ -407,37 +339,264 @@ def try_ex(func):
 
 
 def get_item_dynamodb(accountNumber, query_params):
-    '''retrieves element from DynamoDB'''
+    '''retrieves element from DynamoDB (or from the warm cache)'''
 
     table_name = tbl_name
 
-    table = dyn_resource.Table(table_name)
-    
     if (accountNumber is None) | (query_params is None): return False
 
-    try:
-        response = table.get_item(Key={
-            'AccountNumber': Decimal(accountNumber)
-        })['Item']
-    except KeyError:
+    response = get_cached_item(table_name, {'AccountNumber': Decimal(accountNumber)})
+    if response is None:
         return False
 
     return response[query_params]
 
+def get_account_fields(accountNumber, *fields):
+    '''Several attributes from one read of the account (False for each when there is no account)'''
+
+    response = get_cached_item(tbl_name, {'AccountNumber': Decimal(accountNumber)})
+    if response is None:
+        return [False for field in fields]
+
+    return [response[field] for field in fields]
+
+def normalize_phone_number(phoneNumber):
+    '''E.164 form of a caller number ("(555) 123-4567" -> "+15551234567")'''
+
+    digits = ''.join(c for c in str(phoneNumber) if c.isdigit())
+    if not digits:
+        return None
+    if len(digits) == 10:
+        digits = '1' + digits
+
+    return '+' + digits
+
+
+def get_caller_phone_number(intent_request):
+    '''Caller's number as passed through by the Amazon Connect contact flow, if any'''
+
+    for attributes in (get_session_attributes(intent_request), intent_request.get('requestAttributes') or {}):
+        for name in PHONE_ATTRIBUTES:
+            if attributes.get(name):
+                return normalize_phone_number(attributes[name])
+
+    return None
+
+
+def phone_lookup_params(phoneNumber):
+    from boto3.dynamodb.conditions import Key
+
+    return {
+        'IndexName': PHONE_INDEX_NAME,
+        'KeyConditionExpression': Key('Phone Number').eq(phoneNumber),
+        'ProjectionExpression': 'AccountNumber',
+        'Limit': 2
+    }
+
+
+def single_account(response):
+    '''Only a number tied to exactly one account is trusted'''
+
+    if len(response['Items']) != 1 or 'LastEvaluatedKey' in response:
+        return None
+
+    return str(response['Items'][0]['AccountNumber'])
+
+
+def lookup_account_by_phone(phoneNumber):
+    '''One Query on the phone number GSI'''
+
+    return single_account(get_table(tbl_name).query(**phone_lookup_params(phoneNumber)))
+
+
+def saved_caller_lookup(intent_request, phoneNumber):
+    lookup = get_session_state(intent_request).get('callerLookup')
+
+    return lookup if lookup is not None and lookup['phone'] == phoneNumber else None
+
+
+def save_caller_lookup(intent_request, phoneNumber, accountNumber):
+    lookup = {'phone': phoneNumber, 'accountNumber': accountNumber}
+    get_session_state(intent_request)['callerLookup'] = lookup
+    logger.info(f'caller lookup found accountNumber={accountNumber}')
+
+    return lookup
+
+
+def get_caller_account(intent_request):
+    '''Account number for the calling phone, looked up once per call and kept in session state'''
+
+    phoneNumber = get_caller_phone_number(intent_request)
+    if phoneNumber is None:
+        return None
+
+    lookup = saved_caller_lookup(intent_request, phoneNumber)
+    if lookup is None:
+        #Only a convenience, the caller can still say the account number
+        if not has_time_for():
+            return None
+        lookup = save_caller_lookup(intent_request, phoneNumber, lookup_account_by_phone(phoneNumber))
+
+    return lookup['accountNumber']
+
+
+def prefill_account_number(intent_request, slots):
+    '''Fills an empty accountNumber slot from the caller's phone so only the PIN is left to ask for'''
+
+    if get_slot_value(slots, 'accountNumber') is not None:
+        return False
+
+    accountNumber = get_caller_account(intent_request)
+    if accountNumber is None:
+        return False
+
+    slots['accountNumber'] = build_slot(accountNumber)
+
+    return True
+
+
+def account_summary_params(customerId):
+    from boto3.dynamodb.conditions import Key
+
+    return {
+        'KeyConditionExpression': Key('CustomerId').eq(customerId),
+        'ProjectionExpression': 'AccountType, AccountNumber, #balance',
+        'ExpressionAttributeNames': {'#balance': 'Account Balance'},
+        'ConsistentRead': True
+    }
+
+
+def get_account_summary(accountNumber):
+    '''All of the customer's accounts and balances in one Query. None until the account has a CustomerId'''
+
+    item = get_cached_item(tbl_name, {'AccountNumber': Decimal(accountNumber)})
+    if item is None or 'CustomerId' not in item:
+        return None
+
+    return get_table(customer_tbl_name).query(**account_summary_params(item['CustomerId']))['Items']
+
+
+def describe_accounts(accounts):
+    '''One sentence per account, for customers with several. None for a single account'''
+
+    if not accounts or len(accounts) < 2:
+        return None
+
+    logger.info(f'accounts={accounts}')
+
+    return ''.join(
+        render(
+            'balance_line', 'PlainText',
+            accountType=account['AccountType'], lastFour=str(account['AccountNumber'])[-4:], balance=account['Account Balance']
+        )
+        for account in accounts
+    )
+
+
+def describe_balances(intent_request, accountNumber):
+    '''Balance sentence(s): every account for customers with several, otherwise the one asked about'''
+
+    #Balances are read at fulfillment, never from a cache, since a posting from another container can land in between
+    summary = describe_accounts(get_account_summary(accountNumber))
+    if summary is not None:
+        return summary
+
+    balance = get_balance(accountNumber)
+    logger.info(f'balance={balance}')
+
+    return render('balance', 'PlainText', balance=balance)
+
+
+def transactions_page_params(accountNumber, cursor=None, page_size=TRANSACTIONS_PAGE_SIZE):
+    from boto3.dynamodb.conditions import Key
+
+    params = {
+        'KeyConditionExpression': Key('AccountNumber').eq(Decimal(accountNumber)),
+        'ScanIndexForward': False,
+        'Limit': page_size,
+        'ProjectionExpression': 'PostedAt, Amount, Description'
+    }
+    if cursor is not None:
+        params['ExclusiveStartKey'] = cursor
+
+    return params
+
+
+def get_transactions_page(accountNumber, cursor=None, page_size=TRANSACTIONS_PAGE_SIZE):
+    '''One bounded Query, newest first. Returns (transactions, cursor for the next page or None)'''
+
+    response = get_table(transactions_tbl_name).query(**transactions_page_params(accountNumber, cursor, page_size))
+
+    return response['Items'], response.get('LastEvaluatedKey')
+
+
+def describe_transactions(transactions):
+
+    sentences = []
+    for transaction in transactions:
+        amount = transaction['Amount']
+        kind = 'A deposit' if amount > 0 else 'A payment'
+        sentences.append(render(
+            'transaction_line', 'PlainText',
+            kind=kind, amount=abs(amount), description=transaction.get('Description', 'no description'), day=transaction['PostedAt'][:10]
+        ))
+
+    return ''.join(sentences)
+
+
+def saved_transactions_cursor(intent_request, accountNumber, continue_listing):
+    saved = get_session_state(intent_request).get('transactionCursor')
+
+    if continue_listing and saved is not None and saved['accountNumber'] == str(accountNumber):
+        return saved['cursor']
+
+    return None
+
+
+def read_transactions(intent_request, accountNumber, continue_listing):
+    '''Next mini-statement page. The LastEvaluatedKey cursor is kept in session state so "next five" is one page read'''
+
+    cursor = saved_transactions_cursor(intent_request, accountNumber, continue_listing)
+    transactions, next_cursor = get_transactions_page(accountNumber, cursor)
+
+    return describe_transactions_page(intent_request, accountNumber, cursor, transactions, next_cursor)
+
+
+def describe_transactions_page(intent_request, accountNumber, cursor, transactions, next_cursor):
+    '''The page's sentences, with the cursor for "next five" saved (or dropped on the last page)'''
+
+    logger.info(f'transactions={len(transactions)}, more={next_cursor is not None}')
+
+    session_state = get_session_state(intent_request)
+
+    if next_cursor is not None:
+        session_state['transactionCursor'] = {'accountNumber': str(accountNumber), 'cursor': next_cursor}
+    elif 'transactionCursor' in session_state:
+        del session_state['transactionCursor']
+
+    if not transactions:
+        return render('transactions_no_more' if cursor else 'transactions_none', 'PlainText')
+
+    output = describe_transactions(transactions)
+    if next_cursor is not None:
+        output += render('transactions_more', 'PlainText')
+
+    return output
+
+
 def write_item_dynamodb(table_name, items):
     '''Inserts element into DynamoDB'''
 
     from botocore.exceptions import ClientError
 
-    table = dyn_resource.Table(table_name)
+    table = get_table(table_name)
 
     try:
         response = table.put_item(Item=items)
     except ClientError as err:
-        if err.response['Error']['Code'] == 'InternalError':
-            logger.info('Error Message: {}'.format(err.response['Error']['Message']))
-        else:
-            raise err
+        #InternalError included: botocore has already retried it, reporting the write as done would lose it
+        logger.info('Error Message: {}'.format(err.response['Error']['Message']))
+        raise err
 
     return True
     
@@ -448,7 +607,7 @@ def getValid_AccountNumber():
 
     accountNumber = Decimal(str(uuid.uuid4().int)[:12])
 
-    table = dyn_resource.Table(table_name)
+    table = get_table(table_name)
 
     try:
         response = table.get_item(Key={
@@ -480,6 +639,9 @@ def Greeting(intent_request):
 
     if source == 'DialogCodeHook':
 
+        #Look the caller up by phone number while we are still greeting them
+        get_caller_account(intent_request)
+
         if firstName and not isValid_Word(firstName['value']['interpretedValue']):
             slots['firstName'] = None
             return elicit_slot(
@@ -487,7 +649,8 @@ def Greeting(intent_request):
                 slots, 
                 'firstName', 
                 session_attributes,
-                'Sorry I did not understand. May you repeat your first name once more.'
+                message('first_name_unclear'),
+                reason='first_name_unclear'
             )
         #     return {
         #     'sessionState':{
@@ -514,19 +677,10 @@ def Greeting(intent_request):
     
     logger.info(f'firstName={firstName}')
     
-    output = f'Nice to meet you {firstName}! How may I help you today?'
+    #return close(intent_name, session_attributes, 'InProgress', message('greeting', firstName=firstName))
     
-    message = {
-        'contentType': 'PlainText',
-        'content':output
-    }
-    
-    fulfillment_state = 'InProgress'
-    
-    #return close(intent_name, session_attributes, fulfillment_state, message)
-    
-    #return elicit_slot('', slots, '', session_attributes, message)
-    return elicit_intent(session_attributes, message)
+    #return elicit_slot('', slots, '', session_attributes, message('greeting', firstName=firstName))
+    return elicit_intent(session_attributes, message('greeting', firstName=firstName))
 
     #return delegate(intent_name,intent_request['sessionState']['intent']['slots'] ,session_attributes)
 
@@ -546,10 +700,15 @@ def CheckBalance(intent_request):
 
 
     if source == 'DialogCodeHook':
+        #Known caller numbers pre-fill accountNumber, leaving only the PIN to collect
+        prefill_account_number(intent_request, slots)
+
         # Valdiate any slots which have been specified. If any are invalid, re-elicit for their value.
-        validation_result = validate_balance_information(slots)
+        validation_result = validate_balance_information(slots, intent_request['sessionId'])
         logger.info('validation_result is {} for the non-empty slots in {}'.format(validation_result['isValid'],slots))
         if not validation_result['isValid']:
+            if validation_result.get('lockedOut'):
+                return close(intent_name, session_attributes, 'Failed', validation_result['message'])
             slots[validation_result['violatedSlot']] = None
             logger.debug(f'slots={slots}')
             logger.info('violatedSlot={}, message={}'.format(validation_result['violatedSlot'], validation_result['message']))
@@ -558,24 +717,20 @@ def CheckBalance(intent_request):
                 slots,
                 validation_result['violatedSlot'],
                 session_attributes,
-                validation_result['message']
+                validation_result['message'],
+                reason=validation_result['reason']
             )
-        
-        return delegate(intent_name,intent_request['sessionState']['intent']['slots'] ,session_attributes)
 
-    
-    balance = get_item_dynamodb(slots['accountNumber']['value']['interpretedValue'], 'Account Balance')
-    logger.info(f'balance={balance}')
+        #Lets RecentTransactions skip re-identification later in the call
+        if get_slot_value(slots, 'pin') is not None:
+            mark_verified(intent_request, get_slot_value(slots, 'accountNumber'))
 
-    output1 = f'The balance on your account is ${balance:,.2f} dollars. '
-    output2 = 'Thank you for banking with Example Bank. We appreciate your business. '
-    output3= 'Please stay on the line if you would like to take our customer experience survey.'
-    output = output1+output2+output3
-    fulfillment_state = 'Fulfilled'
+        return delegate(intent_name,intent_request['sessionState']['intent']['slots'] ,session_attributes)
 
-    message = {'contentType':'PlainText', 'content':output}
     
-    return close(intent_name, session_attributes, fulfillment_state, message)
+    balances = describe_balances(intent_request, slots['accountNumber']['value']['interpretedValue'])
+
+    return close(intent_name, session_attributes, 'Fulfilled', message('balance_closing', balances=balances))
 
 
 def FollowupCheckBalance(intent_request):
@@ -593,10 +748,15 @@ def FollowupCheckBalance(intent_request):
     logger.info(f'These are the session attributes: {session_attributes}')
 
     if source == 'DialogCodeHook':
+        #Known caller numbers pre-fill accountNumber, leaving only the PIN to collect
+        prefill_account_number(intent_request, slots)
+
         # Valdiate any slots which have been specified. If any are invalid, re-elicit for their value.
-        validation_result = validate_followup_information(slots)
+        validation_result = validate_followup_information(slots, intent_request['sessionId'])
         logger.info('validation_result is {} for the non-empty slots in {}'.format(validation_result['isValid'],slots))
         if not validation_result['isValid']:
+            if validation_result.get('lockedOut'):
+                return close(intent_name, session_attributes, 'Failed', validation_result['message'])
             slots[validation_result['violatedSlot']] = None
             logger.debug(f'slots={slots}')
             logger.info('violatedSlot={}, message={}'.format(validation_result['violatedSlot'], validation_result['message']))
@@ -631,24 +791,20 @@ def FollowupCheckBalance(intent_request):
                 slots,
                 validation_result['violatedSlot'],
                 session_attributes,
-                'Sorry I did not understand. May you repeat your first name once more.'
+                validation_result['message'],
+                reason=validation_result['reason']
             )
-        
-        return delegate(intent_name,intent_request['sessionState']['intent']['slots'] ,session_attributes)
 
-    
-    balance = get_item_dynamodb(slots['accountNumber']['value']['interpretedValue'], 'Account Balance')
-    logger.info(f'balance={balance}')
+        #Lets RecentTransactions skip re-identification later in the call
+        if get_slot_value(slots, 'pin') is not None:
+            mark_verified(intent_request, get_slot_value(slots, 'accountNumber'))
 
-    output1 = f'The balance on your account is ${balance:,.2f} dollars. '
-    output2 = 'Thank you for banking with Example Bank. We appreciate your business. '
-    output3= 'Please stay on the line if you would like to take our customer experience survey.'
-    output = output1+output2+output3
-    fulfillment_state = 'Fulfilled'
+        return delegate(intent_name,intent_request['sessionState']['intent']['slots'] ,session_attributes)
 
-    message = {'contentType':'PlainText', 'content':output}
     
-    return close(intent_name, session_attributes, fulfillment_state, message)
+    balances = describe_balances(intent_request, slots['accountNumber']['value']['interpretedValue'])
+
+    return close(intent_name, session_attributes, 'Fulfilled', message('balance_closing', balances=balances))
 
 
 
@@ -667,10 +823,15 @@ def ReplaceCard(intent_request):
     logger.info(f'These are the session attributes: {session_attributes}')
 
     if source == 'DialogCodeHook':
+        #Known caller numbers pre-fill accountNumber, leaving only the PIN to collect
+        prefill_account_number(intent_request, slots)
+
         # Valdiate any slots which have been specified. If any are invalid, re-elicit for their value.
-        validation_result = validate_replace_card_information(slots)
+        validation_result = validate_replace_card_information(slots, intent_request['sessionId'])
         logger.info('validation_result is {} for the non-empty slots in {}'.format(validation_result['isValid'],slots))
         if not validation_result['isValid']:
+            if validation_result.get('lockedOut'):
+                return close(intent_name, session_attributes, 'Failed', validation_result['message'])
             slots[validation_result['violatedSlot']] = None
             logger.debug(f'slots={slots}')
             logger.info('violatedSlot={}, message={}'.format(validation_result['violatedSlot'], validation_result['message']))
@@ -705,29 +866,85 @@ def ReplaceCard(intent_request):
                 slots,
                 validation_result['violatedSlot'],
                 session_attributes,
-                'Sorry I did not understand. May you repeat your first name once more.'
+                validation_result['message'],
+                reason=validation_result['reason']
             )
-        
+
         return delegate(intent_name,intent_request['sessionState']['intent']['slots'] ,session_attributes)
 
 
     #Generate/Initalize Output values
-    cardNumber = Decimal(str(uuid.uuid4().int))[:16]
-    email_address = get_item_dynamodb(slots['accountNumber']['value']['interpretedValue'], 'Email Address')
-    street_address = get_item_dynamodb(slots['acountNumber']['value']['interpretedValue'], 'Street Address')
-    
-    logger.info(f'cardNumber={cardNumber}, email address={email_address}, street_address={street_address}')
+    try:
+        cardToken, cardNumber = issue_card()
+    except CardPoolExhausted:
+        logger.warning('card pool exhausted, replacement not recorded')
+        return close(intent_name, session_attributes, 'Failed', message('card_unavailable'))
 
-    out = f'An email has been sent to {email_address} containing your new debit card information. ' 
-    out2 = f'Your new debit card ending in {cardNumber[-4:]} has been mailed out to {street_address}. '
-    out3 = 'Please expect it to arrive within five to seven business days.'
-    
-    output = out+out2+out3
-    fulfillment_state = 'Fulfilled'
+    accountNumber = get_slot_value(slots, 'accountNumber')
 
-    message = {'contentType':'PlainText', 'content':output}
+    #Both addresses come from the same account item, so one read covers them
+    email_address, street_address = get_account_fields(accountNumber, 'Email Address', 'Street Address')
     
-    return close(intent_name, session_attributes, fulfillment_state, message)
+    logger.info(f'cardNumber=...{cardNumber[-4:]}, email address={email_address}, street_address={street_address}')
+
+    #Mailing the card and sending the email happen on the replacement workers, this turn only records the job
+    job = record_card_replacement(accountNumber, cardToken, cardNumber, get_slot_value(slots, 'firstName'), email_address, street_address)
+    logger.info(f"replacement job={job['JobId']}")
+
+    reply = message('card_replaced', email=email_address, lastFour=cardNumber[-4:], street=street_address)
+
+    return close(intent_name, session_attributes, 'Fulfilled', reply)
+
+
+
+def RecentTransactions(intent_request):
+
+    #Initialize required response parameters
+    intent_name = intent_request['sessionState']['intent']['name']
+    session_attributes = get_session_attributes(intent_request)
+    source = intent_request['invocationSource']
+    confirmation_status = intent_request['sessionState']['intent']['confirmationState']
+    slots = get_slots(intent_request)
+
+    logger.info(f'source={source}, slots={slots}, confirmation_status={confirmation_status}')
+
+    #"next five" / "more" carries on from the saved cursor instead of starting at the newest transaction
+    continue_listing = get_slot_value(slots, 'page') == 'next'
+
+    if source == 'DialogCodeHook':
+        #Caller already gave account number and PIN this call (e.g. in CheckBalance): answer right away
+        verified = get_verified_account(intent_request)
+        if verified is not None and get_slot_value(slots, 'accountNumber') in (None, verified):
+            output = read_transactions(intent_request, verified, continue_listing)
+            return close(intent_name, session_attributes, 'Fulfilled', text_message(output))
+
+        #Known caller numbers pre-fill accountNumber, leaving only the PIN to collect
+        prefill_account_number(intent_request, slots)
+
+        validation_result = validate_balance_information(slots, intent_request['sessionId'])
+        logger.info('validation_result is {} for the non-empty slots in {}'.format(validation_result['isValid'],slots))
+        if not validation_result['isValid']:
+            if validation_result.get('lockedOut'):
+                return close(intent_name, session_attributes, 'Failed', validation_result['message'])
+            slots[validation_result['violatedSlot']] = None
+            return elicit_slot(
+                intent_name,
+                slots,
+                validation_result['violatedSlot'],
+                session_attributes,
+                validation_result['message'],
+                reason=validation_result['reason']
+            )
+
+        if get_slot_value(slots, 'pin') is not None:
+            mark_verified(intent_request, get_slot_value(slots, 'accountNumber'))
+
+        return delegate(intent_name,intent_request['sessionState']['intent']['slots'] ,session_attributes)
+
+
+    output = read_transactions(intent_request, get_slot_value(slots, 'accountNumber'), continue_listing)
+
+    return close(intent_name, session_attributes, 'Fulfilled', text_message(output))
 
 
 
@@ -755,6 +972,9 @@ def dispatch(intent_request):
     if intent_name == 'FollowupCheckBalance':
        return FollowupCheckBalance(intent_request)
 
+    if intent_name == 'RecentTransactions':
+        return RecentTransactions(intent_request)
+
 
     raise Exception('Intent with name ' + intent_name + ' not supported')
 
@@ -763,7 +983,31 @@ def dispatch(intent_request):
 ''' --- MAIN handler --- '''
 
 
+def handle_turn(intent_request):
+    '''One Lex turn: dispatch, then fold per-turn state back into the response'''
 
+    #Spoken and keypad digits become plain digit strings before any validator sees them
+    normalize_digit_slots(intent_request, DIGIT_SLOTS)
+    normalize_choice_slots(intent_request, CHOICE_SLOTS)
+
+    #Counts the turn (and any re-prompt) toward the call's funnel metrics
+    response = run_tracked(intent_request, dispatch)
+
+    #Only re-encodes the packed session state if a handler changed it
+    save_session_state(intent_request)
+
+    return response
+
+
+
+
+#Tables whose connections a keep-warm ping opens
+WARM_TABLES = (tbl_name, customer_tbl_name, transactions_tbl_name, idempotency_tbl_name, pin_attempts_tbl_name)
+
+
+#Keep-warm pings are answered before anything reads the Lex fields
+@handle_warmups(WARM_TABLES)
+@capture_turns
 def lambda_handler(event, context):
     
     # By default, treat the user request as coming from the America/New_York time zone.
@@ -778,4 +1022,14 @@ def lambda_handler(event, context):
     logger.info(f'event.bot.name={bot_name}, userMessage={userMessage}, inputType={inputType}')
 
 
-    return dispatch(event)
\ No newline at end of file
+    #Every store call and optional step below is bounded by the time Lambda has left
+    with invocation_deadline(context):
+        #Lex retries fulfillment on timeout, a retried turn gets the first attempt's response back
+        try:
+            return run_idempotent(event, handle_turn)
+        except Exception as err:
+            if not is_store_failure(err):
+                raise err
+            #Throttled, out of time, or the circuit is open: answer now rather than let Lex time out
+            logger.info(f'shedding turn: {err!r}')
+            return try_again_later(event)
\ No newline at end of file
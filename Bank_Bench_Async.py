@@ -0,0 +1,110 @@
+''' Compares the sync and asyncio CheckBalance handlers under simulated DynamoDB latency.
+
+Usage: BANK_STORE=local python Bank_Bench_Async.py [latency_ms] [iterations]
+'''
+
+import os
+import sys
+import time
+import uuid
+import asyncio
+import statistics
+from decimal import Decimal
+
+os.environ.setdefault('BANK_STORE', 'local')
+#The bench only touches its in-memory store, whose card numbers are throwaway
+os.environ.setdefault('BANK_CARD_POOL_KEY', 'bench-card-pool-key')
+
+import Bank_Store
+import Bank_Balance_Replace_V2 as sync_handlers
+import Bank_Balance_Replace_Async as async_handlers
+from Bank_Store import LocalResource, FixedLatency, warm_cache_clear
+from Bank_Store_Async import LocalAsyncStore
+
+
+ACCOUNT_NUMBER = '123456789012'
+
+
+def slot(value):
+    return {'value': {'originalValue': value, 'interpretedValue': value, 'resolvedValues': [value]}}
+
+
+def build_event(intent_name, slots, source, session_attributes, session_id='bench'):
+    return {
+        'bot': {'name': 'BankBot'},
+        'inputTranscript': '',
+        'inputMode': 'Text',
+        'invocationSource': source,
+        'sessionId': session_id,
+        'sessionState': {
+            'intent': {'name': intent_name, 'slots': dict(slots), 'confirmationState': 'None'},
+            'sessionAttributes': dict(session_attributes)
+        }
+    }
+
+
+def dialog():
+    '''One CheckBalance call: account number turn, pin turn, fulfillment'''
+
+    slots = {'accountType': slot('checking'), 'accountNumber': slot(ACCOUNT_NUMBER), 'pin': None}
+    yield 'CheckBalance', slots, 'DialogCodeHook'
+
+    slots = dict(slots, pin=slot('1234'))
+    yield 'CheckBalance', slots, 'DialogCodeHook'
+    yield 'CheckBalance', slots, 'FulfillmentCodeHook'
+
+
+def run_dialog(handler):
+    #A fresh session per run, otherwise fulfillment is replayed from the idempotency record
+    session_id = uuid.uuid4().hex
+    session_attributes = {}
+    for intent_name, slots, source in dialog():
+        #Each turn may land on a different container, so nothing survives in the warm cache
+        warm_cache_clear()
+        response = handler(build_event(intent_name, slots, source, session_attributes, session_id), None)
+        session_attributes = response['sessionState'].get('sessionAttributes') or {}
+
+
+def measure(handler, iterations):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        run_dialog(handler)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return timings
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f'{name:>6}: mean={statistics.mean(timings):7.2f}ms  p50={statistics.median(timings):7.2f}ms  p95={p95:7.2f}ms')
+
+
+def main(latency_ms=20.0, iterations=50):
+    resource = LocalResource()
+    resource.Table(sync_handlers.tbl_name).put_item(Item={
+        'AccountNumber': Decimal(ACCOUNT_NUMBER),
+        'Pin': Decimal('1234'),
+        'Account Balance': Decimal('1500.25'),
+        'Email Address': 'caller@example.com',
+        'Street Address': '1 Main Street'
+    })
+
+    #Both handlers see the same items. The sync tables sleep on every call (LocalTable.set_latency), the async
+    #store awaits the same latency instead, so its replica's tables are left without one
+    Bank_Store.set_resource(LocalResource(replica_of=resource, latency=FixedLatency(latency_ms)))
+    async_store = LocalAsyncStore(LocalResource(replica_of=resource), FixedLatency(latency_ms))
+
+    def async_handler(event, context):
+        return async_handlers._event_loop.run_until_complete(
+            async_handlers.async_lambda_handler(event, context, store=async_store)
+        )
+
+    print(f'CheckBalance dialog (3 turns), {latency_ms}ms simulated DynamoDB latency, {iterations} runs')
+    report('sync', measure(sync_handlers.lambda_handler, iterations))
+    report('async', measure(async_handler, iterations))
+
+
+if __name__ == '__main__':
+    main(*[float(arg) for arg in sys.argv[1:2]], *[int(arg) for arg in sys.argv[2:3]])
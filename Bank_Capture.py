@@ -0,0 +1,238 @@
+''' Opt-in capture of live turns for Bank_Replay.py.
+
+A sampled share of sessions has every Lex event and our response written out
+as one compact JSON line. PINs, SSNs, account numbers and the caller's phone
+number are redacted before anything leaves the handler: account numbers,
+SSNs and phone numbers become keyed pseudonyms of the same length (so one
+account stays one account across a dialog), PINs become REDACTED_PIN.
+
+Set BANK_CAPTURE_SAMPLE_RATE (0..1) to turn it on, together with the
+BANK_CAPTURE_KEY the pseudonyms are keyed with. Lines go to stdout
+(CloudWatch Logs, prefixed with CAPTURE_PREFIX) or to BANK_CAPTURE_PATH.
+'''
+
+import os
+import re
+import json
+import time
+import hmac
+import hashlib
+import logging
+import functools
+import threading
+
+from Bank_Digits import WORD_DIGITS, TEENS, TENS, REPEATS, normalize_digits
+from Bank_Session import SESSION_STATE_KEY, pack, unpack
+
+
+#Configure logger
+logger = logging.getLogger()
+
+
+""" --- Capture configuration --- """
+
+#Share of sessions captured, decided per session so a dialog is captured whole. 0 turns capture off
+CAPTURE_SAMPLE_RATE = float(os.environ.get('BANK_CAPTURE_SAMPLE_RATE', '0'))
+
+#'stdout' for CloudWatch Logs, otherwise a file the JSON lines are appended to
+CAPTURE_PATH = os.environ.get('BANK_CAPTURE_PATH', 'stdout')
+
+#Keys the pseudonyms. Keep it stable across containers, a dialog's turns land on different ones
+CAPTURE_KEY = os.environ.get('BANK_CAPTURE_KEY')
+
+#Unkeyed pseudonyms of 12 digit account numbers could be brute-forced, so capture never runs without the key
+if CAPTURE_SAMPLE_RATE > 0 and not CAPTURE_KEY:
+    raise Exception('BANK_CAPTURE_SAMPLE_RATE is set but BANK_CAPTURE_KEY is not')
+
+#Marks capture lines among the other log lines
+CAPTURE_PREFIX = 'BANK_CAPTURE '
+
+#Every captured PIN becomes this, Bank_Replay.py seeds accounts with it
+REDACTED_PIN = '0000'
+
+PIN_SLOTS = ('pin',)
+PSEUDONYM_SLOTS = ('accountNumber', 'SSN')
+
+#Attributes Amazon Connect may use to pass the caller's number (ANI) to the bot
+PHONE_ATTRIBUTES = ('CustomerNumber', 'callerPhoneNumber')
+
+#Free text that may carry digits the caller spoke
+TRANSCRIPT_FIELDS = ('inputTranscript', 'transcription')
+
+_capture_lock = threading.Lock()
+
+
+
+""" --- Redaction --- """
+
+#Two or more spoken digits in a row ("for one two three"), a lone "to" or "for" is just a word
+_SPOKEN_DIGITS = re.compile(
+    r'\b(?:(?:%s)\b[\s,.-]*){2,}' % '|'.join(sorted(set(WORD_DIGITS) | set(TEENS) | set(TENS) | set(REPEATS), key=len, reverse=True)),
+    re.IGNORECASE
+)
+_DIGIT = re.compile(r'[0-9]')
+
+
+def redact_transcript(text):
+    return _DIGIT.sub('#', _SPOKEN_DIGITS.sub('# ', text))
+
+
+def pseudonym(kind, digits):
+    '''Same-length digit string standing in for digits. The same input always gets the same pseudonym'''
+
+    if kind in PIN_SLOTS:
+        return REDACTED_PIN if len(digits) == len(REDACTED_PIN) else '0' * len(digits)
+
+    digest = hmac.new(CAPTURE_KEY.encode('utf-8'), f'{kind}:{digits}'.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    return str(int(digest, 16) % 10 ** len(digits)).zfill(len(digits))
+
+
+def _collect_replacements(value, replacements):
+    '''{raw text: stand-in} for every sensitive slot value and phone attribute found in value'''
+
+    if isinstance(value, list):
+        for element in value:
+            _collect_replacements(element, replacements)
+        return replacements
+
+    if not isinstance(value, dict):
+        return replacements
+
+    for key, field in value.items():
+        if key in PIN_SLOTS + PSEUDONYM_SLOTS and isinstance(field, dict) and isinstance(field.get('value'), dict):
+            slot_value = field['value']
+            raw_values = [slot_value.get('interpretedValue'), slot_value.get('originalValue')] + list(slot_value.get('resolvedValues') or [])
+            for raw in raw_values:
+                if not raw:
+                    continue
+                digits = normalize_digits(raw)
+                replacements[raw] = pseudonym(key, digits) if digits.isdigit() else '[redacted]'
+                if digits.isdigit():
+                    replacements[digits] = pseudonym(key, digits)
+        elif key in PHONE_ATTRIBUTES and isinstance(field, str):
+            digits = re.sub(r'[^0-9]', '', field)
+            if digits:
+                replacements[digits] = pseudonym('phone', digits)
+        else:
+            _collect_replacements(field, replacements)
+
+    return replacements
+
+
+def _substitute(text, replacements):
+    #One pass, longest first, so a PIN can't be replaced inside an account number's pseudonym
+    escaped = {json.dumps(raw)[1:-1]: stand_in for raw, stand_in in replacements.items() if len(raw) >= len(REDACTED_PIN)}
+    if not escaped:
+        return text
+
+    pattern = re.compile('|'.join(re.escape(raw) for raw in sorted(escaped, key=len, reverse=True)))
+
+    return pattern.sub(lambda match: escaped[match.group(0)], text)
+
+
+def _redact_transcripts(value):
+    if isinstance(value, list):
+        return [_redact_transcripts(element) for element in value]
+    if not isinstance(value, dict):
+        return value
+
+    return {
+        key: redact_transcript(field) if key in TRANSCRIPT_FIELDS and isinstance(field, str) else _redact_transcripts(field)
+        for key, field in value.items()
+    }
+
+
+def _session_attributes(message):
+    if not isinstance(message, dict):
+        return {}
+
+    return (message.get('sessionState') or {}).get('sessionAttributes') or {}
+
+
+def redact(record):
+    '''Copy of a capture record with every sensitive value in its event and response replaced'''
+
+    replacements = _collect_replacements(record, {})
+    record = json.loads(json.dumps(record, default=str))
+
+    #The packed session state is compressed, so it is redacted field by field and
+    #kept out of the text substitution (which could hit digits in its base64)
+    packed_states = {}
+    for name in ('event', 'response'):
+        attributes = _session_attributes(record.get(name))
+        if SESSION_STATE_KEY in attributes:
+            fragments = unpack(attributes.pop(SESSION_STATE_KEY))
+            packed_states[name] = pack({field: _substitute(fragment, replacements) for field, fragment in fragments.items()})
+
+    redacted = json.loads(_substitute(json.dumps(record), replacements))
+    for name, packed in packed_states.items():
+        redacted[name]['sessionState']['sessionAttributes'][SESSION_STATE_KEY] = packed
+
+    return _redact_transcripts(redacted)
+
+
+
+""" --- Capture middleware --- """
+
+
+def is_sampled(sessionId):
+    '''Same answer for every turn of a session, in every container'''
+
+    if CAPTURE_SAMPLE_RATE <= 0:
+        return False
+
+    bucket = int(hashlib.sha256(str(sessionId).encode('utf-8')).hexdigest()[:8], 16) / 0xffffffff
+
+    return bucket < CAPTURE_SAMPLE_RATE
+
+
+def write_capture(record):
+    line = json.dumps(redact(record), separators=(',', ':'), default=str)
+
+    with _capture_lock:
+        if CAPTURE_PATH == 'stdout':
+            #Bank_Replay finds the prefix anywhere in the line, so the runtime's log formatting is fine
+            logger.info(CAPTURE_PREFIX + line)
+        else:
+            with open(CAPTURE_PATH, 'a') as capture_file:
+                capture_file.write(line + '\n')
+
+
+def capture_turns(handler):
+    '''Wraps a lambda_handler so sampled sessions' events and responses are captured for replay'''
+
+    handler_name = handler.__module__
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        if not is_sampled(event.get('sessionId')):
+            return handler(event, context)
+
+        #Handlers rewrite slots and session state in place, keep the event as Lex sent it
+        record = {
+            'at': round(time.time(), 3),
+            'handler': handler_name,
+            'remainingMs': context.get_remaining_time_in_millis() if context is not None else None,
+            'event': json.loads(json.dumps(event, default=str))
+        }
+
+        start = time.perf_counter()
+        try:
+            response = handler(event, context)
+        except Exception as err:
+            record['error'] = repr(err)
+            raise err
+        else:
+            record['response'] = response
+        finally:
+            record['durationMs'] = round((time.perf_counter() - start) * 1000, 2)
+            try:
+                write_capture(record)
+            except Exception as err:
+                #Capture is best effort, it never costs the caller their turn
+                logger.info(f'capture failed: {err!r}')
+
+        return response
+
+    return wrapper
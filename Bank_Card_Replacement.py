@@ -0,0 +1,437 @@
+''' Card replacement fulfillment, taken off the Lex request path.
+
+ReplaceCard only writes a job to the BankCardReplacementJobs outbox and
+publishes its id to the job queue in the background. Workers take jobs off the
+queue in batches, order the card from the vendor and email the customer, and
+retry on failure. A lost publish is picked up by the requeue sweep, so the
+Lex reply depends on the outbox write alone.
+
+The queue, email sender and card vendor have in-memory stand-ins (used with
+BANK_STORE=local) next to the SQS, SES and HTTP vendor backends.
+
+Usage: python Bank_Card_Replacement.py [--requeue-after SECONDS] [--max-batches N]
+'''
+
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import logging
+import argparse
+import threading
+import urllib.request
+from decimal import Decimal
+
+import Bank_Store
+from Bank_Cards import card_for_token
+from Bank_Store import get_table, submit_io, run_concurrently, expires_at
+
+
+#Configure logger
+logger = logging.getLogger()
+
+
+""" --- Replacement configuration --- """
+
+#One row per replacement job (JobId), Status PENDING -> DONE or FAILED
+outbox_tbl_name = 'BankCardReplacementJobs'
+
+#SQS queue carrying job ids to the workers
+REPLACEMENT_QUEUE_URL = os.environ.get('BANK_REPLACEMENT_QUEUE_URL', '')
+
+#Verified SES sender address for the new-card email
+EMAIL_SOURCE = os.environ.get('BANK_EMAIL_SOURCE', 'no-reply@example.com')
+
+#Card vendor order endpoint
+CARD_VENDOR_URL = os.environ.get('BANK_CARD_VENDOR_URL', '')
+
+#Jobs taken off the queue at once (SQS allows at most 10)
+REPLACEMENT_BATCH_SIZE = 10
+
+#After this many failed attempts a job is parked as FAILED for someone to look at
+REPLACEMENT_MAX_ATTEMPTS = int(os.environ.get('BANK_REPLACEMENT_MAX_ATTEMPTS', '5'))
+
+#Seconds before a released job is handed out again by the local queue, doubled on every release of the same job
+REPLACEMENT_RETRY_DELAY = float(os.environ.get('BANK_REPLACEMENT_RETRY_DELAY', '2'))
+REPLACEMENT_MAX_RETRY_DELAY = 60.0
+
+#Seconds a DONE job is kept before TTL deletes it, so the requeue sweep's scan stays small. FAILED jobs are kept
+REPLACEMENT_DONE_RETENTION = int(os.environ.get('BANK_REPLACEMENT_DONE_RETENTION', str(7 * 24 * 3600)))
+
+
+
+""" --- Queue, email and vendor backends --- """
+
+
+class LocalJobQueue(object):
+    '''In-memory stand-in for the SQS job queue. A released job comes back after a growing delay,
+    the way an SQS message reappears after its visibility timeout'''
+
+    def __init__(self, retry_delay=None):
+        self.jobs = queue.Queue()
+        self.retry_delay = REPLACEMENT_RETRY_DELAY if retry_delay is None else retry_delay
+        self.releases = {}
+        self.lock = threading.Lock()
+
+
+    def send(self, jobIds):
+        for jobId in jobIds:
+            self.jobs.put(jobId)
+
+
+    def receive(self, max_jobs=REPLACEMENT_BATCH_SIZE, wait=0.0):
+        '''Returns [(jobId, receipt)]. A job must be acknowledged or it is handed out again'''
+
+        received = []
+        try:
+            received.append(self.jobs.get(timeout=wait) if wait else self.jobs.get_nowait())
+            while len(received) < max_jobs:
+                received.append(self.jobs.get_nowait())
+        except queue.Empty:
+            pass
+
+        return [(jobId, jobId) for jobId in received]
+
+
+    def acknowledge(self, receipts):
+        pass
+
+
+    def release(self, receipts):
+        for jobId in receipts:
+            with self.lock:
+                self.releases[jobId] = self.releases.get(jobId, 0) + 1
+                delay = min(REPLACEMENT_MAX_RETRY_DELAY, self.retry_delay * 2 ** (self.releases[jobId] - 1))
+
+            timer = threading.Timer(delay, self.send, [[jobId]])
+            timer.daemon = True
+            timer.start()
+
+
+
+class SqsJobQueue(object):
+
+    def __init__(self, queue_url):
+        import boto3
+
+        self.queue_url = queue_url
+        self.client = boto3.client('sqs')
+
+
+    def send(self, jobIds):
+        jobIds = list(jobIds)
+        for start in range(0, len(jobIds), REPLACEMENT_BATCH_SIZE):
+            self.client.send_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{'Id': str(index), 'MessageBody': jobId} for index, jobId in enumerate(jobIds[start:start + REPLACEMENT_BATCH_SIZE])]
+            )
+
+
+    def receive(self, max_jobs=REPLACEMENT_BATCH_SIZE, wait=0.0):
+        response = self.client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=min(max_jobs, REPLACEMENT_BATCH_SIZE),
+            WaitTimeSeconds=int(wait)
+        )
+
+        return [(message['Body'], message['ReceiptHandle']) for message in response.get('Messages', [])]
+
+
+    def acknowledge(self, receipts):
+        receipts = list(receipts)
+        for start in range(0, len(receipts), REPLACEMENT_BATCH_SIZE):
+            self.client.delete_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{'Id': str(index), 'ReceiptHandle': receipt} for index, receipt in enumerate(receipts[start:start + REPLACEMENT_BATCH_SIZE])]
+            )
+
+
+    def release(self, receipts):
+        #Left undeleted, SQS hands the message out again after its visibility timeout
+        pass
+
+
+
+class LocalEmailSender(object):
+    '''Records emails instead of sending them. fail_next makes the next sends raise, to exercise retries'''
+
+    def __init__(self, fail_next=0):
+        self.sent = []
+        self.fail_next = fail_next
+
+
+    def send(self, to_address, subject, body):
+        if self.fail_next:
+            self.fail_next -= 1
+            raise Exception('Email sender unavailable')
+
+        self.sent.append({'to': to_address, 'subject': subject, 'body': body})
+
+
+
+class SesEmailSender(object):
+
+    def __init__(self, source=EMAIL_SOURCE):
+        import boto3
+
+        self.source = source
+        self.client = boto3.client('ses')
+
+
+    def send(self, to_address, subject, body):
+        self.client.send_email(
+            Source=self.source,
+            Destination={'ToAddresses': [to_address]},
+            Message={'Subject': {'Data': subject}, 'Body': {'Text': {'Data': body}}}
+        )
+
+
+
+class LocalCardVendor(object):
+    '''Records card orders instead of placing them. fail_next makes the next orders raise'''
+
+    def __init__(self, fail_next=0):
+        self.orders = []
+        self.fail_next = fail_next
+
+
+    def mail_card(self, orderId, cardNumber, name, street_address):
+        if self.fail_next:
+            self.fail_next -= 1
+            raise Exception('Card vendor unavailable')
+
+        #The vendor dedupes on orderId, so a retried order is not mailed twice
+        if all(order['orderId'] != orderId for order in self.orders):
+            self.orders.append({'orderId': orderId, 'cardNumber': cardNumber, 'name': name, 'address': street_address})
+
+
+
+class HttpCardVendor(object):
+
+    def __init__(self, url=CARD_VENDOR_URL, timeout=5.0):
+        self.url = url
+        self.timeout = timeout
+
+
+    def mail_card(self, orderId, cardNumber, name, street_address):
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps({'orderId': orderId, 'cardNumber': cardNumber, 'name': name, 'address': street_address}).encode('utf-8'),
+            headers={'Content-Type': 'application/json', 'Idempotency-Key': orderId},
+            method='POST'
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+
+_services = None
+_services_lock = threading.Lock()
+
+
+def get_services():
+    '''(job queue, email sender, card vendor) for this container'''
+
+    global _services
+
+    with _services_lock:
+        if _services is None:
+            if Bank_Store.STORE_BACKEND == 'local':
+                _services = (LocalJobQueue(), LocalEmailSender(), LocalCardVendor())
+            else:
+                _services = (SqsJobQueue(REPLACEMENT_QUEUE_URL), SesEmailSender(), HttpCardVendor())
+
+    return _services
+
+
+def set_services(job_queue, email_sender, card_vendor):
+    '''Swaps the backends, e.g. for stand-ins with failures injected. Returns the previous ones'''
+
+    global _services
+
+    with _services_lock:
+        previous = _services
+        _services = (job_queue, email_sender, card_vendor)
+
+    return previous
+
+
+
+""" --- Recording jobs (Lex side) --- """
+
+
+def replacement_job(accountNumber, cardToken, cardNumber, firstName, email_address, street_address):
+    '''The outbox row. It keeps the card's token and last four digits, the worker turns the token back into the number'''
+
+    return {
+        'JobId': uuid.uuid4().hex,
+        'Status': 'PENDING',
+        'AccountNumber': Decimal(accountNumber),
+        'CardToken': cardToken,
+        'CardLastFour': cardNumber[-4:],
+        'FirstName': firstName or '',
+        'EmailAddress': email_address,
+        'StreetAddress': street_address,
+        'Attempts': Decimal('0'),
+        'CreatedAt': Decimal(int(time.time()))
+    }
+
+
+def publish_jobs(jobIds):
+    '''Hands job ids to the queue on the background executor. Nothing waits on it'''
+
+    def send():
+        try:
+            get_services()[0].send(jobIds)
+        except Exception as err:
+            logger.info(f'publishing replacement jobs {jobIds} failed, the requeue sweep will pick them up: {err!r}')
+
+    return submit_io(send)
+
+
+def record_card_replacement(accountNumber, cardToken, cardNumber, firstName, email_address, street_address):
+    '''The only write on the Lex path: the job row. Returns the job'''
+
+    job = replacement_job(accountNumber, cardToken, cardNumber, firstName, email_address, street_address)
+    get_table(outbox_tbl_name).put_item(Item=job)
+
+    publish_jobs([job['JobId']])
+
+    return job
+
+
+
+""" --- Worker --- """
+
+
+def _mark_job(jobId, update_expression, values):
+    params = {'Key': {'JobId': jobId}, 'UpdateExpression': update_expression, 'ExpressionAttributeValues': values}
+
+    #DynamoDB rejects attribute names the expression does not use
+    if '#status' in update_expression:
+        params['ExpressionAttributeNames'] = {'#status': 'Status'}
+
+    get_table(outbox_tbl_name).update_item(**params)
+
+
+def process_job(jobId):
+    '''Orders the card and sends the email for one job. True once the job needs no more work.
+
+    Safe to run more than once: each finished step is recorded on the job,
+    and the vendor order is keyed by JobId.
+    '''
+
+    services = get_services()
+
+    job = get_table(outbox_tbl_name).get_item(Key={'JobId': jobId}, ConsistentRead=True).get('Item')
+    if job is None or job['Status'] != 'PENDING':
+        return True
+
+    try:
+        if not job.get('CardOrdered'):
+            services[2].mail_card(jobId, card_for_token(job['CardToken']), job['FirstName'], job['StreetAddress'])
+            _mark_job(jobId, 'SET CardOrdered = :true', {':true': True})
+
+        if not job.get('EmailSent'):
+            services[1].send(
+                job['EmailAddress'],
+                'Your new Example Bank debit card',
+                'Your new debit card ending in {} has been mailed to {}. Please expect it within five to seven business days.'.format(
+                    job['CardLastFour'], job['StreetAddress']
+                )
+            )
+            _mark_job(jobId, 'SET EmailSent = :true', {':true': True})
+
+        _mark_job(jobId, 'SET #status = :done, ExpiresAt = :expires', {':done': 'DONE', ':expires': expires_at(REPLACEMENT_DONE_RETENTION)})
+
+        return True
+    except Exception as err:
+        attempts = job['Attempts'] + 1
+        status = 'FAILED' if attempts >= REPLACEMENT_MAX_ATTEMPTS else 'PENDING'
+        logger.info(f'replacement job {jobId} attempt {attempts} failed: {err!r}')
+
+        _mark_job(jobId, 'SET #status = :status, Attempts = :attempts, LastError = :error', {
+            ':status': status, ':attempts': attempts, ':error': repr(err)
+        })
+
+        return status == 'FAILED'
+
+
+def process_batch(jobIds):
+    '''Processes a batch side by side and returns the ids that should be retried'''
+
+    finished = run_concurrently(*[(lambda jobId=jobId: process_job(jobId)) for jobId in jobIds])
+
+    return [jobId for jobId, done in zip(jobIds, finished) if not done]
+
+
+def worker_handler(event, context):
+    '''SQS-triggered worker Lambda. Reports only the failed jobs back, so the rest of the batch is not redelivered'''
+
+    records = event.get('Records', [])
+    retry = set(process_batch([record['body'] for record in records]))
+
+    return {'batchItemFailures': [{'itemIdentifier': record['messageId']} for record in records if record['body'] in retry]}
+
+
+def run_worker(max_batches=None, wait=0.0):
+    '''Polls the queue and works through it until it is empty (or max_batches). Returns jobs processed'''
+
+    job_queue = get_services()[0]
+    processed = batches = 0
+
+    while max_batches is None or batches < max_batches:
+        received = job_queue.receive(REPLACEMENT_BATCH_SIZE, wait)
+        if not received:
+            return processed
+
+        retry = set(process_batch([jobId for jobId, receipt in received]))
+        job_queue.acknowledge([receipt for jobId, receipt in received if jobId not in retry])
+        job_queue.release([receipt for jobId, receipt in received if jobId in retry])
+
+        processed += len(received)
+        batches += 1
+
+    return processed
+
+
+def requeue_stale_jobs(older_than=300):
+    '''Publishes PENDING jobs older than older_than seconds again, covering publishes that never made it'''
+
+    from boto3.dynamodb.conditions import Attr
+
+    scan_params = {
+        'FilterExpression': Attr('Status').eq('PENDING') & Attr('CreatedAt').lt(Decimal(int(time.time()) - older_than)),
+        'ProjectionExpression': 'JobId'
+    }
+    jobIds = []
+
+    while True:
+        response = get_table(outbox_tbl_name).scan(**scan_params)
+        jobIds.extend(item['JobId'] for item in response['Items'])
+
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    if jobIds:
+        get_services()[0].send(jobIds)
+
+    return jobIds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Requeue stale card replacement jobs and work through the queue')
+    parser.add_argument('--requeue-after', type=int, default=300, help='republish PENDING jobs older than this many seconds')
+    parser.add_argument('--max-batches', type=int, default=None, help='stop after this many batches')
+    args = parser.parse_args(argv)
+
+    requeued = requeue_stale_jobs(args.requeue_after)
+    processed = run_worker(args.max_batches)
+    print(f'jobs requeued={len(requeued)}, jobs processed={processed}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
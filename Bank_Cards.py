@@ -0,0 +1,232 @@
+''' Pool of pre-generated, Luhn-valid debit card numbers for ReplaceCard.
+
+Card numbers are generated offline in blocks (one BankCardPool row per block).
+A Lambda container claims a whole block with one atomic counter update and
+issues numbers from memory, so a new card costs no per-card uniqueness check.
+Numbers are BIN + a keyed permutation of the card's sequence number + Luhn
+check digit, so every generated number is unique by construction. Block rows
+only hold their sequence range: the numbers are computed when the block is
+claimed, so the table never holds a card number.
+
+Usage: python Bank_Cards.py --blocks N
+'''
+
+import os
+import sys
+import hmac
+import hashlib
+import logging
+import argparse
+import threading
+from collections import deque
+from decimal import Decimal
+
+from botocore.exceptions import ClientError
+
+from Bank_Store import get_table
+
+
+#Configure logger
+logger = logging.getLogger()
+
+
+""" --- Card pool configuration --- """
+
+#One row per block of card numbers (PoolKey = BLOCK#n, FirstSequence/Cards = its sequence range) plus the counter row (PoolKey = COUNTER):
+#Generated = blocks written, NextBlock = last block claimed, Available = written but unclaimed
+card_pool_tbl_name = 'BankCardPool'
+
+#Issuer identification number every card starts with
+CARD_BIN = os.environ.get('BANK_CARD_BIN', '400000')
+
+#Keys the permutation so consecutive cards don't get consecutive numbers
+CARD_POOL_KEY = os.environ.get('BANK_CARD_POOL_KEY')
+
+#Without the key card numbers (and the tokens stored for them) would be guessable, so refuse to start
+if not CARD_POOL_KEY:
+    raise Exception('BANK_CARD_POOL_KEY is not set')
+
+#Cards per block. Changing it reuses sequence numbers, so it is fixed for the life of the pool
+CARD_BLOCK_SIZE = 100
+
+COUNTER_KEY = 'COUNTER'
+
+#Digits between the BIN and the check digit: 16 = 6 + 9 + 1
+ACCOUNT_DIGITS = 9
+
+_FEISTEL_HALF = 31623
+_FEISTEL_ROUNDS = 4
+
+
+
+""" --- Card numbers --- """
+
+
+def luhn_check_digit(digits):
+    total = 0
+    for position, digit in enumerate(reversed(digits)):
+        value = int(digit)
+        #Counting from the right with the check digit still to come, every other digit starts doubled
+        if position % 2 == 0:
+            value *= 2
+            if value > 9:
+                value -= 9
+        total += value
+
+    return str((10 - total % 10) % 10)
+
+
+def isValid_CardNumber(cardNumber):
+    cardNumber = str(cardNumber)
+
+    return cardNumber.isdigit() and len(cardNumber) == 16 and luhn_check_digit(cardNumber[:-1]) == cardNumber[-1]
+
+
+def _round_value(round_number, half):
+    digest = hmac.new(CARD_POOL_KEY.encode('utf-8'), f'{round_number}:{half}'.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    return int(digest[:8], 16) % _FEISTEL_HALF
+
+
+def _permute(sequence):
+    '''Keyed one-to-one shuffle of 0 .. 10**ACCOUNT_DIGITS - 1 (Feistel rounds, cycle walking back into range)'''
+
+    limit = 10 ** ACCOUNT_DIGITS
+    if not 0 <= sequence < limit:
+        raise Exception(f'Card sequence {sequence} is outside the pool')
+
+    value = sequence
+    while True:
+        left, right = divmod(value, _FEISTEL_HALF)
+        for round_number in range(_FEISTEL_ROUNDS):
+            left, right = right, (left + _round_value(round_number, right)) % _FEISTEL_HALF
+        value = left * _FEISTEL_HALF + right
+
+        if value < limit:
+            return value
+
+
+def card_number(sequence):
+    body = '{}{:0{}d}'.format(CARD_BIN, _permute(sequence), ACCOUNT_DIGITS)
+
+    return body + luhn_check_digit(body)
+
+
+def card_for_token(cardToken):
+    '''The card number a token stands for. Only holders of CARD_POOL_KEY can turn one back'''
+
+    return card_number(int(cardToken))
+
+
+
+""" --- Offline pool generation --- """
+
+
+def generate_pool(blocks):
+    '''Appends blocks to the end of the pool and returns their block numbers.
+
+    Block numbers are reserved on the counter row first and only made
+    claimable once every block is written. Run one generation at a time:
+    claims take the next block number, not a particular run's blocks.
+    '''
+
+    table = get_table(card_pool_tbl_name)
+
+    response = table.update_item(
+        Key={'PoolKey': COUNTER_KEY},
+        UpdateExpression='ADD Generated :blocks',
+        ExpressionAttributeValues={':blocks': Decimal(blocks)},
+        ReturnValues='UPDATED_NEW'
+    )
+    last_block = int(response['Attributes']['Generated'])
+    block_numbers = range(last_block - blocks + 1, last_block + 1)
+
+    with table.batch_writer() as batch:
+        for block in block_numbers:
+            start = (block - 1) * CARD_BLOCK_SIZE
+            batch.put_item(Item={
+                'PoolKey': f'BLOCK#{block}',
+                'FirstSequence': Decimal(start),
+                'Cards': Decimal(CARD_BLOCK_SIZE)
+            })
+
+    table.update_item(
+        Key={'PoolKey': COUNTER_KEY},
+        UpdateExpression='ADD Available :blocks',
+        ExpressionAttributeValues={':blocks': Decimal(blocks)}
+    )
+
+    return block_numbers
+
+
+
+""" --- Issuing --- """
+
+
+class CardPoolExhausted(Exception):
+    '''Raised when every generated block has been claimed. Run generate_pool (--blocks N) to add more'''
+
+
+
+_claimed_cards = deque()
+_claim_lock = threading.Lock()
+
+
+def claim_block():
+    '''Claims the next unissued block for this container and returns its (sequence, card number) pairs'''
+
+    from boto3.dynamodb.conditions import Attr
+
+    table = get_table(card_pool_tbl_name)
+
+    try:
+        response = table.update_item(
+            Key={'PoolKey': COUNTER_KEY},
+            UpdateExpression='ADD NextBlock :one, Available :minus_one',
+            ConditionExpression=Attr('Available').gt(0),
+            ExpressionAttributeValues={':one': Decimal('1'), ':minus_one': Decimal('-1')},
+            ReturnValues='UPDATED_NEW'
+        )
+    except ClientError as err:
+        if err.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            raise CardPoolExhausted('Card pool exhausted, generate more blocks')
+        raise err
+    block = int(response['Attributes']['NextBlock'])
+
+    item = table.get_item(Key={'PoolKey': f'BLOCK#{block}'}, ConsistentRead=True).get('Item')
+
+    logger.info(f'claimed card block {block}')
+
+    start = int(item['FirstSequence'])
+
+    return [(sequence, card_number(sequence)) for sequence in range(start, start + int(item['Cards']))]
+
+
+def issue_card():
+    '''(card token, card number) for the next card from this container's claimed block, claiming another
+    block when it runs out. The token (the card's sequence number) is what gets stored, never the number'''
+
+    with _claim_lock:
+        if not _claimed_cards:
+            _claimed_cards.extend(claim_block())
+
+        sequence, cardNumber = _claimed_cards.popleft()
+
+    return str(sequence), cardNumber
+
+
+def issue_card_number():
+    return issue_card()[1]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate blocks of Luhn-valid card numbers')
+    parser.add_argument('--blocks', type=int, required=True, help='number of blocks to append to the pool')
+    args = parser.parse_args(argv)
+
+    block_numbers = generate_pool(args.blocks)
+    print(f'blocks written={block_numbers.start}..{block_numbers.stop - 1}, card numbers={len(block_numbers) * CARD_BLOCK_SIZE}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,140 @@
+import re
+import logging
+
+
+#Configure logger
+logger = logging.getLogger()
+
+
+""" --- Digit normalization tables --- """
+
+#Spoken digits, including the usual recognizer homophones
+WORD_DIGITS = {
+    'zero': '0', 'oh': '0', 'o': '0',
+    'one': '1', 'won': '1',
+    'two': '2', 'to': '2', 'too': '2',
+    'three': '3',
+    'four': '4', 'for': '4',
+    'five': '5',
+    'six': '6',
+    'seven': '7',
+    'eight': '8', 'ate': '8',
+    'nine': '9', 'niner': '9',
+}
+
+TEENS = {
+    'ten': '10', 'eleven': '11', 'twelve': '12', 'thirteen': '13', 'fourteen': '14',
+    'fifteen': '15', 'sixteen': '16', 'seventeen': '17', 'eighteen': '18', 'nineteen': '19',
+}
+
+TENS = {
+    'twenty': '2', 'thirty': '3', 'forty': '4', 'fifty': '5',
+    'sixty': '6', 'seventy': '7', 'eighty': '8', 'ninety': '9',
+}
+
+#"double three" -> 33
+REPEATS = {'double': 2, 'triple': 3}
+
+#Words callers say between digits that carry no digits
+FILLER_WORDS = {'dash', 'hyphen', 'space', 'and', 'uh', 'um', 'er', 'my', 'is', 'its', 'it', 'pin', 'number', 'account'}
+
+#Separators people type or recognizers insert between digit groups
+_SEPARATORS = str.maketrans('', '', ' -.,()/_')
+
+#Keypad input: '#' ends entry, '*' is usually a mis-press
+_DTMF_SEPARATORS = str.maketrans('', '', ' #*')
+
+_TOKENS = re.compile(r"[a-z]+|[0-9]+")
+
+
+
+""" --- Normalization --- """
+
+
+def spoken_to_digits(text):
+    '''Digit string for a spoken/typed phrase like "four five double six", None if any word is not a digit'''
+
+    tokens = _TOKENS.findall(text.lower().replace("'", ''))
+    digits = []
+    repeat = 1
+    index = 0
+
+    while index < len(tokens):
+        token = tokens[index]
+        index += 1
+
+        if token in FILLER_WORDS:
+            continue
+        if token in REPEATS:
+            repeat = REPEATS[token]
+            continue
+
+        if token.isdigit():
+            value = token
+        elif token in WORD_DIGITS:
+            value = WORD_DIGITS[token]
+        elif token in TEENS:
+            value = TEENS[token]
+        elif token in TENS:
+            #"forty two" -> 42, a lone "forty" -> 40
+            if index < len(tokens) and tokens[index] in WORD_DIGITS and WORD_DIGITS[tokens[index]] != '0':
+                value = TENS[token] + WORD_DIGITS[tokens[index]]
+                index += 1
+            else:
+                value = TENS[token] + '0'
+        else:
+            return None
+
+        #A repeat applies to the next digit only: "double 34" -> 334
+        digits.append(value[0] * repeat + value[1:])
+        repeat = 1
+
+    return ''.join(digits) or None
+
+
+def normalize_digits(value, input_mode=None):
+    '''Canonical digit string for DTMF, spoken or typed digit input. Anything that isn't digits comes back unchanged'''
+
+    if value is None:
+        return None
+
+    text = str(value).strip()
+
+    if input_mode == 'DTMF':
+        keyed = text.translate(_DTMF_SEPARATORS)
+        if keyed.isdigit():
+            return keyed
+
+    #Fast path: digits with separators, the common typed and recognized shape
+    compact = text.translate(_SEPARATORS)
+    if compact.isdigit() and compact.isascii():
+        return compact
+
+    digits = spoken_to_digits(text)
+
+    return digits if digits is not None else value
+
+
+def normalize_digit_slots(intent_request, slot_names):
+    '''Rewrites the named slots' interpretedValue to canonical digits before validation runs.
+
+    The rewritten slots go back to Lex with the response, so later turns see the clean value too.
+    '''
+
+    slots = intent_request['sessionState']['intent'].get('slots') or {}
+    input_mode = intent_request.get('inputMode')
+
+    for slot_name in slot_names:
+        slot = slots.get(slot_name)
+        if not slot or not slot.get('value'):
+            continue
+
+        value = slot['value']
+        raw = value.get('interpretedValue') or value.get('originalValue')
+        normalized = normalize_digits(raw, input_mode)
+
+        if normalized is not None and normalized.isdigit() and normalized != value.get('interpretedValue'):
+            logger.info(f'normalized slot {slot_name} from {input_mode} input')
+            value['interpretedValue'] = normalized
+
+    return slots
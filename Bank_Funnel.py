@@ -0,0 +1,194 @@
+''' Conversation funnel metrics: turns, re-prompts, hang-ups and intent transitions.
+
+Every Lambda invocation is one dialog turn, so the turns a call takes are
+its cost. Each turn is counted in session state; when an intent closes the
+counts since the previous close are written out as one JSON line and reset.
+A shorter line is written every turn, so a call that hangs up (and never
+reaches a close) still shows the turn and prompt it was lost at.
+
+Usage (offline aggregation of exported log lines): python Bank_Funnel.py LOG_FILE [LOG_FILE ...]
+'''
+
+import os
+import sys
+import json
+import logging
+import argparse
+
+from Bank_Session import get_session_state
+from Bank_Responses import REASON_FIELD
+
+
+#Configure logger
+logger = logging.getLogger()
+
+
+""" --- Funnel configuration --- """
+
+#Session state field holding the counts
+FUNNEL_KEY = 'funnel'
+
+#Marks funnel lines among the other log lines
+FUNNEL_PREFIX = 'BANK_FUNNEL '
+
+#The per-turn line is what shows where callers hang up, '0' keeps only the close summaries
+FUNNEL_LOG_TURNS = os.environ.get('BANK_FUNNEL_LOG_TURNS', '1') == '1'
+
+
+
+""" --- Recording --- """
+
+
+def filled_slots(intent_request):
+    '''Names of the slots the caller has answered, taken before validators clear the rejected ones'''
+
+    slots = intent_request['sessionState']['intent'].get('slots') or {}
+
+    return [name for name, slot in slots.items() if slot and slot.get('value')]
+
+
+def violation_reason(response):
+    #The catalog key, never the rendered message: that can echo the caller's name or account number
+    return response.pop(REASON_FIELD, None) or 'unknown'
+
+
+def emit(record):
+    #read_records finds the prefix anywhere in the line, so the runtime's log formatting is fine
+    logger.info(FUNNEL_PREFIX + json.dumps(record, separators=(',', ':')))
+
+
+def record_turn(intent_request, response, filled):
+    '''Counts this turn in the session's funnel and emits the summary when the intent closes'''
+
+    intent_name = intent_request['sessionState']['intent']['name']
+    dialog_action = (response.get('sessionState') or {}).get('dialogAction') or {}
+    reason = violation_reason(response)
+
+    session_state = get_session_state(intent_request)
+    funnel = session_state.setdefault(FUNNEL_KEY, {'turn': 0, 'intent': None, 'turns': {}, 'reprompts': {}, 'transitions': {}})
+
+    funnel['turn'] += 1
+    funnel['turns'][intent_name] = funnel['turns'].get(intent_name, 0) + 1
+
+    if funnel['intent'] is not None and funnel['intent'] != intent_name:
+        transition = f"{funnel['intent']}>{intent_name}"
+        funnel['transitions'][transition] = funnel['transitions'].get(transition, 0) + 1
+    funnel['intent'] = intent_name
+
+    slot_to_elicit = dialog_action.get('slotToElicit')
+    reprompt = None
+
+    #Asked again for a slot the caller just answered: a validator turned the answer down
+    if dialog_action.get('type') == 'ElicitSlot' and slot_to_elicit in filled:
+        reprompt = f'{intent_name}/{slot_to_elicit}/{reason}'
+        funnel['reprompts'][reprompt] = funnel['reprompts'].get(reprompt, 0) + 1
+
+    if FUNNEL_LOG_TURNS:
+        emit({
+            'kind': 'turn',
+            'sessionId': intent_request.get('sessionId'),
+            'turn': funnel['turn'],
+            'intent': intent_name,
+            'action': dialog_action.get('type'),
+            'slot': slot_to_elicit,
+            'reprompt': reprompt
+        })
+
+    if dialog_action.get('type') == 'Close':
+        emit({
+            'kind': 'close',
+            'sessionId': intent_request.get('sessionId'),
+            'turn': funnel['turn'],
+            'intent': intent_name,
+            'outcome': ((response.get('sessionState') or {}).get('intent') or {}).get('state'),
+            'turns': funnel['turns'],
+            'reprompts': funnel['reprompts'],
+            'transitions': funnel['transitions']
+        })
+        #The next summary only covers what happens after this close
+        funnel.update(turns={}, reprompts={}, transitions={})
+
+    session_state.touch(FUNNEL_KEY)
+
+
+def run_tracked(intent_request, dispatch):
+    '''dispatch(intent_request), with the turn recorded in the funnel'''
+
+    filled = filled_slots(intent_request)
+    response = dispatch(intent_request)
+
+    try:
+        record_turn(intent_request, response, filled)
+    except Exception as err:
+        #Metrics never cost the caller their turn
+        logger.info(f'funnel metrics skipped: {err!r}')
+
+    return response
+
+
+
+""" --- Offline aggregation --- """
+
+
+def read_records(paths):
+    for path in paths:
+        with open(path) as log_file:
+            for line in log_file:
+                if FUNNEL_PREFIX in line:
+                    yield json.loads(line.split(FUNNEL_PREFIX, 1)[1])
+
+
+def _add(totals, counts):
+    for name, count in counts.items():
+        totals[name] = totals.get(name, 0) + count
+
+
+def aggregate(records):
+    '''Totals across calls, plus where the calls that never closed their last intent were lost'''
+
+    turns, reprompts, transitions, outcomes = {}, {}, {}, {}
+    closed_turns, closed_reprompts, turn_lines = {}, {}, False
+    last_turn = {}
+
+    for record in records:
+        if record['kind'] == 'close':
+            _add(closed_turns, record['turns'])
+            _add(closed_reprompts, record['reprompts'])
+            _add(transitions, record['transitions'])
+            _add(outcomes, {f"{record['intent']}/{record['outcome']}": 1})
+        else:
+            #Turn lines also cover the turns and re-prompts of calls that hung up before a close
+            turn_lines = True
+            _add(turns, {record['intent']: 1})
+            if record.get('reprompt'):
+                _add(reprompts, {record['reprompt']: 1})
+        last_turn[record['sessionId']] = record
+
+    if not turn_lines:
+        turns, reprompts = closed_turns, closed_reprompts
+
+    hangups = {}
+    for record in last_turn.values():
+        if record['kind'] == 'turn' and record['action'] != 'Close':
+            _add(hangups, {f"{record['intent']}/{record['slot'] or record['action']}/turn {record['turn']}": 1})
+
+    return {'turns': turns, 'reprompts': reprompts, 'transitions': transitions, 'outcomes': outcomes, 'hangups': hangups}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Aggregate funnel metrics from exported Lambda log lines')
+    parser.add_argument('log_files', nargs='+', help='files of log lines carrying ' + FUNNEL_PREFIX.strip())
+    parser.add_argument('--top', type=int, default=10, help='rows to print per table')
+    args = parser.parse_args(argv)
+
+    totals = aggregate(read_records(args.log_files))
+
+    for title, name in [('Turns per intent', 'turns'), ('Re-prompts (intent/slot/reason)', 'reprompts'),
+                        ('Hang-ups (intent/prompt/turn)', 'hangups'), ('Intent transitions', 'transitions'), ('Outcomes', 'outcomes')]:
+        print(f'\n{title}')
+        for key, count in sorted(totals[name].items(), key=lambda entry: -entry[1])[:args.top]:
+            print(f'{count:>8}  {key}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,212 @@
+import re
+import logging
+
+
+#Configure logger
+logger = logging.getLogger()
+
+
+""" --- Fuzzy matcher --- """
+
+#Only letters and digits take part in matching: "Check-in" and "check in" both become "checkin"
+_NOT_ALPHANUMERIC = re.compile(r'[^a-z0-9]+')
+
+
+def normalize_choice(text):
+    return _NOT_ALPHANUMERIC.sub('', str(text).lower())
+
+
+def _deletes(word, distance):
+    '''word with up to distance characters deleted, every combination'''
+
+    found = {word}
+    frontier = {word}
+
+    for _ in range(distance):
+        frontier = {candidate[:index] + candidate[index + 1:] for candidate in frontier for index in range(len(candidate))}
+        found |= frontier
+
+    return found
+
+
+_LETTERS = 'abcdefghijklmnopqrstuvwxyz0123456789'
+
+
+def _edits1(word):
+    '''Every string one deletion, transposition, substitution or insertion away from word'''
+
+    splits = [(word[:index], word[index:]) for index in range(len(word) + 1)]
+
+    deletes = [left + right[1:] for left, right in splits if right]
+    transposes = [left + right[1] + right[0] + right[2:] for left, right in splits if len(right) > 1]
+    replaces = [left + letter + right[1:] for left, right in splits if right for letter in _LETTERS]
+    inserts = [left + letter + right for left, right in splits for letter in _LETTERS]
+
+    return set(deletes + transposes + replaces + inserts)
+
+
+def edit_distance(a, b, limit):
+    '''Damerau-Levenshtein (optimal string alignment) distance, or limit + 1 once it is known to exceed limit'''
+
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+
+    previous_previous = None
+    previous = list(range(len(b) + 1))
+
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous_previous, previous = previous, current
+
+    return previous[-1]
+
+
+class FuzzyMatcher(object):
+    '''Resolves near-miss answers ("savins", "check in") to a canonical choice.
+
+    Built once from {canonical: [synonyms]}. Every string one edit away from a
+    synonym is precomputed, so the usual single slip is one dict lookup. For
+    two edits, each synonym's deletion variants are precomputed too: a lookup
+    only generates the answer's own deletions and checks the few synonyms they
+    hit, instead of comparing against the whole vocabulary.
+    '''
+
+    def __init__(self, vocabulary, min_length=3, cache_size=1024):
+        self.min_length = min_length
+        self.cache_size = cache_size
+        self.terms = {}
+        self.neighbours = {}
+        self.variants = {}
+        self.cache = {}
+
+        for canonical, synonyms in vocabulary.items():
+            for synonym in [canonical] + list(synonyms):
+                term = normalize_choice(synonym)
+                self.terms[term] = canonical
+                if self.allowed_distance(term) >= 1:
+                    for neighbour in _edits1(term):
+                        self.neighbours.setdefault(neighbour, set()).add(canonical)
+                for variant in _deletes(term, self.allowed_distance(term)):
+                    self.variants.setdefault(variant, set()).add(term)
+
+        self.max_distance = max(self.allowed_distance(term) for term in self.terms)
+
+
+    @staticmethod
+    def allowed_distance(term):
+        #One typo in a short word already makes it a different word
+        if len(term) <= 4:
+            return 0
+        if len(term) <= 6:
+            return 1
+
+        return 2
+
+
+    def match(self, text):
+        '''Canonical choice for text, or None if nothing is close enough or two choices are equally close'''
+
+        if text is None:
+            return None
+
+        key = normalize_choice(text)
+        if key in self.terms:
+            return self.terms[key]
+        if len(key) < self.min_length:
+            return None
+
+        neighbours = self.neighbours.get(key)
+        if neighbours is not None:
+            #Equally close to two different choices: ask again rather than guess
+            return next(iter(neighbours)) if len(neighbours) == 1 else None
+
+        if key in self.cache:
+            return self.cache[key]
+
+        candidates = set()
+        for variant in _deletes(key, self.max_distance):
+            candidates.update(self.variants.get(variant, ()))
+
+        best_distance = None
+        best = set()
+
+        for term in candidates:
+            limit = self.allowed_distance(term)
+            distance = edit_distance(key, term, limit)
+            if distance > limit:
+                continue
+            if best_distance is None or distance < best_distance:
+                best_distance, best = distance, {self.terms[term]}
+            elif distance == best_distance:
+                best.add(self.terms[term])
+
+        choice = best.pop() if len(best) == 1 else None
+
+        #Callers mishear the same way over and over, remember the answer
+        if len(self.cache) < self.cache_size:
+            self.cache[key] = choice
+
+        return choice
+
+
+    def is_valid(self, text):
+        return self.match(text) is not None
+
+
+
+""" --- Vocabularies --- """
+
+ACCOUNT_TYPES = FuzzyMatcher({
+    'checking': ['checkings', 'chequing', 'check', 'current', 'checking account'],
+    'savings': ['saving', 'save', 'savings account'],
+})
+
+#Survey: how was your experience today / would you recommend us
+SURVEY_RATINGS = FuzzyMatcher({
+    'excellent': ['great', 'very good', 'amazing'],
+    'good': ['fine', 'okay', 'ok', 'pretty good'],
+    'fair': ['average', 'so so', 'alright'],
+    'poor': ['bad', 'terrible', 'awful'],
+})
+
+YES_NO = FuzzyMatcher({
+    'yes': ['yeah', 'yeh', 'yep', 'ya', 'sure', 'of course', 'definitely'],
+    'no': ['nope', 'nop', 'nah', 'not really', 'no thanks'],
+})
+
+#RecentTransactions: asking for the next page of the mini-statement
+PAGE_CHOICES = FuzzyMatcher({
+    'next': ['more', 'next five', 'next 5', 'continue', 'keep going'],
+})
+
+
+def normalize_choice_slots(intent_request, matchers):
+    '''Rewrites each enumerated slot's interpretedValue to its canonical choice before validation.
+
+    matchers is {slot name: FuzzyMatcher}. Values nothing matches are left for
+    the validators to reject as before.
+    '''
+
+    slots = intent_request['sessionState']['intent'].get('slots') or {}
+
+    for slot_name, matcher in matchers.items():
+        slot = slots.get(slot_name)
+        if not slot or not slot.get('value'):
+            continue
+
+        value = slot['value']
+        raw = value.get('interpretedValue') or value.get('originalValue')
+        choice = matcher.match(raw)
+
+        if choice is not None and choice != value.get('interpretedValue'):
+            logger.info(f'resolved slot {slot_name}={raw!r} to {choice!r}')
+            value['interpretedValue'] = choice
+
+    return slots
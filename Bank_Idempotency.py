@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import asyncio
+import logging
+
+from botocore.exceptions import ClientError
+
+from Bank_Session import get_session_state
+from Bank_Store import StoreUnavailable, get_table, submit_io, bounded_wait, warm_cache_get, warm_cache_put, warm_cache_invalidate
+
+
+#Configure logger
+logger = logging.getLogger()
+
+
+""" --- Idempotency configuration --- """
+
+#Finished fulfillment responses, expired by DynamoDB TTL on ExpiresAt
+idempotency_tbl_name = 'BankIdempotency'
+
+#How long a finished response is replayed to Lex retries
+IDEMPOTENCY_TTL = int(os.environ.get('BANK_IDEMPOTENCY_TTL', '300'))
+
+#How long a retry waits for the first attempt (still running in another container) to finish
+IDEMPOTENCY_WAIT = float(os.environ.get('BANK_IDEMPOTENCY_WAIT', '2.0'))
+
+#Session state field counting our responses. Lex echoes it back, so a retry carries the same turn number
+TURN_KEY = 'turn'
+
+
+
+""" --- Idempotent fulfillment --- """
+
+
+class FulfillmentInProgress(StoreUnavailable):
+    '''Raised to a Lex retry while the first attempt is still running. A store failure, so the handlers
+    answer it with their try-again reply and the next retry gets the finished response'''
+
+
+
+def idempotency_key(intent_request):
+    '''sessionId#intent#turn for this request, and moves the session to the next turn'''
+
+    session_state = get_session_state(intent_request)
+    turn = session_state.get(TURN_KEY, 0)
+
+    #Written into our response, so only a genuinely new turn comes back with turn + 1
+    session_state[TURN_KEY] = turn + 1
+
+    intent_name = intent_request['sessionState']['intent']['name']
+
+    return f"{intent_request['sessionId']}#{intent_name}#{turn}"
+
+
+def _get_record(key):
+    record = warm_cache_get(idempotency_tbl_name, {'IdempotencyKey': key})
+    if record is None:
+        record = get_table(idempotency_tbl_name).get_item(Key={'IdempotencyKey': key}, ConsistentRead=True).get('Item')
+
+    #TTL deletes lazily, so expired records can still be read back
+    if record is None or record['ExpiresAt'] < int(time.time()):
+        return None
+
+    return record
+
+
+def _claim(key):
+    '''Marks key as in progress. False if another attempt already holds (or finished) it'''
+
+    from boto3.dynamodb.conditions import Attr
+
+    now = int(time.time())
+
+    try:
+        get_table(idempotency_tbl_name).put_item(
+            Item={'IdempotencyKey': key, 'Status': 'PENDING', 'ExpiresAt': now + IDEMPOTENCY_TTL},
+            ConditionExpression=Attr('IdempotencyKey').not_exists() | Attr('ExpiresAt').lt(now)
+        )
+    except ClientError as err:
+        if err.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise err
+
+    return True
+
+
+def _wait_for_response(key):
+    deadline = time.monotonic() + bounded_wait(IDEMPOTENCY_WAIT)
+
+    while True:
+        record = _get_record(key)
+        if record is None:
+            return None
+        if record['Status'] == 'COMPLETE':
+            return json.loads(record['Response'])
+        if time.monotonic() >= deadline:
+            raise FulfillmentInProgress(f'Fulfillment {key} is still in progress')
+        time.sleep(0.05)
+
+
+def claim_fulfillment(key):
+    '''The stored response if this turn already ran, otherwise None once key is claimed for this attempt'''
+
+    record = warm_cache_get(idempotency_tbl_name, {'IdempotencyKey': key})
+    if record is not None and record['Status'] == 'COMPLETE':
+        logger.info(f'returning warm response for retried fulfillment {key}')
+        return json.loads(record['Response'])
+
+    while not _claim(key):
+        cached = _wait_for_response(key)
+        if cached is not None:
+            logger.info(f'returning stored response for retried fulfillment {key}')
+            return cached
+
+        #The earlier record expired between our claim and read. Claim it again, another attempt may win that race too
+
+    return None
+
+
+def release_fulfillment(key):
+    '''Lets the next retry run the turn again instead of waiting on a claim that will never finish'''
+
+    get_table(idempotency_tbl_name).delete_item(Key={'IdempotencyKey': key})
+    warm_cache_invalidate(idempotency_tbl_name, {'IdempotencyKey': key})
+
+
+def complete_fulfillment(key, response):
+    record = {
+        'IdempotencyKey': key,
+        'Status': 'COMPLETE',
+        'Response': json.dumps(response, separators=(',', ':'), default=str),
+        'ExpiresAt': int(time.time()) + IDEMPOTENCY_TTL
+    }
+    get_table(idempotency_tbl_name).put_item(Item=record)
+    warm_cache_put(idempotency_tbl_name, {'IdempotencyKey': key}, record, ttl=IDEMPOTENCY_TTL)
+
+
+def run_idempotent(intent_request, handler):
+    '''Runs handler(intent_request) at most once per session, intent and turn.
+
+    Only fulfillment is guarded: that is where Lex retries on timeout and where
+    the handlers write. A retry of a finished turn gets the stored response
+    back (from the warm cache in microseconds when it lands on the same
+    container); a retry racing the first attempt waits for it briefly.
+    '''
+
+    if intent_request['invocationSource'] != 'FulfillmentCodeHook':
+        return handler(intent_request)
+
+    key = idempotency_key(intent_request)
+
+    cached = claim_fulfillment(key)
+    if cached is not None:
+        return cached
+
+    try:
+        response = handler(intent_request)
+    except Exception:
+        release_fulfillment(key)
+        raise
+
+    complete_fulfillment(key, response)
+
+    return response
+
+
+async def run_idempotent_async(intent_request, handler):
+    '''run_idempotent for the async handler: awaits handler(intent_request), the record calls run on the I/O pool'''
+
+    if intent_request['invocationSource'] != 'FulfillmentCodeHook':
+        return await handler(intent_request)
+
+    key = idempotency_key(intent_request)
+
+    cached = await asyncio.wrap_future(submit_io(claim_fulfillment, key))
+    if cached is not None:
+        return cached
+
+    try:
+        response = await handler(intent_request)
+    except Exception:
+        await asyncio.wrap_future(submit_io(release_fulfillment, key))
+        raise
+
+    await asyncio.wrap_future(submit_io(complete_fulfillment, key, response))
+
+    return response
@@ -0,0 +1,360 @@
+''' Append-only ledger of postings with a materialized balance snapshot.
+
+Every posting is one new BankTransactions row (the same rows RecentTransactions
+reads). The same transaction ADDs its amount to the account's 'Account Balance'
+and bumps 'BalanceVersion', so balance reads stay a single GetItem and writers
+never read the balance back to change it.
+
+The compaction job rolls postings older than --days into a BankLedgerCheckpoints
+row (balance and version as of the last rolled posting) and deletes them.
+Checkpoint + remaining postings always rebuild the snapshot, which --verify checks.
+
+Usage: python Bank_Ledger.py [--days N] [--segments N] [--verify] [--dry-run]
+'''
+
+import sys
+import uuid
+import logging
+import hashlib
+import argparse
+from decimal import Decimal
+from datetime import datetime, timedelta, timezone
+
+from botocore.exceptions import ClientError
+
+from Bank_Store import (
+    get_table, get_cached_item, warm_cache_invalidate, transact_write, run_concurrently,
+    accounts_tbl_name as tbl_name, customer_tbl_name, transactions_tbl_name
+)
+
+
+#Configure logger
+logger = logging.getLogger()
+
+
+""" --- Ledger configuration --- """
+
+#Balance and version of an account as of its last compacted posting
+checkpoint_tbl_name = 'BankLedgerCheckpoints'
+
+#AsOf of the opening checkpoint, sorts before every PostedAt timestamp
+OPENING_AS_OF = '0'
+
+#Postings older than this are rolled into a checkpoint by the compaction job
+COMPACT_AFTER_DAYS = 90
+
+
+
+""" --- Posting --- """
+
+
+def posting_time(when=None):
+    when = when or datetime.now(timezone.utc)
+
+    return when.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def post_transaction(accountNumber, amount, description, postingId=None, postedAt=None):
+    '''Appends a posting and applies it to the balance snapshot in one transaction.
+
+    Pass the caller's own postingId and postedAt to make retries safe: the
+    same posting is written, and counted, only once. Returns the posting.
+    '''
+
+    from boto3.dynamodb.conditions import Attr
+
+    #PostedAt is part of the row's key, a retry stamped with a new time would be a second posting
+    if postingId is not None and postedAt is None:
+        raise Exception(f'posting {postingId} needs the postedAt of its first attempt')
+
+    accountNumber = Decimal(accountNumber)
+    amount = Decimal(str(amount))
+    postingId = postingId or uuid.uuid4().hex
+    postedAt = postedAt or posting_time()
+
+    #CustomerId / AccountType never change, so a cached copy is enough to find the summary row
+    account = get_cached_item(tbl_name, {'AccountNumber': accountNumber})
+    if account is None:
+        raise Exception(f'Account {accountNumber} does not exist')
+
+    posting = {
+        'AccountNumber': accountNumber,
+        'PostedAt': f'{postedAt}#{postingId}',
+        'PostingId': postingId,
+        'Amount': amount,
+        'Description': description
+    }
+
+    apply_posting = {
+        'UpdateExpression': 'ADD #balance :amount, BalanceVersion :one',
+        'ExpressionAttributeNames': {'#balance': 'Account Balance'},
+        'ExpressionAttributeValues': {':amount': amount, ':one': Decimal('1')}
+    }
+
+    actions = [
+        {'Put': {'TableName': transactions_tbl_name, 'Item': posting, 'ConditionExpression': Attr('PostedAt').not_exists()}},
+        {'Update': dict(apply_posting, TableName=tbl_name, Key={'AccountNumber': accountNumber},
+                        ConditionExpression=Attr('AccountNumber').exists())}
+    ]
+    if 'CustomerId' in account:
+        #Only an existing summary row: an ADD on a missing one would create a row with nothing but the balance
+        actions.append({'Update': dict(
+            apply_posting,
+            TableName=customer_tbl_name,
+            Key={'CustomerId': account['CustomerId'], 'AccountKey': '{}#{}'.format(account['AccountType'], accountNumber)},
+            ConditionExpression=Attr('CustomerId').exists()
+        )})
+
+    try:
+        _apply_posting(actions, posting)
+    finally:
+        warm_cache_invalidate(tbl_name, {'AccountNumber': accountNumber})
+
+    return posting
+
+
+def _cancelled_by(err, index):
+    reasons = err.response.get('CancellationReasons', [])
+
+    return len(reasons) > index and reasons[index].get('Code') == 'ConditionalCheckFailed'
+
+
+def _apply_posting(actions, posting):
+    '''Runs the posting transaction. A posting already applied is left as it is, and one whose
+    customer summary row is missing (not migrated yet) is applied to the account alone'''
+
+    try:
+        transact_write(actions, posting_token(posting))
+        return
+    except ClientError as err:
+        if _cancelled_by(err, 0):
+            logger.info(f"posting {posting['PostingId']} was already applied")
+            return
+        if not _cancelled_by(err, 2):
+            raise err
+
+    #The migration writes the summary row from the account's balance, so the posting still shows up there
+    logger.info(f"account {posting['AccountNumber']} has no customer summary row, posting to the account only")
+    try:
+        transact_write(actions[:2], posting_token(posting, summary=False))
+    except ClientError as err:
+        if not _cancelled_by(err, 0):
+            raise err
+        logger.info(f"posting {posting['PostingId']} was already applied")
+
+
+def posting_token(posting, summary=True):
+    '''ClientRequestToken for a posting. Covers the whole posting, so reusing a postingId for
+    different postings is refused by DynamoDB rather than treated as a retry. summary=False is
+    the token of the account-only transaction, which has different parameters'''
+
+    fields = [posting['AccountNumber'], posting['PostedAt'], posting['Amount'], posting['Description']]
+    if not summary:
+        fields.append('account-only')
+
+    return hashlib.sha256('#'.join(str(field) for field in fields).encode('utf-8')).hexdigest()[:36]
+
+
+def get_balance(accountNumber):
+    '''Balance snapshot read from the table. Postings from any container land there, while warm
+    caches and prefetched copies only hear about this container's own, so balances the caller
+    hears are never served from them'''
+
+    item = get_table(tbl_name).get_item(
+        Key={'AccountNumber': Decimal(accountNumber)},
+        ProjectionExpression='#balance',
+        ExpressionAttributeNames={'#balance': 'Account Balance'},
+        ConsistentRead=True
+    ).get('Item')
+
+    return item.get('Account Balance') if item is not None else None
+
+
+
+""" --- Checkpoints and compaction --- """
+
+
+def get_checkpoint(accountNumber):
+    '''Latest checkpoint for the account, None if it was never compacted'''
+
+    from boto3.dynamodb.conditions import Key
+
+    response = get_table(checkpoint_tbl_name).query(
+        KeyConditionExpression=Key('AccountNumber').eq(Decimal(accountNumber)),
+        ScanIndexForward=False,
+        Limit=1,
+        ConsistentRead=True
+    )
+
+    return response['Items'][0] if response['Items'] else None
+
+
+def get_postings(accountNumber, before=None):
+    '''Every posting (oldest first), or only those posted before the given posting_time()'''
+
+    from boto3.dynamodb.conditions import Key
+
+    condition = Key('AccountNumber').eq(Decimal(accountNumber))
+    if before is not None:
+        condition = condition & Key('PostedAt').lt(before)
+
+    query_params = {'KeyConditionExpression': condition, 'ConsistentRead': True}
+    postings = []
+
+    while True:
+        response = get_table(transactions_tbl_name).query(**query_params)
+        postings.extend(response['Items'])
+
+        if 'LastEvaluatedKey' not in response:
+            return postings
+        query_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def open_checkpoint(accountNumber):
+    '''Opening checkpoint for an account that was funded before the ledger existed.
+
+    The opening balance is the snapshot minus every posting since, which is only
+    exact if nothing was posted in between: BalanceVersion must equal the
+    number of postings read. Returns None (try again later) when it does not.
+    '''
+
+    account = get_table(tbl_name).get_item(Key={'AccountNumber': Decimal(accountNumber)}, ConsistentRead=True).get('Item')
+    if account is None:
+        return None
+
+    postings = get_postings(accountNumber)
+    if account.get('BalanceVersion', 0) != len(postings):
+        logger.info(f'account {accountNumber} is being posted to, opening checkpoint skipped')
+        return None
+
+    checkpoint = {
+        'AccountNumber': Decimal(accountNumber),
+        'AsOf': OPENING_AS_OF,
+        'Balance': account.get('Account Balance', Decimal('0')) - sum(posting['Amount'] for posting in postings),
+        'Version': Decimal('0'),
+        'Postings': Decimal('0')
+    }
+    get_table(checkpoint_tbl_name).put_item(Item=checkpoint)
+
+    return checkpoint
+
+
+def rebuild_balance(accountNumber):
+    '''(balance, version) replayed from the latest checkpoint and the postings after it'''
+
+    checkpoint = get_checkpoint(accountNumber)
+    if checkpoint is None:
+        checkpoint = {'AsOf': OPENING_AS_OF, 'Balance': Decimal('0'), 'Version': Decimal('0')}
+
+    #A crash between writing a checkpoint and deleting its postings leaves them behind, skip them
+    postings = [posting for posting in get_postings(accountNumber) if posting['PostedAt'] > checkpoint['AsOf']]
+
+    return checkpoint['Balance'] + sum(posting['Amount'] for posting in postings), checkpoint['Version'] + len(postings)
+
+
+def compact_account(accountNumber, before, dry_run=False):
+    '''Rolls postings older than before into a new checkpoint. Returns how many were rolled up'''
+
+    checkpoint = get_checkpoint(accountNumber)
+    if checkpoint is None and dry_run:
+        checkpoint = {'AsOf': OPENING_AS_OF}
+    elif checkpoint is None:
+        checkpoint = open_checkpoint(accountNumber)
+        if checkpoint is None:
+            return 0
+
+    postings = get_postings(accountNumber, before)
+    rolled = [posting for posting in postings if posting['PostedAt'] > checkpoint['AsOf']]
+
+    if dry_run or not postings:
+        return len(rolled)
+
+    if rolled:
+        get_table(checkpoint_tbl_name).put_item(Item={
+            'AccountNumber': Decimal(accountNumber),
+            'AsOf': rolled[-1]['PostedAt'],
+            'Balance': checkpoint['Balance'] + sum(posting['Amount'] for posting in rolled),
+            'Version': checkpoint['Version'] + len(rolled),
+            'Postings': Decimal(len(rolled))
+        })
+
+    #Only delete once the checkpoint covering them is written
+    with get_table(transactions_tbl_name).batch_writer() as batch:
+        for posting in postings:
+            batch.delete_item(Key={'AccountNumber': posting['AccountNumber'], 'PostedAt': posting['PostedAt']})
+
+    return len(rolled)
+
+
+def verify_account(accountNumber):
+    '''Difference between the snapshot and the replayed ledger, None if they agree'''
+
+    account = get_table(tbl_name).get_item(Key={'AccountNumber': Decimal(accountNumber)}, ConsistentRead=True).get('Item')
+    if account is None:
+        return None
+
+    balance, version = rebuild_balance(accountNumber)
+    snapshot = (account.get('Account Balance', Decimal('0')), account.get('BalanceVersion', Decimal('0')))
+
+    if snapshot == (balance, version):
+        return None
+
+    return {'AccountNumber': accountNumber, 'snapshot': snapshot, 'ledger': (balance, version)}
+
+
+def compact_segment(segment, total_segments, before, verify=False, dry_run=False):
+    '''Compacts every account in one parallel Scan segment. Returns (accounts, postings rolled up, drifted accounts)'''
+
+    scan_params = {'Segment': segment, 'TotalSegments': total_segments, 'ProjectionExpression': 'AccountNumber'}
+    accounts = rolled = 0
+    drifted = []
+
+    while True:
+        response = get_table(tbl_name).scan(**scan_params)
+
+        for item in response['Items']:
+            accounts += 1
+            rolled += compact_account(item['AccountNumber'], before, dry_run)
+            if verify:
+                drift = verify_account(item['AccountNumber'])
+                if drift is not None:
+                    drifted.append(drift)
+
+        if 'LastEvaluatedKey' not in response:
+            return accounts, rolled, drifted
+        scan_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def compact(days=COMPACT_AFTER_DAYS, total_segments=4, verify=False, dry_run=False):
+    before = posting_time(datetime.now(timezone.utc) - timedelta(days=days))
+
+    results = run_concurrently(*[
+        (lambda segment=segment: compact_segment(segment, total_segments, before, verify, dry_run)) for segment in range(total_segments)
+    ])
+
+    return (
+        sum(result[0] for result in results),
+        sum(result[1] for result in results),
+        [drift for result in results for drift in result[2]]
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Roll old ledger postings into balance checkpoints')
+    parser.add_argument('--days', type=int, default=COMPACT_AFTER_DAYS, help='keep postings newer than this many days')
+    parser.add_argument('--segments', type=int, default=4, help='parallel Scan segments')
+    parser.add_argument('--verify', action='store_true', help='check every snapshot against its replayed ledger')
+    parser.add_argument('--dry-run', action='store_true', help='count postings without writing')
+    args = parser.parse_args(argv)
+
+    accounts, rolled, drifted = compact(args.days, args.segments, args.verify, args.dry_run)
+    print(f'accounts scanned={accounts}, postings rolled up={rolled}, dry_run={args.dry_run}')
+
+    for drift in drifted:
+        print(f"account {drift['AccountNumber']}: snapshot={drift['snapshot']} ledger={drift['ledger']}")
+
+    return 1 if drifted else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
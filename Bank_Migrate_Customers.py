@@ -0,0 +1,141 @@
+''' Backfills BankCustomerAccounts (CustomerId / AccountType#AccountNumber) from the single-key BankAccountsNew table.
+
+Every account gets a CustomerId (the hashed SSN, the same one OpenAccount
+writes) and a customer row carrying its type and balance, so CheckBalance can
+read all of a customer's balances with one Query. Accounts with an SSN on file
+also get the SSN + account type marker OpenAccount checks, so a customer who
+opened an account before the markers existed can't open a second of that type.
+Safe to re-run.
+
+Usage: python Bank_Migrate_Customers.py [--segments N] [--dry-run]
+'''
+
+import sys
+import logging
+import argparse
+
+from botocore.exceptions import ClientError
+
+from Bank_Store import get_table, run_concurrently
+from Bank_OpenAccount_V2_Lambda import (
+    tbl_name, customer_tbl_name, guard_tbl_name, customer_id_for_ssn, guard_key_for, normalize_account_type, customer_account_item
+)
+
+
+#Configure logger
+logger = logging.getLogger()
+
+
+def customer_id_for_item(item):
+    #The SSN decides when there is one, so accounts linked before SSNs were zero-padded (hash_ssn) are moved
+    if 'SSN' in item:
+        return customer_id_for_ssn(item['SSN'])
+    if 'CustomerId' in item:
+        return item['CustomerId']
+
+    #No SSN on file: the account is its own customer until someone links it
+    return 'ACCT#{}'.format(item['AccountNumber'])
+
+
+#SessionId on backfilled markers. No Lex session has it, so OpenAccount never takes one for its own retry
+MIGRATION_SESSION = 'migration'
+
+
+def write_guard(item, accountType):
+    '''Conditionally writes the account's SSN marker. False if another account of the type already holds it'''
+
+    from boto3.dynamodb.conditions import Attr
+
+    guard_key = guard_key_for(item['SSN'], accountType)
+    guards = get_table(guard_tbl_name)
+
+    try:
+        guards.put_item(
+            Item={'GuardKey': guard_key, 'AccountNumber': item['AccountNumber'], 'SessionId': MIGRATION_SESSION},
+            ConditionExpression=Attr('GuardKey').not_exists()
+        )
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise err
+        #A re-run finds its own marker, anything else is a customer with two accounts of one type
+        guard = guards.get_item(Key={'GuardKey': guard_key}, ConsistentRead=True).get('Item')
+        if guard is None or guard['AccountNumber'] != item['AccountNumber']:
+            logger.info(f"account {item['AccountNumber']}: another {accountType} account already holds its SSN marker")
+            return False
+
+    return True
+
+
+def migrate_segment(segment, total_segments, dry_run=False):
+    '''Migrates one parallel Scan segment and returns (accounts seen, accounts given a new CustomerId, markers it could not take)'''
+
+    source = get_table(tbl_name)
+    target = get_table(customer_tbl_name)
+
+    scan_params = {'Segment': segment, 'TotalSegments': total_segments}
+    seen = linked = duplicates = 0
+
+    with target.batch_writer(overwrite_by_pkeys=['CustomerId', 'AccountKey']) as batch:
+        while True:
+            response = source.scan(**scan_params)
+
+            for item in response['Items']:
+                seen += 1
+                customerId = customer_id_for_item(item)
+                accountType = normalize_account_type(item.get('AccountType', 'bank'))
+                entry = {
+                    'CustomerId': customerId,
+                    'AccountType': accountType,
+                    'Account Balance': item.get('Account Balance')
+                }
+                entry = {name: value for name, value in entry.items() if value is not None}
+
+                if dry_run:
+                    continue
+
+                row = customer_account_item(entry, item['AccountNumber'])
+                batch.put_item(Item=row)
+
+                if 'SSN' in item and not write_guard(item, accountType):
+                    duplicates += 1
+
+                if item.get('CustomerId') != customerId:
+                    if 'CustomerId' in item:
+                        #Linked under an older CustomerId: its row there would split the customer's Query
+                        batch.delete_item(Key={'CustomerId': item['CustomerId'], 'AccountKey': row['AccountKey']})
+                    source.update_item(
+                        Key={'AccountNumber': item['AccountNumber']},
+                        UpdateExpression='SET CustomerId = :customerId',
+                        ExpressionAttributeValues={':customerId': customerId}
+                    )
+                    linked += 1
+
+            if 'LastEvaluatedKey' not in response:
+                return seen, linked, duplicates
+            scan_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def migrate(total_segments=4, dry_run=False):
+    results = run_concurrently(*[
+        (lambda segment=segment: migrate_segment(segment, total_segments, dry_run)) for segment in range(total_segments)
+    ])
+
+    seen = sum(result[0] for result in results)
+    linked = sum(result[1] for result in results)
+    duplicates = sum(result[2] for result in results)
+
+    return seen, linked, duplicates
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Backfill the customer-partitioned account table')
+    parser.add_argument('--segments', type=int, default=4, help='parallel Scan segments')
+    parser.add_argument('--dry-run', action='store_true', help='scan and count without writing')
+    args = parser.parse_args(argv)
+
+    seen, linked, duplicates = migrate(args.segments, args.dry_run)
+    print(f'accounts scanned={seen}, given a new CustomerId={linked}, sharing an SSN marker={duplicates}, dry_run={args.dry_run}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
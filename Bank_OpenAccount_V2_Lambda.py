@@ -3,9 +3,21 @@ import os
 import time
 import boto3
 import uuid
+import hmac
+import hashlib
 import logging
 from decimal import Decimal
 
+from Bank_Capture import capture_turns
+from Bank_Digits import normalize_digit_slots
+from Bank_Funnel import run_tracked
+from Bank_Fuzzy import ACCOUNT_TYPES, normalize_choice_slots
+from Bank_Idempotency import run_idempotent, idempotency_tbl_name
+from Bank_Responses import close, elicit_slot, delegate, build_validation_result, message
+from Bank_Session import save_session_state
+from Bank_Store import get_table, transact_write, is_store_failure, invocation_deadline, accounts_tbl_name, customer_tbl_name
+from Bank_Warmup import handle_warmups
+
 from boto3 import session
 
 
@@ -14,9 +26,27 @@ logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
 
-#Initialize DynamoDB resource
-dyn_resource = boto3.resource('dynamodb')
-tbl_name = 'BankAccountsNew'
+#DynamoDB tables (set BANK_STORE=local to use the in-memory stand-in from Bank_Store)
+tbl_name = accounts_tbl_name
+
+#Slots callers answer with digits, normalized from speech / DTMF before validation
+DIGIT_SLOTS = ('pin', 'SSN')
+
+#Enumerated slots, resolved to their canonical choice even when slightly misheard
+CHOICE_SLOTS = {'accountType': ACCOUNT_TYPES}
+
+#Uniqueness markers written in the same transaction as the account (one per hashed SSN and account type)
+guard_tbl_name = 'BankAccountGuards'
+
+#Secret mixed into SSN hashes so the marker table never holds a guessable SSN digest
+SSN_HASH_KEY = os.environ.get('BANK_SSN_HASH_KEY')
+
+#Without the key CustomerIds and markers would be plain SSN digests, so refuse to start
+if not SSN_HASH_KEY:
+    raise Exception('BANK_SSN_HASH_KEY is not set')
+
+#Account number collisions are vanishingly rare, this just bounds the loop
+MAX_ACCOUNT_NUMBER_ATTEMPTS = 5
 
 
 """ --- Generic functions used to simplify interaction with Amazon Lex --- """
@@ -33,120 +63,33 @@ def get_slots(intent_request):
 #         return None 
 
 
-def get_session_attributes(intent_request):
-    sessionState = intent_request['sessionState']
-    if 'sessionAttributes' in sessionState:
-        return sessionState['sessionAttributes']
-    
-    return {}
-
-
-
-def close(intent_name, session_attributes, fulfillment_state, message):
-    '''Closes/Ends current Lex session with customer'''
-
-    response = {
-        'messages': [
-            message
-        ],
-        'sessionState': {
-            'dialogAction': {
-                'type': 'Close'           
-            },
-            'sessionAttributes': session_attributes,
-            'intent': {
-                'confirmationState': 'Confirmed',
-                'name': intent_name,
-                'state': fulfillment_state
-            }
-        }
-    }
-
-    return response
-    
+def get_slot_value(slots, slotName):
+    '''interpretedValue of a slot, or None if Lex has not filled it yet'''
 
+    slot = try_ex(lambda: slots[slotName])
+    if slot is None:
+        return None
 
-def elicit_intent(session_attributes, message):
-    '''Informs Amazon Lex that the user is expected to respond with an utterance that includes an intent. '''
-    
-    return {
-        'sessionState':{
-            'dialogAction':{
-                'type':'ElicitIntent'
-            },
-            'sessionAttributes': session_attributes
-        },
-        'messages': [message] if message != None else None
-    }
+    return try_ex(lambda: slot['value']['interpretedValue'])
 
 
-def confirm_intent(session_attributes, intent_name, slots, message):
-    '''Informs Amazon Lex that the user is expected to give a yes or no answer to confirm or deny the current intent'''
-    return {
-        'messages': [
-            message
-        ],
-        'sessionState': {
-            'sessionAttributes': session_attributes,
-            'dialogAction': {
-                'type': 'ConfirmIntent'
-            },
-            'intent': {
-                'name': intent_name,
-                'slots': slots
-            }
-        }
-    }
+def get_session_attributes(intent_request):
+    '''Flat Lex session attributes. Structured state lives in Bank_Session.get_session_state'''
 
+    #setdefault so anything written here (e.g. the packed session state) reaches the response
+    return intent_request['sessionState'].setdefault('sessionAttributes', {})
 
-def elicit_slot(intent_name, slots, violated_slot, session_attributes, message):
-    '''Re-prompts user to provide a slot value in the response'''
-    return {
-        'sessionState':{
-            'sessionAttributes': session_attributes,
-            'dialogAction':{
-                'slotToElicit': violated_slot,
-                'type':'ElicitSlot'
-            },
-            'intent':{
-                'confirmationState': 'Denied',
-                'name':intent_name,
-                'slots':slots,
-                'state':'InProgress'
-            }
-        },
-        'messages': [message] if message != None else None
-    }
 
 
-def delegate(intent_name, slots, session_attributes):
-    '''Directs Amazon Lex to choose the next course of action based on the bot configuration. '''
-    return {
-        'sessionState':{
-            'sessionAttributes': session_attributes,
-            'dialogAction':{
-                'type':'Delegate'
-            },
-            'intent':{
-                'name':intent_name,
-                'slots': slots
-            }
-        }
-    }
+''' --- Validation Functions --- '''
 
+def try_again_later(intent_request):
+    '''Degraded but valid reply for when the tables are shedding load'''
 
-''' --- Validation Functions --- '''
+    intent_name = intent_request['sessionState']['intent']['name']
 
-def build_validation_result(is_valid, violated_slot, message_content):
+    return close(intent_name, get_session_attributes(intent_request), 'Failed', message('try_again_systems'))
 
-    return {
-        'isValid': is_valid,
-        'violatedSlot': violated_slot,
-        'message':{
-            'contentType':'PlainText',
-            'content': message_content
-        }
-    }
 
 def isValid_Word(word):
 
@@ -175,9 +118,8 @@ def isValid_Pin(pin):
 
 def isValid_AccountType(accountType):
 
-    account_types = ['checking', 'savings', 'checkings','saving']
-
-    return accountType.lower() in account_types
+    #Near-misses ("savins", "check in") count too, see Bank_Fuzzy
+    return ACCOUNT_TYPES.is_valid(accountType)
 
 
 def isValid_SSN(ssn):
@@ -205,34 +147,18 @@ def validate_account_information(slots, session_attributes):
     logger.info(f'accountType={accountType}, firstName={firstName}, pin={pin}')
 
     if accountType and not isValid_AccountType(accountType['value']['interpretedValue']):
-        return build_validation_result(
-            False,
-            'accountType',
-            f'Sorry {firstName}, I did not understand. Would you like to open a Checking account or a Savings account?'
-        )
+        return build_validation_result(False, 'accountType', 'open_account_type_unclear', firstName=firstName)
     
     if ssn and not isValid_SSN(ssn['value']['interpretedValue']):
-        return build_validation_result(
-            False,
-            'SSN',
-            f'Sorry {firstName}, I did not understand. Could you please repeat your twelve digit Social Security Number.'
-        )
+        return build_validation_result(False, 'SSN', 'ssn_unclear', firstName=firstName)
 
     if lastName and not isValid_Word(lastName['value']['interpretedValue']):
-        return build_validation_result(
-            False,
-            'lastName',
-            f"<speak> Sorry {firstName}, I did not understand, May you repeat your last name to me once more, it would help if you could spell it out for me, like <say-as interpret-as='spell-out' Hello </say-as> </speak>"
-        )
+        return build_validation_result(False, 'LastName', 'last_name_unclear', firstName=firstName)
 
     if pin:
-        logger.info(f'pin={pin} and user_pin={user_pin}')
+        logger.info(f'pin={pin}')
         if not isValid_Pin(pin['value']['interpretedValue']):
-            return build_validation_result(
-                False,
-                'pin',
-                f'Sorry {firstName}, this is not a valid pin. Please tell us the four digit pin number you would like to use for your account.'
-            )
+            return build_validation_result(False, 'pin', 'new_pin_invalid', firstName=firstName)
     
     return {'isValid':True}
 
@@ -253,22 +179,122 @@ def try_ex(func):
     except KeyError:
         return None
 
-def getValid_AccountNumber():
+def hash_ssn(ssn):
+    '''Keyed hash of an SSN, used as the uniqueness marker key'''
 
-    table_name = tbl_name
+    #Slots hold the digits as spoken, the table a Decimal that drops leading zeros: both hash as twelve digits
+    digits = '{:012d}'.format(int(ssn))
 
-    accountNumber = Decimal(str(uuid.uuid4().int)[:12])
+    return hmac.new(SSN_HASH_KEY.encode('utf-8'), digits.encode('utf-8'), hashlib.sha256).hexdigest()
 
-    table = dyn_resource.Table(table_name)
 
-    try:
-        response = table.get_item(Key={
-            'AccountNumber': Decimal(accountNumber)
-        })['Item']
-    except KeyError:
-        return accountNumber
+def customer_id_for_ssn(ssn):
+    '''Customers are identified by their (hashed) SSN, so all of one person's accounts share a partition'''
+
+    return 'CUST#' + hash_ssn(ssn)
+
+
+def guard_key_for(ssn, accountType):
+    '''Uniqueness marker key: one account of each type per customer, so it covers SSN + account type'''
+
+    return 'SSN#{}#{}'.format(hash_ssn(ssn), accountType)
+
+
+def normalize_account_type(accountType):
+    '''"Checkings" / "saving" -> "checking" / "savings"'''
+
+    choice = ACCOUNT_TYPES.match(accountType)
+    if choice is not None:
+        return choice
 
-    return getValid_AccountNumber()
+    accountType = str(accountType).strip().lower()
+
+    if accountType.startswith('check'):
+        return 'checking'
+    if accountType.startswith('saving'):
+        return 'savings'
+
+    return accountType
+
+
+def customer_account_item(db_entry, accountNumber):
+    '''BankCustomerAccounts row for an account: only what the multi-account balance summary reads'''
+
+    return {
+        'CustomerId': db_entry['CustomerId'],
+        'AccountKey': '{}#{}'.format(db_entry['AccountType'], accountNumber),
+        'AccountType': db_entry['AccountType'],
+        'AccountNumber': accountNumber,
+        'Account Balance': db_entry.get('Account Balance', Decimal('0'))
+    }
+
+
+def derive_account_number(seed, attempt):
+    '''12 digit account number derived from the session, so a Lex retry proposes the same number'''
+
+    digest = int(hashlib.sha256(f'{seed}#{attempt}'.encode('utf-8')).hexdigest(), 16)
+
+    #Keep the leading digit non-zero so the number stays twelve digits as a Decimal
+    return Decimal(10**11 + digest % (9 * 10**11))
+
+
+def create_account(session_id, db_entry, ssn):
+    '''Writes the account, its customer row and its SSN marker in one TransactWriteItems call.
+
+    Returns (accountNumber, outcome) where outcome is 'created', 'retry' (this
+    session already created the account, e.g. Lex re-sent fulfillment) or
+    'duplicate' (the SSN already has an account of this type, accountNumber is None).
+    '''
+
+    from botocore.exceptions import ClientError
+    from boto3.dynamodb.conditions import Attr
+
+    guard_key = guard_key_for(ssn, db_entry['AccountType'])
+
+    for attempt in range(MAX_ACCOUNT_NUMBER_ATTEMPTS):
+        accountNumber = derive_account_number(session_id + guard_key, attempt)
+
+        try:
+            transact_write(
+                [
+                    {'Put': {
+                        'TableName': tbl_name,
+                        'Item': dict(db_entry, AccountNumber=accountNumber),
+                        'ConditionExpression': Attr('AccountNumber').not_exists()
+                    }},
+                    {'Put': {
+                        'TableName': customer_tbl_name,
+                        'Item': customer_account_item(db_entry, accountNumber)
+                    }},
+                    {'Put': {
+                        'TableName': guard_tbl_name,
+                        'Item': {'GuardKey': guard_key, 'AccountNumber': accountNumber, 'SessionId': session_id},
+                        'ConditionExpression': Attr('GuardKey').not_exists()
+                    }}
+                ],
+                #Same account and marker -> same token and parameters, so DynamoDB treats a retry as a no-op.
+                #A second account opened in the session has its own marker, so its own token
+                client_request_token=hashlib.sha256(f'{guard_key}#{accountNumber}'.encode('utf-8')).hexdigest()[:36]
+            )
+            return accountNumber, 'created'
+
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'TransactionCanceledException':
+                raise err
+
+            reasons = [reason.get('Code') for reason in err.response.get('CancellationReasons', [])]
+            logger.info(f'create_account attempt={attempt} cancelled, reasons={reasons}')
+
+            if len(reasons) > 2 and reasons[2] == 'ConditionalCheckFailed':
+                guard = get_table(guard_tbl_name).get_item(Key={'GuardKey': guard_key}).get('Item')
+                if guard is not None and guard.get('SessionId') == session_id:
+                    return guard['AccountNumber'], 'retry'
+                return None, 'duplicate'
+
+            if not reasons or reasons[0] != 'ConditionalCheckFailed':
+                raise err
+
+    raise Exception('Could not allocate a unique account number')
 
 
 def write_item_dynamodb(items):
@@ -277,31 +303,32 @@ def write_item_dynamodb(items):
 
     table_name = tbl_name
 
-    table = dyn_resource.Table(table_name)
+    table = get_table(table_name)
 
     try:
         response = table.put_item(Item=items)
     except ClientError as err:
-        if err.response['Error']['Code'] == 'InternalError':
-            logger.info('Error Message: {}'.format(err.response['Error']['Message']))
-        else:
-            raise err
+        #InternalError included: botocore has already retried it, reporting the write as done would lose it
+        logger.info('Error Message: {}'.format(err.response['Error']['Message']))
+        raise err
 
     return True
 
 
 def process(sessionAttributes, slots):
+    '''Builds the BankAccountsNew item for a new account (create_account adds the AccountNumber)'''
 
     response = {
-        'AccountNumber': { "N": sessionAttributes['accountNumber']},
-        'Pin': { 'N': slots['pin']},
-        'AccountType':{'S': slots['accountType']},
-        'FirstName': {'S': sessionAttributes['firstName']},
-        'LastName': {'S': slots['lastName']},
-        'SSN': {'N': slots['SSN']}
+        'Pin': Decimal(get_slot_value(slots, 'pin')),
+        'AccountType': normalize_account_type(get_slot_value(slots, 'accountType')),
+        'CustomerId': customer_id_for_ssn(get_slot_value(slots, 'SSN')),
+        'FirstName': try_ex(lambda: sessionAttributes['FirstName']),
+        'LastName': get_slot_value(slots, 'LastName'),
+        'SSN': Decimal(get_slot_value(slots, 'SSN')),
+        'Account Balance': Decimal('0')
     }
 
-    return response
+    return {name: value for name, value in response.items() if value is not None}
 
 
 """ --- Functions that control the bot's behavior --- """
@@ -329,65 +356,39 @@ def OpenAccount(intent_request):
             slots[validation_result['violatedSlot']] = None 
             logger.debug(f'slots={slots}')
             logger.info('violatedSlot={}, message={}'.format(validation_result['violatedSlot'], validation_result['message']))
-            if validation_result['violatedSlot'] == 'LastName':
-                return {
-        'sessionState':{
-            'sessionAttributes': session_attributes,
-            'dialogAction':{
-                'slotElicitationStyle': 'SpellByLetter',
-                'slotToElicit': 'LastName',
-                'type':'ElicitSlot',
-
-            },
-            'intent':{
-                'confirmationState': 'Denied',
-                'name':intent_name,
-                'slots':slots,
-                'state':'InProgress'
-            }
-        },
-        'messages': validation_result['message']
-    }
-            else:
-                return elicit_slot(
-                    intent_name,
-                    slots,
-                    validation_result['violatedSlot'],
-                    session_attributes,
-                    validation_result['message']
-                )
+            #Names are easier to take down letter by letter
+            return elicit_slot(
+                intent_name,
+                slots,
+                validation_result['violatedSlot'],
+                session_attributes,
+                validation_result['message'],
+                style='SpellByLetter' if validation_result['violatedSlot'] == 'LastName' else None,
+                reason=validation_result['reason']
+            )
         
         return delegate(intent_name,intent_request['sessionState']['intent']['slots'] ,session_attributes)
 
 
-    session_attributes['accountNumber'] = getValid_AccountNumber()
-
-    firstName = session_attributes['FirstName']
-    lastName = slots['LastName']
-    accountType = slots['AccountType']
+    firstName = try_ex(lambda: session_attributes['FirstName'])
+    lastName = get_slot_value(slots, 'LastName')
+    accountType = get_slot_value(slots, 'accountType')
 
     #Process information into dictionary for DynamoDB entry format
     db_entry = process(session_attributes, slots)
 
-    #Write processed informtion into DynamoDB
-    if write_item_dynamodb(db_entry):
+    #Account and SSN marker go in together, so a duplicate SSN is caught in the same round trip
+    accountNumber, outcome = create_account(intent_request['sessionId'], db_entry, get_slot_value(slots, 'SSN'))
+    logger.info(f'firstName={firstName}, lastName={lastName}, accountType={accountType}, outcome={outcome}')
 
-        logger.info(f'firstName={firstName}, lastName={lastName}, accountType={accountType}')
-        logger.info(f'Info to be put into Database: {db_entry}')
+    if outcome == 'duplicate':
+        return close(intent_name, session_attributes, 'Failed', message('ssn_duplicate', firstName=firstName, accountType=accountType))
 
-        out1 =  f'Awesome! We have finished processing your information and your new {accountType} is now open and ready for use.'
-        out2 = f'You can log in with username {lastName} and the password is the last four of your social. You can change this in settings.'
-        out3 = f'Thank you {firstName} for choosing to open an account with Example Bank. We appreciate your business. '
-        out4= f'Please stay on the line if you would like to take part in a customer experience survey.'
-        output = out1+out2+out3+out4
-        fulfillment_state = 'Fulfilled'
+    session_attributes['accountNumber'] = str(accountNumber)
 
-        message = {'contentType':'PlainText', 'content':output}
-        
-        return close(intent_name, session_attributes, fulfillment_state, message)
-    
-    else:
-        raise Exception('Error writing into DynamoDB')
+    reply = message('account_opened', accountType=accountType, lastName=lastName, firstName=firstName)
+
+    return close(intent_name, session_attributes, 'Fulfilled', reply)
 
 
 
@@ -410,6 +411,30 @@ def dispatch(intent_request):
 ''' --- MAIN handler --- '''
 
 
+def handle_turn(intent_request):
+    '''One Lex turn: dispatch, then fold per-turn state back into the response'''
+
+    #Spoken and keypad digits become plain digit strings before any validator sees them
+    normalize_digit_slots(intent_request, DIGIT_SLOTS)
+    normalize_choice_slots(intent_request, CHOICE_SLOTS)
+
+    #Counts the turn (and any re-prompt) toward the call's funnel metrics
+    response = run_tracked(intent_request, dispatch)
+
+    #Only re-encodes the packed session state if a handler changed it
+    save_session_state(intent_request)
+
+    return response
+
+
+
+#Tables whose connections a keep-warm ping opens
+WARM_TABLES = (tbl_name, customer_tbl_name, guard_tbl_name, idempotency_tbl_name)
+
+
+#Keep-warm pings are answered before anything reads the Lex fields
+@handle_warmups(WARM_TABLES)
+@capture_turns
 def lambda_handler(event, context):
     
     # By default, treat the user request as coming from the America/New_York time zone.
@@ -425,7 +450,17 @@ def lambda_handler(event, context):
     logger.info(f'event.bot.name={bot_name}, userMessage={userMessage}, inputType={inputType}')
 
 
-    return dispatch(event)
+    #Every store call and optional step below is bounded by the time Lambda has left
+    with invocation_deadline(context):
+        #Lex retries fulfillment on timeout, a retried turn gets the first attempt's response back
+        try:
+            return run_idempotent(event, handle_turn)
+        except Exception as err:
+            if not is_store_failure(err):
+                raise err
+            #Throttled, out of time, or the circuit is open: answer now rather than let Lex time out
+            logger.info(f'shedding turn: {err!r}')
+            return try_again_later(event)
 
 
 
@@ -0,0 +1,273 @@
+import os
+import time
+import asyncio
+import logging
+from decimal import Decimal
+
+from botocore.exceptions import ClientError
+
+from Bank_Store import get_table, run_concurrently, warm_cache_get, warm_cache_put
+
+
+#Configure logger
+logger = logging.getLogger()
+
+
+""" --- PIN retry configuration --- """
+
+#Failed PIN attempts per account (AttemptKey = ACCOUNT#n) and per session (AttemptKey = SESSION#id),
+#expired by DynamoDB TTL on ExpiresAt
+pin_attempts_tbl_name = 'BankPinAttempts'
+
+#Wrong PINs an account accepts, from any number of sessions, before it is locked out
+PIN_MAX_ACCOUNT_FAILURES = int(os.environ.get('BANK_PIN_MAX_ACCOUNT_FAILURES', '5'))
+
+#Wrong PINs one session gets, so a single caller can't use up the account's whole budget
+PIN_MAX_SESSION_FAILURES = int(os.environ.get('BANK_PIN_MAX_SESSION_FAILURES', '3'))
+
+#Seconds after the last wrong PIN before a counter (and any lockout) expires
+PIN_LOCKOUT_SECONDS = int(os.environ.get('BANK_PIN_LOCKOUT_SECONDS', '900'))
+
+
+
+""" --- Attempt counters --- """
+
+#Charge / restart rounds before a refused counter is taken as used up. The second round only
+#matters when an expired counter was restarted by another attempt between our two writes
+CHARGE_ROUNDS = 2
+
+
+def attempt_limits(accountNumber, sessionId=None):
+    '''{AttemptKey: failures allowed} for the counters one PIN attempt is charged to'''
+
+    limits = {f'ACCOUNT#{accountNumber}': PIN_MAX_ACCOUNT_FAILURES}
+    if sessionId:
+        limits[f'SESSION#{sessionId}'] = PIN_MAX_SESSION_FAILURES
+
+    return limits
+
+
+def _is_locked(record, limit, now):
+    #TTL deletes lazily, so expired counters can still be read back
+    return record is not None and record['ExpiresAt'] >= now and record['Failures'] >= limit
+
+
+def _remember_lockout(attempt_key, record, now):
+    '''Keeps a lockout in the warm cache until it expires, so retries are turned away without a write'''
+
+    warm_cache_put(pin_attempts_tbl_name, {'AttemptKey': attempt_key}, record, ttl=int(record['ExpiresAt']) - now + 1)
+
+
+def _cached_lockout(limits, now):
+    return any(
+        _is_locked(warm_cache_get(pin_attempts_tbl_name, {'AttemptKey': attempt_key}), limit, now)
+        for attempt_key, limit in limits.items()
+    )
+
+
+def _charge_update(attempt_key, limit, now):
+    '''update_item arguments charging one attempt to a live counter that has attempts left'''
+
+    from boto3.dynamodb.conditions import Attr
+
+    return {
+        'Key': {'AttemptKey': attempt_key},
+        'UpdateExpression': 'SET ExpiresAt = :expires ADD Failures :one',
+        'ConditionExpression': Attr('AttemptKey').not_exists() | (Attr('ExpiresAt').gte(now) & Attr('Failures').lt(limit)),
+        'ExpressionAttributeValues': {':expires': Decimal(now + PIN_LOCKOUT_SECONDS), ':one': Decimal('1')},
+        'ReturnValues': 'ALL_NEW'
+    }
+
+
+def _restart_put(attempt_key, now):
+    '''put_item arguments starting an expired counter over at one, only while it is still expired'''
+
+    from boto3.dynamodb.conditions import Attr
+
+    return {
+        'Item': {'AttemptKey': attempt_key, 'Failures': Decimal('1'), 'ExpiresAt': Decimal(now + PIN_LOCKOUT_SECONDS)},
+        'ConditionExpression': Attr('AttemptKey').not_exists() | Attr('ExpiresAt').lt(now)
+    }
+
+
+def _release_steps(attempt_key, record, clear):
+    '''(operation, arguments) tried in order to give a charged attempt back, the first that goes through wins.
+
+    The delete only applies if nothing was charged after us: with clear it also
+    forgets earlier failures (the account's, once its PIN is given), without it
+    only a counter this attempt started. Otherwise just our one charge is taken back.
+    '''
+
+    from boto3.dynamodb.conditions import Attr
+
+    key = {'AttemptKey': attempt_key}
+    steps = []
+    if clear or record['Failures'] == 1:
+        steps.append(('delete_item', {'Key': key, 'ConditionExpression': Attr('Failures').lte(record['Failures'])}))
+    steps.append(('update_item', {
+        'Key': key,
+        'UpdateExpression': 'ADD Failures :refund',
+        'ConditionExpression': Attr('Failures').gte(1),
+        'ExpressionAttributeValues': {':refund': Decimal('-1')}
+    }))
+
+    return steps
+
+
+def _is_condition_failure(err):
+    return err.response['Error']['Code'] == 'ConditionalCheckFailedException'
+
+
+def _attempt(limits, records):
+    '''{AttemptKey: (limit, counter)} if every counter took the charge, else None'''
+
+    if any(record is None for record in records):
+        return None
+
+    return {attempt_key: (limit, record) for (attempt_key, limit), record in zip(limits.items(), records)}
+
+
+def _refunds(limits, records):
+    '''(attempt_key, counter, clear) for the counters a refused attempt still has to give its charge back to'''
+
+    return [(attempt_key, record, False) for attempt_key, record in zip(limits, records) if record is not None]
+
+
+def _releases(attempt):
+    #The account's earlier failures are forgotten once its PIN is given, the session's stay until they expire
+    return [(attempt_key, record, attempt_key.startswith('ACCOUNT#')) for attempt_key, (limit, record) in attempt.items()]
+
+
+def _charge(attempt_key, limit, now):
+    '''The counter after charging one attempt to it, None if it has none left'''
+
+    table = get_table(pin_attempts_tbl_name)
+
+    for _ in range(CHARGE_ROUNDS):
+        try:
+            return table.update_item(**_charge_update(attempt_key, limit, now))['Attributes']
+        except ClientError as err:
+            if not _is_condition_failure(err):
+                raise err
+
+        #Refused: either the counter is used up, or it expired and starts over
+        restart = _restart_put(attempt_key, now)
+        try:
+            table.put_item(**restart)
+            return restart['Item']
+        except ClientError as err:
+            if not _is_condition_failure(err):
+                raise err
+
+    return None
+
+
+def _release(attempt_key, record, clear):
+    table = get_table(pin_attempts_tbl_name)
+
+    for operation, params in _release_steps(attempt_key, record, clear):
+        try:
+            getattr(table, operation)(**params)
+            return
+        except ClientError as err:
+            if not _is_condition_failure(err):
+                raise err
+
+
+def reserve_pin_attempt(accountNumber, sessionId=None):
+    '''Charges one attempt to the account and session counters before the PIN is compared.
+
+    Each charge is a single conditional ADD, so concurrent or retried turns can
+    never get past the cap between a check and the compare. Returns the attempt
+    for pin_attempt_failed / release_pin_attempt, None if either counter is used up.
+    '''
+
+    now = int(time.time())
+    limits = attempt_limits(accountNumber, sessionId)
+
+    if _cached_lockout(limits, now):
+        return None
+
+    records = run_concurrently(*[
+        (lambda attempt_key=attempt_key, limit=limit: _charge(attempt_key, limit, now)) for attempt_key, limit in limits.items()
+    ])
+
+    attempt = _attempt(limits, records)
+    if attempt is None:
+        run_concurrently(*[(lambda refund=refund: _release(*refund)) for refund in _refunds(limits, records)])
+
+    return attempt
+
+
+def pin_attempt_failed(attempt):
+    '''A wrong PIN keeps its charge. True if that was the last attempt on either counter'''
+
+    now = int(time.time())
+
+    locked = False
+    for attempt_key, (limit, record) in attempt.items():
+        if _is_locked(record, limit, now):
+            logger.info(f'{attempt_key} locked out after {record["Failures"]} wrong PINs')
+            _remember_lockout(attempt_key, record, now)
+            locked = True
+
+    return locked
+
+
+def release_pin_attempt(attempt):
+    '''Gives a correct PIN's charge back, and forgets the account's earlier wrong PINs'''
+
+    run_concurrently(*[(lambda release=release: _release(*release)) for release in _releases(attempt)])
+
+
+
+""" --- Async counterparts (Bank_Store_Async store) --- """
+
+
+async def _charge_async(store, attempt_key, limit, now):
+    for _ in range(CHARGE_ROUNDS):
+        try:
+            return (await store.request(pin_attempts_tbl_name, 'update_item', **_charge_update(attempt_key, limit, now)))['Attributes']
+        except ClientError as err:
+            if not _is_condition_failure(err):
+                raise err
+
+        restart = _restart_put(attempt_key, now)
+        try:
+            await store.request(pin_attempts_tbl_name, 'put_item', **restart)
+            return restart['Item']
+        except ClientError as err:
+            if not _is_condition_failure(err):
+                raise err
+
+    return None
+
+
+async def _release_async(store, attempt_key, record, clear):
+    for operation, params in _release_steps(attempt_key, record, clear):
+        try:
+            await store.request(pin_attempts_tbl_name, operation, **params)
+            return
+        except ClientError as err:
+            if not _is_condition_failure(err):
+                raise err
+
+
+async def reserve_pin_attempt_async(store, accountNumber, sessionId=None):
+    now = int(time.time())
+    limits = attempt_limits(accountNumber, sessionId)
+
+    if _cached_lockout(limits, now):
+        return None
+
+    records = await asyncio.gather(*[_charge_async(store, attempt_key, limit, now) for attempt_key, limit in limits.items()])
+
+    attempt = _attempt(limits, records)
+    if attempt is None:
+        await asyncio.gather(*[_release_async(store, *refund) for refund in _refunds(limits, records)])
+
+    return attempt
+
+
+async def release_pin_attempt_async(store, attempt):
+    await asyncio.gather(*[_release_async(store, *release) for release in _releases(attempt)])
@@ -0,0 +1,302 @@
+''' Replays turns captured by Bank_Capture.py against a handler and the local store.
+
+Every captured event is sent to the handler in order, against a fresh
+LocalResource seeded with one account per (pseudonymous) account number in
+the captures, all with REDACTED_PIN. Reports handler latency per intent,
+DynamoDB calls per operation, and every turn whose response differs from
+the captured one.
+
+The handler is the one that was captured unless --handler names another:
+a module (Bank_Balance_Replace_V2) or a file (old/Bank_Balance_Replace_V2.py),
+optionally :function (default lambda_handler).
+
+--latency and --fault run the same turns against a slow or failing store,
+e.g. --latency lognormal:12:0.6 --fault InternalError:0.02.
+
+Usage: python Bank_Replay.py CAPTURE_FILE [--handler MODULE_OR_FILE[:FUNCTION]] [--speed X] [--cold]
+                             [--latency SPEC] [--fault CODE:RATE] [--show-diffs N]
+'''
+
+import os
+import sys
+import json
+import time
+import difflib
+import argparse
+import importlib
+import importlib.util
+from decimal import Decimal
+
+os.environ.setdefault('BANK_STORE', 'local')
+
+#Replayed turns must not be captured again
+os.environ['BANK_CAPTURE_SAMPLE_RATE'] = '0'
+
+#Every replayed response is checked against the Lex V2 response shape
+os.environ.setdefault('BANK_VALIDATE_RESPONSES', '1')
+
+import Bank_Store
+from Bank_Store import LocalResource, TABLE_KEYS, parse_latency, warm_cache_clear
+from Bank_Capture import CAPTURE_PREFIX, REDACTED_PIN
+
+
+""" --- Replay configuration --- """
+
+#Lambda time left when the capture did not record it
+DEFAULT_REMAINING_MS = 3000
+
+#Seeded into every replayed account besides its number and PIN
+SEED_ACCOUNT = {
+    'Account Balance': Decimal('1000.00'),
+    'Email Address': 'replay@example.com',
+    'Street Address': '1 Replay Street'
+}
+
+
+
+""" --- Loading --- """
+
+
+def load_captures(path):
+    '''Capture records in the file, oldest first. Accepts raw JSON lines or log lines carrying CAPTURE_PREFIX'''
+
+    captures = []
+
+    with open(path) as capture_file:
+        for line in capture_file:
+            if CAPTURE_PREFIX in line:
+                line = line.split(CAPTURE_PREFIX, 1)[1]
+            line = line.strip()
+            if line.startswith('{'):
+                captures.append(json.loads(line))
+
+    return sorted(captures, key=lambda capture: capture['at'])
+
+
+def load_handler(spec):
+    '''lambda_handler (or the named function) from a module name or a .py file'''
+
+    target, _, function_name = spec.partition(':')
+
+    if target.endswith('.py'):
+        #A file, e.g. an older version of the handler checked out elsewhere
+        directory = os.path.dirname(os.path.abspath(target))
+        if directory not in sys.path:
+            sys.path.append(directory)
+        module_spec = importlib.util.spec_from_file_location('replayed_' + os.path.basename(target)[:-3], target)
+        module = importlib.util.module_from_spec(module_spec)
+        module_spec.loader.exec_module(module)
+    else:
+        module = importlib.import_module(target)
+
+    return getattr(module, function_name or 'lambda_handler')
+
+
+def seed_store(captures, latency=None, faults=()):
+    '''Fresh local store holding one account per account number the captures mention.
+
+    latency is a distribution every call waits, faults are (error code, rate) pairs.
+    '''
+
+    resource = LocalResource()
+    Bank_Store.set_resource(resource)
+    Bank_Store.reset_breakers()
+    warm_cache_clear()
+
+    table = resource.Table('BankAccountsNew')
+    for capture in captures:
+        slots = capture['event']['sessionState']['intent'].get('slots') or {}
+        accountNumber = ((slots.get('accountNumber') or {}).get('value') or {}).get('interpretedValue')
+        if accountNumber and accountNumber.isdigit():
+            table.put_item(Item=dict(SEED_ACCOUNT, AccountNumber=Decimal(accountNumber), Pin=Decimal(REDACTED_PIN)))
+
+    #Seeding itself runs at full speed and never fails
+    for name in TABLE_KEYS:
+        table = resource.Table(name)
+        table.calls = {}
+        table.set_latency(latency)
+        for seed, (code, rate) in enumerate(faults):
+            table.inject_faults(code, rate=rate, seed=seed)
+
+    return resource
+
+
+
+""" --- Replay --- """
+
+
+class ReplayContext(object):
+    '''Lambda context whose remaining time counts down from what the captured turn had'''
+
+    def __init__(self, remaining_ms):
+        self.deadline = time.monotonic() + remaining_ms / 1000.0
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.monotonic()) * 1000))
+
+
+def count_calls(resource):
+    calls = {}
+    for table in list(resource.tables.values()):
+        for operation_name, count in table.calls.items():
+            calls[operation_name] = calls.get(operation_name, 0) + count
+
+    return calls
+
+
+def comparable(response):
+    '''The parts of a response a changed handler should be judged on. Session attributes carry
+    signatures, timestamps and prefetched data that differ between runs anyway'''
+
+    if response is None:
+        return None
+
+    session_state = response.get('sessionState') or {}
+    intent = session_state.get('intent') or {}
+
+    return {
+        'dialogAction': session_state.get('dialogAction'),
+        'intent': {'name': intent.get('name'), 'state': intent.get('state'), 'slots': intent.get('slots')},
+        'messages': response.get('messages')
+    }
+
+
+def replay(captures, handler=None, speed=1.0, cold=False, latency=None, faults=()):
+    '''Runs the captures and returns one result per turn.
+
+    speed scales the captured gaps between turns (2 = twice as fast, 0 = no waiting).
+    cold clears the warm cache before every turn, as if each landed on a new container.
+    '''
+
+    resource = seed_store(captures, latency, faults)
+    handlers = {}
+    results = []
+    started = time.monotonic()
+
+    for capture in captures:
+        if speed > 0:
+            due = (capture['at'] - captures[0]['at']) / speed
+            wait = due - (time.monotonic() - started)
+            if wait > 0:
+                time.sleep(wait)
+
+        if handler is None:
+            name = capture['handler']
+            if name not in handlers:
+                handlers[name] = load_handler(name)
+            turn_handler = handlers[name]
+        else:
+            turn_handler = handler
+
+        if cold:
+            warm_cache_clear()
+
+        event = json.loads(json.dumps(capture['event']))
+        calls_before = count_calls(resource)
+        response, error = None, None
+
+        start = time.perf_counter()
+        try:
+            response = turn_handler(event, ReplayContext(capture.get('remainingMs') or DEFAULT_REMAINING_MS))
+        except Exception as err:
+            error = repr(err)
+        duration = (time.perf_counter() - start) * 1000
+
+        calls_after = count_calls(resource)
+
+        results.append({
+            'intent': capture['event']['sessionState']['intent']['name'],
+            'source': capture['event'].get('invocationSource'),
+            'durationMs': duration,
+            'capturedMs': capture.get('durationMs'),
+            'calls': {name: calls_after[name] - calls_before.get(name, 0) for name in calls_after if calls_after[name] != calls_before.get(name, 0)},
+            'error': error,
+            'captured': comparable(capture.get('response')),
+            'replayed': comparable(response),
+            'capturedError': capture.get('error')
+        })
+
+    return results
+
+
+
+""" --- Report --- """
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def differs(result):
+    if result['capturedError'] or result['error']:
+        return bool(result['capturedError']) != bool(result['error'])
+
+    return result['captured'] != result['replayed']
+
+
+def report(results, show_diffs=5):
+    print(f'turns replayed={len(results)}, errors={sum(1 for result in results if result["error"])}')
+
+    print('\nlatency (ms)                        turns     p50     p95     p99     max   captured p50')
+    for intent_name in sorted({result['intent'] for result in results}):
+        turns = [result for result in results if result['intent'] == intent_name]
+        durations = [result['durationMs'] for result in turns]
+        captured = [result['capturedMs'] for result in turns if result['capturedMs'] is not None]
+        print('{:<34} {:>6} {:>7.2f} {:>7.2f} {:>7.2f} {:>7.2f} {:>14}'.format(
+            intent_name, len(turns), percentile(durations, 0.5), percentile(durations, 0.95), percentile(durations, 0.99), max(durations),
+            '{:.2f}'.format(percentile(captured, 0.5)) if captured else '-'
+        ))
+
+    totals = {}
+    for result in results:
+        for operation_name, count in result['calls'].items():
+            totals[operation_name] = totals.get(operation_name, 0) + count
+
+    print('\nDynamoDB calls                     total  per turn')
+    for operation_name in sorted(totals):
+        print('{:<30} {:>9} {:>9.2f}'.format(operation_name, totals[operation_name], totals[operation_name] / len(results)))
+
+    diffs = [(index, result) for index, result in enumerate(results) if differs(result)]
+    print(f'\nresponses differing from capture={len(diffs)}')
+
+    for index, result in diffs[:show_diffs]:
+        print(f"\n--- turn {index} {result['intent']} ({result['source']})")
+        if result['error'] or result['capturedError']:
+            print(f"captured error={result['capturedError']} replayed error={result['error']}")
+            continue
+        captured = json.dumps(result['captured'], indent=1, sort_keys=True).splitlines()
+        replayed = json.dumps(result['replayed'], indent=1, sort_keys=True).splitlines()
+        print('\n'.join(difflib.unified_diff(captured, replayed, 'captured', 'replayed', lineterm='', n=1)))
+
+    return len(diffs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay captured Lex turns against a handler and the local store')
+    parser.add_argument('capture_file', help='JSON lines written by Bank_Capture.py, or the log lines carrying them')
+    parser.add_argument('--handler', help='MODULE_OR_FILE[:FUNCTION] to replay against, default the captured handler')
+    parser.add_argument('--speed', type=float, default=0, help='replay speed relative to capture, 0 = as fast as possible')
+    parser.add_argument('--cold', action='store_true', help='clear the warm cache before every turn')
+    parser.add_argument('--latency', help='store latency: fixed:MS, lognormal:MEDIAN_MS[:SIGMA[:SEED]] or trace:PATH')
+    parser.add_argument('--fault', action='append', default=[], help='CODE:RATE, e.g. InternalError:0.02 (repeatable)')
+    parser.add_argument('--show-diffs', type=int, default=5, help='differing responses to print')
+    args = parser.parse_args(argv)
+
+    captures = load_captures(args.capture_file)
+    if not captures:
+        print('no captures found')
+        return 0
+
+    handler = load_handler(args.handler) if args.handler else None
+    latency = parse_latency(args.latency) if args.latency else None
+    faults = [(code, float(rate)) for code, _, rate in (fault.rpartition(':') for fault in args.fault)]
+
+    results = replay(captures, handler, args.speed, args.cold, latency, faults)
+
+    return 1 if report(results, args.show_diffs) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,367 @@
+''' Shared Lex V2 response layer: the message catalog and the response envelopes.
+
+Every prompt is a template in MESSAGES, compiled once per container into its
+literal and field parts, for PlainText and for SSML (literal text escaped and
+wrapped in <speak>, or a hand-written SSML variant). Rendering a prompt is a
+join over those parts.
+
+Responses are built from skeletons made once per (dialog action, intent): a
+turn copies the skeleton's sessionState and patches in only what changes,
+its session attributes, slots and messages.
+
+Set BANK_VALIDATE_RESPONSES=1 (tests, Bank_Replay.py) to check every response
+against the Lex V2 response shape before it leaves the builder.
+'''
+
+import os
+import string
+import logging
+from xml.sax.saxutils import escape
+from xml.etree import ElementTree
+
+
+#Configure logger
+logger = logging.getLogger()
+
+
+""" --- Response configuration --- """
+
+#PlainText for chat and Connect's default voice handling, SSML for voice bots that use it
+MESSAGE_CONTENT_TYPE = os.environ.get('BANK_MESSAGE_CONTENT_TYPE', 'PlainText')
+
+#Test mode: every response is checked against the Lex V2 shape, a malformed one raises
+VALIDATE_RESPONSES = os.environ.get('BANK_VALIDATE_RESPONSES', '0') == '1'
+
+#Carries a re-prompt's catalog key to the funnel metrics. Not part of the Lex shape, record_turn takes it off
+REASON_FIELD = 'violationReason'
+
+
+
+""" --- Message catalog --- """
+
+#Prompt templates by key. {field[:format spec]} is filled per turn. A dict gives the
+#PlainText and SSML variants separately, a plain string has its SSML made from it
+MESSAGES = {
+    #Greeting
+    'greeting': 'Nice to meet you {firstName}! How may I help you today?',
+    'first_name_unclear': 'Sorry I did not understand. May you repeat your first name once more.',
+
+    #Account and PIN checks
+    'balance_account_type_unclear': 'Sorry I did not understand. Would you like to get the account balance for your Checking account or your Savings account?',
+    'account_number_invalid': 'Sorry this is not a valid account number. Please enter your twelve digit {accountType} account number',
+    'account_number_unknown': 'Sorry but the account number {accountNumber} does not exist in our database. Please enter your twelve digit account number.',
+    'pin_invalid': 'Sorry this is not a valid pin. Please enter your four digit pin number.',
+    'pin_incorrect': 'The pin number entered is incorrect. Please enter your four digit pin number.',
+    'pin_locked': 'For your security, pin entry is locked after too many incorrect attempts. Please try again later.',
+
+    #Balances and transactions
+    'balance': 'The balance on your account is ${balance:,.2f} dollars. ',
+    'balance_line': 'Your {accountType} account ending in {lastFour} has a balance of ${balance:,.2f} dollars. ',
+    'balance_closing': '{balances}Thank you for banking with Example Bank. We appreciate your business. '
+                       'Please stay on the line if you would like to take our customer experience survey.',
+    'transaction_line': '{kind} of ${amount:,.2f} dollars, {description}, on {day}. ',
+    'transactions_more': 'Say next five to hear more. ',
+    'transactions_none': 'There are no recent transactions on this account. ',
+    'transactions_no_more': 'There are no more transactions on this account. ',
+
+    #Card replacement
+    'card_replaced': 'An email containing your new debit card information is on its way to {email}. '
+                     'Your new debit card ending in {lastFour} will be mailed out to {street}. '
+                     'Please expect it to arrive within five to seven business days.',
+    'card_unavailable': 'Sorry, we are unable to issue a new card right now. Please call back later to request your replacement.',
+
+    #Account opening
+    'open_account_type_unclear': 'Sorry {firstName}, I did not understand. Would you like to open a Checking account or a Savings account?',
+    'ssn_unclear': 'Sorry {firstName}, I did not understand. Could you please repeat your twelve digit Social Security Number.',
+    'last_name_unclear': {
+        'PlainText': 'Sorry {firstName}, I did not understand. May you repeat your last name to me once more? '
+                     'It would help if you could spell it out for me.',
+        'SSML': '<speak>Sorry {firstName}, I did not understand. May you repeat your last name to me once more? '
+                'It would help if you could spell it out for me, like <say-as interpret-as="spell-out">Hello</say-as>.</speak>'
+    },
+    'new_pin_invalid': 'Sorry {firstName}, this is not a valid pin. Please tell us the four digit pin number you would like to use for your account.',
+    'ssn_duplicate': 'Sorry {firstName}, it looks like a {accountType} account has already been opened with this Social Security Number. '
+                     'Please visit a branch or call us back and an agent will help you.',
+    'account_opened': 'Awesome! We have finished processing your information and your new {accountType} is now open and ready for use. '
+                      'You can log in with username {lastName} and the password is the last four of your social. You can change this in settings. '
+                      'Thank you {firstName} for choosing to open an account with Example Bank. We appreciate your business. '
+                      'Please stay on the line if you would like to take part in a customer experience survey.',
+
+    #Survey
+    'survey_thanks': 'Thank you for taking our customer experience survey. Have a great day!',
+
+    #Degraded replies
+    'try_again_account': 'Sorry, we are having trouble reaching your account right now. Please try again shortly.',
+    'try_again_systems': 'Sorry, we are having trouble reaching our systems right now. Please try again shortly.'
+}
+
+CONTENT_TYPES = ('PlainText', 'SSML')
+
+_formatter = string.Formatter()
+
+
+def compile_template(template, escape_literals=False):
+    '''((literal, field or None, format spec), ...) for a template, parsed once'''
+
+    parts = []
+    for literal, field, spec, conversion in _formatter.parse(template):
+        if conversion:
+            raise ValueError(f'conversions are not supported in message templates: {template!r}')
+        parts.append((escape(literal) if escape_literals else literal, field, spec or ''))
+
+    return tuple(parts)
+
+
+def compile_catalog(messages):
+    '''{key: {content type: parts}}, SSML made from the PlainText where no variant is given'''
+
+    compiled = {}
+    for key, template in messages.items():
+        variants = template if isinstance(template, dict) else {'PlainText': template}
+        compiled[key] = {'PlainText': compile_template(variants['PlainText'])}
+        if 'SSML' in variants:
+            compiled[key]['SSML'] = compile_template(variants['SSML'])
+        else:
+            compiled[key]['SSML'] = (('<speak>', None, ''),) + compile_template(variants['PlainText'], escape_literals=True) + (('</speak>', None, ''),)
+
+    return compiled
+
+
+_catalog = compile_catalog(MESSAGES)
+
+
+def render(key, content_type=None, **values):
+    '''The catalog prompt key with values filled in. Values are escaped when rendering SSML'''
+
+    ssml = (content_type or MESSAGE_CONTENT_TYPE) == 'SSML'
+    pieces = []
+
+    for literal, field, spec in _catalog[key]['SSML' if ssml else 'PlainText']:
+        pieces.append(literal)
+        if field is not None:
+            value = format(values[field], spec)
+            pieces.append(escape(value) if ssml else value)
+
+    return ''.join(pieces)
+
+
+def message(key, content_type=None, **values):
+    '''Lex message for the catalog prompt key'''
+
+    content_type = content_type or MESSAGE_CONTENT_TYPE
+
+    return {'contentType': content_type, 'content': render(key, content_type, **values)}
+
+
+def text_message(content, content_type=None):
+    '''Lex message for text already put together (e.g. from several rendered PlainText prompts)'''
+
+    content_type = content_type or MESSAGE_CONTENT_TYPE
+    if content_type == 'SSML':
+        content = '<speak>' + escape(content) + '</speak>'
+
+    return {'contentType': content_type, 'content': content}
+
+
+def build_validation_result(is_valid, violated_slot, message_key=None, **values):
+
+    return {
+        'isValid': is_valid,
+        'violatedSlot': violated_slot,
+        'message': message(message_key, **values) if message_key else None,
+        'reason': message_key
+    }
+
+
+
+""" --- Response envelopes --- """
+
+#What each dialog action fixes in the response. Anything patched per turn is left out
+_ACTION_DEFAULTS = {
+    'Close': {'intent': {'confirmationState': 'Confirmed'}},
+    'ElicitSlot': {'intent': {'confirmationState': 'Denied', 'state': 'InProgress'}},
+    'ConfirmIntent': {'intent': {}},
+    'Delegate': {'intent': {}},
+    'ElicitIntent': {'dialogAction': {'slotToElicit': None}}
+}
+
+#(dialog action, intent name): skeleton, filled as intents are first answered. build_response copies from them
+_skeletons = {}
+
+
+def skeleton(action, intent_name=None):
+    '''The parts of a response that are the same every turn for this dialog action and intent'''
+
+    key = (action, intent_name)
+    found = _skeletons.get(key)
+    if found is not None:
+        return found
+
+    defaults = _ACTION_DEFAULTS[action]
+    session_state = {'dialogAction': dict(defaults.get('dialogAction', {}), type=action)}
+    if 'intent' in defaults:
+        session_state['intent'] = dict(defaults['intent'], name=intent_name)
+
+    _skeletons[key] = session_state
+
+    return session_state
+
+
+def build_response(action, intent_name, session_attributes, message=None, dialog=None, intent=None):
+    '''Response for a dialog action: the skeleton with this turn's attributes, dialog/intent fields and message'''
+
+    base = skeleton(action, intent_name)
+
+    #Shallow copies, so a handler patching its response can never reach the shared skeleton
+    session_state = {'sessionAttributes': session_attributes, 'dialogAction': dict(base['dialogAction'], **(dialog or {}))}
+    if 'intent' in base:
+        session_state['intent'] = dict(base['intent'], **(intent or {}))
+
+    response = {'sessionState': session_state}
+    if message is not None:
+        response['messages'] = [message]
+
+    if VALIDATE_RESPONSES:
+        validate_response(response)
+
+    return response
+
+
+def close(intent_name, session_attributes, fulfillment_state, message):
+    '''Closes/Ends current Lex session with customer'''
+
+    return build_response('Close', intent_name, session_attributes, message, intent={'state': fulfillment_state})
+
+
+def elicit_intent(session_attributes, message):
+    '''Informs Amazon Lex that the user is expected to respond with an utterance that includes an intent. '''
+
+    return build_response('ElicitIntent', None, session_attributes, message)
+
+
+def confirm_intent(session_attributes, intent_name, slots, message):
+    '''Informs Amazon Lex that the user is expected to give a yes or no answer to confirm or deny the current intent'''
+
+    return build_response('ConfirmIntent', intent_name, session_attributes, message, intent={'slots': slots})
+
+
+def elicit_slot(intent_name, slots, violated_slot, session_attributes, message, style=None, reason=None):
+    '''Re-prompts user to provide a slot value in the response. style is a slotElicitationStyle, e.g. SpellByLetter.
+    reason is the catalog key of the prompt, what the funnel counts the re-prompt under'''
+
+    dialog = {'slotToElicit': violated_slot}
+    if style is not None:
+        dialog['slotElicitationStyle'] = style
+
+    response = build_response('ElicitSlot', intent_name, session_attributes, message, dialog=dialog, intent={'slots': slots})
+    if reason is not None:
+        response[REASON_FIELD] = reason
+
+    return response
+
+
+def delegate(intent_name, slots, session_attributes):
+    '''Directs Amazon Lex to choose the next course of action based on the bot configuration. '''
+
+    return build_response('Delegate', intent_name, session_attributes, intent={'slots': slots})
+
+
+
+""" --- Response validation (test mode) --- """
+
+DIALOG_ACTIONS = ('Close', 'ConfirmIntent', 'Delegate', 'ElicitIntent', 'ElicitSlot')
+INTENT_STATES = ('Failed', 'Fulfilled', 'FulfillmentInProgress', 'InProgress', 'ReadyForFulfillment', 'Waiting')
+CONFIRMATION_STATES = ('Confirmed', 'Denied', 'None')
+ELICITATION_STYLES = ('Default', 'SpellByLetter', 'SpellByWord')
+MESSAGE_CONTENT_TYPES = CONTENT_TYPES + ('CustomPayload', 'ImageResponseCard')
+
+
+def _require(condition, problem):
+    if not condition:
+        raise ValueError(f'invalid Lex response: {problem}')
+
+
+def _validate_message(index, message):
+    _require(isinstance(message, dict), f'messages[{index}] is a {type(message).__name__}, not a message')
+    _require(message.get('contentType') in MESSAGE_CONTENT_TYPES, f'messages[{index}].contentType={message.get("contentType")!r}')
+
+    if message['contentType'] == 'ImageResponseCard':
+        _require(isinstance(message.get('imageResponseCard'), dict), f'messages[{index}] has no imageResponseCard')
+        return
+
+    content = message.get('content')
+    _require(isinstance(content, str) and content, f'messages[{index}].content is empty or not a string')
+
+    if message['contentType'] == 'SSML':
+        try:
+            root = ElementTree.fromstring(content)
+        except ElementTree.ParseError as err:
+            raise ValueError(f'invalid Lex response: messages[{index}] is not well-formed SSML ({err})')
+        _require(root.tag == 'speak', f'messages[{index}] SSML is not wrapped in <speak>')
+    else:
+        _require('<speak>' not in content, f'messages[{index}] is SSML sent as {message["contentType"]}')
+
+
+def _validate_slots(slots):
+    _require(isinstance(slots, dict), 'intent.slots is not a map')
+
+    for name, slot in slots.items():
+        if slot is None:
+            continue
+        _require(isinstance(slot, dict), f'slot {name} is not a slot')
+        value = slot.get('value')
+        if value is not None:
+            _require(isinstance(value, dict) and 'interpretedValue' in value, f'slot {name} has no interpretedValue')
+
+
+def validate_response(response):
+    '''Raises ValueError naming the first way response differs from the Lex V2 response shape'''
+
+    _require(isinstance(response, dict), 'response is not a map')
+    _require(set(response) <= {'sessionState', 'messages', 'requestAttributes'}, f'unexpected fields {sorted(set(response) - {"sessionState", "messages", "requestAttributes"})}')
+
+    session_state = response.get('sessionState')
+    _require(isinstance(session_state, dict), 'no sessionState')
+
+    attributes = session_state.get('sessionAttributes') or {}
+    _require(isinstance(attributes, dict), 'sessionAttributes is not a map')
+    for name, value in attributes.items():
+        _require(isinstance(value, str), f'session attribute {name} is a {type(value).__name__}, Lex only takes strings')
+
+    dialog_action = session_state.get('dialogAction')
+    _require(isinstance(dialog_action, dict), 'no dialogAction')
+    action = dialog_action.get('type')
+    _require(action in DIALOG_ACTIONS, f'dialogAction.type={action!r}')
+
+    if dialog_action.get('slotElicitationStyle') is not None:
+        _require(dialog_action['slotElicitationStyle'] in ELICITATION_STYLES, f'slotElicitationStyle={dialog_action["slotElicitationStyle"]!r}')
+
+    intent = session_state.get('intent')
+    if action != 'ElicitIntent':
+        _require(isinstance(intent, dict) and intent.get('name'), f'{action} needs an intent name')
+    if intent is not None:
+        if intent.get('state') is not None:
+            _require(intent['state'] in INTENT_STATES, f'intent.state={intent["state"]!r}')
+        if intent.get('confirmationState') is not None:
+            _require(intent['confirmationState'] in CONFIRMATION_STATES, f'intent.confirmationState={intent["confirmationState"]!r}')
+        if intent.get('slots') is not None:
+            _validate_slots(intent['slots'])
+
+    if action == 'ElicitSlot':
+        slot_to_elicit = dialog_action.get('slotToElicit')
+        _require(isinstance(slot_to_elicit, str) and slot_to_elicit, 'ElicitSlot without slotToElicit')
+        if isinstance(intent.get('slots'), dict):
+            _require(slot_to_elicit in intent['slots'], f'slotToElicit={slot_to_elicit!r} is not one of the intent slots')
+    if action == 'Close':
+        _require(intent.get('state') in ('Failed', 'Fulfilled', 'InProgress'), f'Close with intent.state={intent.get("state")!r}')
+
+    messages = response.get('messages')
+    if messages is not None:
+        _require(isinstance(messages, list), f'messages is a {type(messages).__name__}, not a list')
+        for index, message in enumerate(messages):
+            _validate_message(index, message)
+
+    if action in ('Close', 'ElicitIntent', 'ConfirmIntent'):
+        _require(messages, f'{action} with no message leaves the caller in silence')
+
+    return response
@@ -0,0 +1,185 @@
+''' Compaction report: live versus expired items in the transient tables.
+
+Transient items (idempotency records, PIN attempt counters, finished card
+replacement jobs) live in their own tables with a DynamoDB TTL attribute
+(Bank_Store.TTL_ATTRIBUTES). TTL deletes expired items within a day or two
+of expiry, and until then they still take up reads, scans and exports. The
+report counts each table's live and expired items, items that will never
+expire (no TTL attribute), and whether TTL is enabled at all. Durable tables
+are counted too, and flagged if anything transient has landed in them.
+
+The survey only stores finished responses, which are kept, so it has nothing
+in DynamoDB to expire.
+
+The report scans every table it covers (parallel segments), so run it off-peak.
+Exits 1 if any table needs attention.
+
+Usage: python Bank_Retention.py [--tables NAME ...] [--segments N] [--enable-ttl] [--sweep]
+'''
+
+import sys
+import time
+import logging
+import argparse
+
+from Bank_Store import (
+    TABLE_KEYS, TTL_ATTRIBUTES, LocalResource, get_table, get_table_keys, get_ttl_attribute, get_resource, run_concurrently
+)
+
+
+#Configure logger
+logger = logging.getLogger()
+
+
+""" --- Retention configuration --- """
+
+#Looked for on durable tables, where it means a transient item was written to the wrong table
+TRANSIENT_MARKERS = sorted(set(TTL_ATTRIBUTES.values()))
+
+
+
+""" --- Counting --- """
+
+
+def scan_segment(table_name, segment, total_segments, now):
+    '''{'items', 'live', 'expired', 'noTtl', 'misplaced'} for one parallel Scan segment'''
+
+    ttl_attribute = get_ttl_attribute(table_name)
+    partition_key = get_table_keys(table_name)[0]
+
+    #Only the key and the TTL attribute (or markers) come back, the rest of each item is not needed
+    names = {'#key': partition_key}
+    for index, attribute in enumerate([ttl_attribute] if ttl_attribute else TRANSIENT_MARKERS):
+        names[f'#ttl{index}'] = attribute
+
+    scan_params = {
+        'Segment': segment,
+        'TotalSegments': total_segments,
+        'ProjectionExpression': ', '.join(names),
+        'ExpressionAttributeNames': names
+    }
+    counts = {'items': 0, 'live': 0, 'expired': 0, 'noTtl': 0, 'misplaced': 0}
+
+    while True:
+        response = get_table(table_name).scan(**scan_params)
+
+        for item in response['Items']:
+            counts['items'] += 1
+            if ttl_attribute is None:
+                if any(marker in item for marker in TRANSIENT_MARKERS):
+                    counts['misplaced'] += 1
+            elif ttl_attribute not in item:
+                counts['noTtl'] += 1
+            elif item[ttl_attribute] < now:
+                counts['expired'] += 1
+            else:
+                counts['live'] += 1
+
+        if 'LastEvaluatedKey' not in response:
+            return counts
+        scan_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def ttl_status(table_name):
+    '''DynamoDB's TimeToLiveStatus for the table ('ENABLED', 'DISABLED', ...), 'local' for the stand-in'''
+
+    resource = get_resource()
+    if isinstance(resource, LocalResource):
+        return 'local'
+
+    description = resource.meta.client.describe_time_to_live(TableName=table_name)['TimeToLiveDescription']
+
+    return description['TimeToLiveStatus']
+
+
+def enable_ttl(table_name):
+    resource = get_resource()
+    if isinstance(resource, LocalResource):
+        return
+
+    resource.meta.client.update_time_to_live(
+        TableName=table_name,
+        TimeToLiveSpecification={'Enabled': True, 'AttributeName': get_ttl_attribute(table_name)}
+    )
+
+
+def table_report(table_name, total_segments=4, now=None):
+    now = int(time.time()) if now is None else now
+
+    segments = run_concurrently(*[
+        (lambda segment=segment: scan_segment(table_name, segment, total_segments, now)) for segment in range(total_segments)
+    ])
+
+    row = {name: sum(counts[name] for counts in segments) for name in segments[0]}
+    row['table'] = table_name
+    row['ttlAttribute'] = get_ttl_attribute(table_name)
+    row['ttlStatus'] = ttl_status(table_name) if row['ttlAttribute'] else None
+
+    return row
+
+
+def needs_attention(row):
+    '''What is wrong with a table's retention, None if nothing'''
+
+    if row['ttlAttribute'] is None:
+        return f"{row['misplaced']} transient items in a durable table" if row['misplaced'] else None
+
+    problems = []
+    if row['ttlStatus'] not in ('ENABLED', 'ENABLING', 'local'):
+        problems.append(f"TTL is {row['ttlStatus']}")
+    if row['noTtl']:
+        problems.append(f"{row['noTtl']} items never expire")
+
+    return ', '.join(problems) or None
+
+
+
+""" --- Report --- """
+
+
+def report(rows):
+    print('table                          class       items      live   expired  expired %    no TTL  TTL status')
+
+    attention = 0
+    for row in rows:
+        transient = row['ttlAttribute'] is not None
+        print('{:<30} {:<9} {:>7} {:>9} {:>9} {:>10} {:>9}  {}'.format(
+            row['table'], 'transient' if transient else 'durable', row['items'],
+            row['live'] if transient else '-', row['expired'] if transient else '-',
+            '{:.1f}'.format(100.0 * row['expired'] / row['items']) if transient and row['items'] else '-',
+            row['noTtl'] if transient else '-', row['ttlStatus'] or '-'
+        ))
+
+        problem = needs_attention(row)
+        if problem:
+            attention += 1
+            print(f'    ! {problem}')
+
+    return attention
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Report live versus expired items in the transient tables')
+    parser.add_argument('--tables', nargs='+', default=sorted(TABLE_KEYS), help='tables to report on, default every table')
+    parser.add_argument('--segments', type=int, default=4, help='parallel Scan segments per table')
+    parser.add_argument('--enable-ttl', action='store_true', help='turn TTL on for transient tables that have it off')
+    parser.add_argument('--sweep', action='store_true', help='local stand-in only: delete expired items as TTL would')
+    args = parser.parse_args(argv)
+
+    if args.sweep and isinstance(get_resource(), LocalResource):
+        for table_name in args.tables:
+            print(f'{table_name}: {get_resource().Table(table_name).sweep_expired()} expired items swept')
+
+    rows = [table_report(table_name, args.segments) for table_name in args.tables]
+
+    if args.enable_ttl:
+        for row in rows:
+            if row['ttlAttribute'] and row['ttlStatus'] == 'DISABLED':
+                enable_ttl(row['table'])
+                row['ttlStatus'] = ttl_status(row['table'])
+
+    return 1 if report(rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
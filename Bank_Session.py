@@ -0,0 +1,239 @@
+import os
+import json
+import zlib
+import hmac
+import base64
+import hashlib
+import logging
+from decimal import Decimal
+
+
+#Configure logger
+logger = logging.getLogger()
+
+
+""" --- Session state codec --- """
+
+#All structured state travels in this one session attribute
+SESSION_STATE_KEY = 'bankState'
+SESSION_STATE_VERSION = 'v1'
+
+#Warn well before Lex starts rejecting oversized session attributes
+MAX_SESSION_STATE_BYTES = 10000
+
+
+def _encode_value(value):
+    '''json.dumps default hook: DynamoDB hands us Decimals'''
+
+    if isinstance(value, Decimal):
+        return {'__decimal__': str(value)}
+
+    raise TypeError(f'{type(value).__name__} is not session state serializable')
+
+
+def _decode_value(value):
+    if '__decimal__' in value and len(value) == 1:
+        return Decimal(value['__decimal__'])
+
+    return value
+
+
+def encode_field(value):
+    return json.dumps(value, separators=(',', ':'), default=_encode_value)
+
+
+def decode_field(fragment):
+    return json.loads(fragment, object_hook=_decode_value)
+
+
+def pack(fragments):
+    '''Compresses the encoded fields and returns the versioned attribute value'''
+
+    payload = json.dumps(fragments, separators=(',', ':'))
+    packed = base64.b64encode(zlib.compress(payload.encode('utf-8'), 9)).decode('ascii')
+
+    return SESSION_STATE_VERSION + ':' + packed
+
+
+def unpack(value):
+    '''Reverses pack() into {field: encoded field}. Unknown versions or corrupt values give an empty state'''
+
+    if not value:
+        return {}
+
+    version, _, packed = value.partition(':')
+    if version != SESSION_STATE_VERSION:
+        logger.info(f'Ignoring session state with unsupported version={version}')
+        return {}
+
+    try:
+        return json.loads(zlib.decompress(base64.b64decode(packed)).decode('utf-8'))
+    except (ValueError, zlib.error) as err:
+        logger.info(f'Ignoring unreadable session state: {err}')
+        return {}
+
+
+class SessionState(object):
+    '''Structured session state kept in a single compressed session attribute.
+
+    Each field is stored as its own JSON fragment inside the compressed payload,
+    so a field is only decoded when it is read and only the fields that were
+    set are serialized again on save(). Call touch() after mutating a nested
+    value in place.
+    '''
+
+    _deleted = object()
+
+    def __init__(self, session_attributes):
+        self.session_attributes = session_attributes
+        self._fragments = None
+        self._values = {}
+        self._dirty = set()
+
+
+    def _load(self):
+        if self._fragments is None:
+            self._fragments = unpack(self.session_attributes.get(SESSION_STATE_KEY))
+
+        return self._fragments
+
+
+    def __contains__(self, name):
+        if name in self._values:
+            return self._values[name] is not self._deleted
+
+        return name in self._load()
+
+
+    def __getitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+
+        if name not in self._values:
+            self._values[name] = decode_field(self._fragments[name])
+
+        return self._values[name]
+
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+
+    def __setitem__(self, name, value):
+        self._values[name] = value
+        self._dirty.add(name)
+
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+
+        self._values[name] = self._deleted
+        self._dirty.add(name)
+
+
+    def setdefault(self, name, value):
+        if name not in self:
+            self[name] = value
+
+        return self[name]
+
+
+    def touch(self, name):
+        if name in self:
+            self._dirty.add(name)
+
+
+    def save(self):
+        '''Writes the state back into the session attributes if anything changed'''
+
+        if not self._dirty:
+            return False
+
+        fragments = self._load()
+        for name in self._dirty:
+            if self._values[name] is self._deleted:
+                fragments.pop(name, None)
+            else:
+                fragments[name] = encode_field(self._values[name])
+
+        if fragments:
+            encoded = pack(fragments)
+            if len(encoded) > MAX_SESSION_STATE_BYTES:
+                logger.warning(f'Session state is {len(encoded)} bytes, close to the Lex session attribute limit')
+            self.session_attributes[SESSION_STATE_KEY] = encoded
+        else:
+            self.session_attributes.pop(SESSION_STATE_KEY, None)
+
+        self._dirty.clear()
+
+        return True
+
+
+
+""" --- Per-request helpers --- """
+
+
+def get_session_state(intent_request):
+    '''Returns the SessionState for this turn, created once and cached on the request'''
+
+    state = intent_request.get('_sessionState')
+
+    if state is None:
+        session_attributes = intent_request['sessionState'].setdefault('sessionAttributes', {})
+        state = intent_request['_sessionState'] = SessionState(session_attributes)
+
+    return state
+
+
+def save_session_state(intent_request):
+    '''Re-encodes the turn's SessionState (if it was used) before the response goes back to Lex'''
+
+    state = intent_request.get('_sessionState')
+
+    return state.save() if state is not None else False
+
+
+
+""" --- Verified caller --- """
+
+#Signs the verified-account marker. Lex API callers can set session attributes, so unsigned markers can't be trusted
+SESSION_SECRET = os.environ.get('BANK_SESSION_SECRET', '')
+
+VERIFIED_KEY = 'verifiedAccount'
+
+
+def _verification_signature(intent_request, accountNumber):
+    message = '{}#{}'.format(intent_request['sessionId'], accountNumber).encode('utf-8')
+
+    return hmac.new(SESSION_SECRET.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+
+def mark_verified(intent_request, accountNumber):
+    '''Records that the caller proved this account (account number + PIN) earlier in the session'''
+
+    if not SESSION_SECRET or accountNumber is None:
+        return
+
+    get_session_state(intent_request)[VERIFIED_KEY] = {
+        'accountNumber': str(accountNumber),
+        'signature': _verification_signature(intent_request, accountNumber)
+    }
+
+
+def get_verified_account(intent_request):
+    '''Account number the caller already verified in this session, or None'''
+
+    if not SESSION_SECRET:
+        return None
+
+    verified = get_session_state(intent_request).get(VERIFIED_KEY)
+    if verified is None:
+        return None
+
+    expected = _verification_signature(intent_request, verified['accountNumber'])
+    if not hmac.compare_digest(expected, verified['signature']):
+        logger.info('Ignoring verified account marker with a bad signature')
+        return None
+
+    return verified['accountNumber']
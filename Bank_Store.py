@@ -0,0 +1,1637 @@
+import os
+import math
+import time
+import uuid
+import heapq
+import random
+import re
+import hashlib
+import logging
+import threading
+import copy
+import contextvars
+from decimal import Decimal
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from botocore.exceptions import ClientError, BotoCoreError
+
+
+#Configure logger
+logger = logging.getLogger()
+
+
+""" --- Store configuration --- """
+
+#'dynamodb' talks to AWS, 'local' uses the in-memory stand-in below
+STORE_BACKEND = os.environ.get('BANK_STORE', 'dynamodb')
+
+#Number of shards used for time-keyed (survey/audit) partitions
+TIME_SERIES_SHARDS = int(os.environ.get('BANK_TIME_SERIES_SHARDS', '8'))
+
+#Account tables shared by the Lex handlers, the ledger and the batch jobs
+accounts_tbl_name = 'BankAccountsNew'
+
+#Customer-partitioned copy of each account (CustomerId / AccountType#AccountNumber) for multi-account balance reads
+customer_tbl_name = 'BankCustomerAccounts'
+
+#Posted transactions, newest read first (AccountNumber / PostedAt = ISO timestamp#id)
+transactions_tbl_name = 'BankTransactions'
+
+#(partition key, sort key) for every table the bot touches
+TABLE_KEYS = {
+    'BankAccountsNew': ('AccountNumber', None),
+    'BankCustomerAccounts': ('CustomerId', 'AccountKey'),
+    'BankSurveyResponses': ('SurveyDay', 'ResponseId'),
+    'BankAuditLog': ('AuditDay', 'EventId'),
+    'BankAccountGuards': ('GuardKey', None),
+    'BankIdempotency': ('IdempotencyKey', None),
+    'BankTransactions': ('AccountNumber', 'PostedAt'),
+    'BankLedgerCheckpoints': ('AccountNumber', 'AsOf'),
+    'BankCardPool': ('PoolKey', None),
+    'BankCardReplacementJobs': ('JobId', None),
+    'BankPinAttempts': ('AttemptKey', None),
+}
+
+DEFAULT_TABLE_KEYS = ('AccountNumber', None)
+
+#Tables of transient items and their DynamoDB TTL attribute (epoch seconds). Transient items live only in
+#these tables, so scans and exports of the account tables never wade through them. Bank_Retention.py reports
+TTL_ATTRIBUTES = {
+    'BankIdempotency': 'ExpiresAt',
+    'BankPinAttempts': 'ExpiresAt',
+    'BankCardReplacementJobs': 'ExpiresAt',
+}
+
+#GSI on BankAccountsNew keyed by the caller's phone number (E.164)
+PHONE_INDEX_NAME = os.environ.get('BANK_PHONE_INDEX', 'PhoneNumberIndex')
+
+#Global secondary indexes: {table: {index name: (partition key, sort key)}}
+TABLE_INDEXES = {
+    'BankAccountsNew': {
+        PHONE_INDEX_NAME: ('Phone Number', None),
+    },
+}
+
+#botocore attempts per call (first try included) and socket timeouts. Lex gives the whole turn a few
+#seconds, so a throttled call fails fast and the circuit breaker below decides what happens next
+STORE_MAX_ATTEMPTS = int(os.environ.get('BANK_STORE_MAX_ATTEMPTS', '2'))
+STORE_CONNECT_TIMEOUT = float(os.environ.get('BANK_STORE_CONNECT_TIMEOUT', '1'))
+STORE_READ_TIMEOUT = float(os.environ.get('BANK_STORE_READ_TIMEOUT', '2'))
+
+#Longest one call can take with every attempt timing out, so nothing waiting on a shared read waits longer
+STORE_CALL_TIMEOUT = STORE_MAX_ATTEMPTS * (STORE_CONNECT_TIMEOUT + STORE_READ_TIMEOUT)
+
+#Regions holding a replica of the (global) tables, nearest first. Unset keeps every call in the function's own region
+STORE_REGIONS = [region.strip() for region in os.environ.get('BANK_STORE_REGIONS', '').split(',') if region.strip()]
+
+#Writes go here first, so conditional writes (PIN counters, idempotency, account guards) are decided in one region
+STORE_HOME_REGION = os.environ.get('BANK_STORE_HOME_REGION') or (STORE_REGIONS[0] if STORE_REGIONS else None)
+
+#The region reads prefer. Lambda sets AWS_REGION
+STORE_LOCAL_REGION = os.environ.get('BANK_STORE_LOCAL_REGION') or os.environ.get('AWS_REGION')
+
+_resource = None
+
+
+def get_table_keys(table_name):
+    return TABLE_KEYS.get(table_name, DEFAULT_TABLE_KEYS)
+
+
+def get_ttl_attribute(table_name):
+    '''The table's TTL attribute, None for tables of durable items'''
+
+    return TTL_ATTRIBUTES.get(table_name)
+
+
+def expires_at(seconds, now=None):
+    '''TTL attribute value for an item DynamoDB may delete seconds from now'''
+
+    return int(time.time() if now is None else now) + int(seconds)
+
+
+def get_resource():
+    '''Returns the DynamoDB resource (or local stand-in) shared by the container'''
+
+    global _resource
+
+    if _resource is None:
+        if STORE_BACKEND == 'local':
+            _resource = LocalResource()
+        else:
+            _resource = _dynamodb_resource()
+
+    return _resource
+
+
+def _dynamodb_resource(region_name=None):
+    import boto3
+    from botocore.config import Config
+
+    return boto3.resource('dynamodb', region_name=region_name, config=Config(
+        retries={'max_attempts': STORE_MAX_ATTEMPTS, 'mode': 'standard'},
+        connect_timeout=STORE_CONNECT_TIMEOUT,
+        read_timeout=STORE_READ_TIMEOUT
+    ))
+
+
+def set_resource(resource):
+    '''Swaps the store backend, e.g. for a LocalResource in tests. Returns the previous one'''
+
+    global _resource
+
+    previous = _resource
+    _resource = resource
+
+    #Replicas stood in for the old backend go with it
+    with _regional_resources_lock:
+        _regional_resources.clear()
+
+    return previous
+
+
+def get_table(table_name):
+    '''The table behind its circuit breaker, or behind region routing when replicas are configured'''
+
+    if len(STORE_REGIONS) > 1:
+        return RoutedTable(table_name)
+
+    return GuardedTable(get_resource().Table(table_name), get_breaker(table_name))
+
+
+
+""" --- Circuit breaker --- """
+
+#Failure rate over the sliding window that opens a table's breaker, once it has seen enough calls
+BREAKER_FAILURE_RATE = float(os.environ.get('BANK_BREAKER_FAILURE_RATE', '0.5'))
+BREAKER_MIN_CALLS = int(os.environ.get('BANK_BREAKER_MIN_CALLS', '10'))
+BREAKER_WINDOW = float(os.environ.get('BANK_BREAKER_WINDOW', '10'))
+
+#How long an open breaker sheds calls before letting a half-open probe through
+BREAKER_OPEN_SECONDS = float(os.environ.get('BANK_BREAKER_OPEN_SECONDS', '5'))
+
+#Error codes that mean DynamoDB is overloaded or unwell, rather than that the request was refused
+STORE_FAILURE_CODES = {
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'InternalServerError',
+    'InternalError',
+    'ServiceUnavailable',
+}
+
+#Table operations that go through the breaker
+GUARDED_OPERATIONS = {'get_item', 'put_item', 'update_item', 'delete_item', 'query', 'scan'}
+
+
+class StoreUnavailable(Exception):
+    '''Raised instead of calling DynamoDB while a table's breaker is open'''
+
+
+
+class DeadlineExceeded(StoreUnavailable):
+    '''Raised when a store call would run past the invocation deadline'''
+
+
+
+#The same, as they appear in a cancelled transaction's CancellationReasons
+TRANSACTION_FAILURE_CODES = {'ThrottlingError', 'ProvisionedThroughputExceeded', 'TransactionConflict'}
+
+
+def is_store_failure(err):
+    '''True for throttling, service and connection errors: DynamoDB could not serve the call'''
+
+    if isinstance(err, (StoreUnavailable, BotoCoreError)):
+        return True
+    if isinstance(err, ClientError):
+        code = err.response['Error']['Code']
+        if code == 'TransactionCanceledException':
+            return any(reason.get('Code') in TRANSACTION_FAILURE_CODES for reason in err.response.get('CancellationReasons', []))
+        return code in STORE_FAILURE_CODES
+
+    return False
+
+
+class CircuitBreaker(object):
+    '''Closed -> open when the failure rate over the window is too high -> half-open single probe -> closed.
+
+    Conditional-check failures and other refusals count as successes: DynamoDB
+    answered. Only throttling, service errors and connection errors count against it.
+    '''
+
+    def __init__(self, name, failure_rate=None, min_calls=None, window=None, open_seconds=None, clock=time.monotonic):
+        self.name = name
+        self.failure_rate = BREAKER_FAILURE_RATE if failure_rate is None else failure_rate
+        self.min_calls = BREAKER_MIN_CALLS if min_calls is None else min_calls
+        self.window = BREAKER_WINDOW if window is None else window
+        self.open_seconds = BREAKER_OPEN_SECONDS if open_seconds is None else open_seconds
+        self.clock = clock
+        self.state = 'closed'
+        self.opened_at = None
+        self.probing = False
+        self.outcomes = deque()
+        self.lock = threading.Lock()
+
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'open':
+                if self.clock() - self.opened_at < self.open_seconds:
+                    return False
+                self.state = 'half_open'
+                self.probing = False
+
+            if self.state == 'half_open':
+                if self.probing:
+                    return False
+                self.probing = True
+
+            return True
+
+
+    def record(self, failed):
+        with self.lock:
+            now = self.clock()
+
+            if self.state == 'half_open':
+                self.probing = False
+                if failed:
+                    self._open(now)
+                else:
+                    logger.info(f'circuit {self.name} closed')
+                    self.state = 'closed'
+                    self.outcomes.clear()
+                return
+
+            self.outcomes.append((now, failed))
+            while self.outcomes and self.outcomes[0][0] < now - self.window:
+                self.outcomes.popleft()
+
+            failures = sum(1 for _, outcome in self.outcomes if outcome)
+            if self.state == 'closed' and len(self.outcomes) >= self.min_calls and failures >= self.failure_rate * len(self.outcomes):
+                self._open(now)
+
+
+    def _open(self, now):
+        logger.info(f'circuit {self.name} opened')
+        self.state = 'open'
+        self.opened_at = now
+        self.outcomes.clear()
+
+
+    @contextmanager
+    def guard(self):
+        '''Wraps one store call (sync or awaited): sheds it while open, records how it went otherwise'''
+
+        if not self.allow():
+            raise StoreUnavailable(f'{self.name} is unavailable, circuit open')
+
+        try:
+            yield
+        except DeadlineExceeded:
+            #Our invocation ran out of time, which says nothing about the table's health
+            self.release()
+            raise
+        except Exception as err:
+            self.record(is_store_failure(err))
+            raise
+        else:
+            self.record(False)
+
+
+    def release(self):
+        '''Ends a call without an outcome. A half-open probe lets the next call probe instead'''
+
+        with self.lock:
+            if self.state == 'half_open':
+                self.probing = False
+
+
+    def call(self, func, *args, **kwargs):
+        with self.guard():
+            return func(*args, **kwargs)
+
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(table_name):
+    with _breakers_lock:
+        if table_name not in _breakers:
+            _breakers[table_name] = CircuitBreaker(table_name)
+
+        return _breakers[table_name]
+
+
+def reset_breakers():
+    with _breakers_lock:
+        _breakers.clear()
+
+
+
+class GuardedTable(object):
+    '''Table proxy that sends reads and writes through the table's circuit breaker'''
+
+    def __init__(self, table, breaker):
+        self._table = table
+        self._breaker = breaker
+
+
+    def __getattr__(self, name):
+        attribute = getattr(self._table, name)
+        if name not in GUARDED_OPERATIONS:
+            return attribute
+
+        return lambda *args, **kwargs: call_within_deadline(self._breaker, name, attribute, *args, **kwargs)
+
+
+
+""" --- Region routing across global table replicas --- """
+
+#Served by any replica. A strongly consistent read is only consistent in the region written to, so it is routed like a write
+READ_OPERATIONS = {'get_item', 'query', 'scan'}
+
+#Simulated latency per region for the local stand-in replicas, e.g. 'us-east-1=fixed:3,us-west-2=lognormal:70'
+LOCAL_REGION_LATENCY = os.environ.get('BANK_LOCAL_REGION_LATENCY')
+
+_regional_resources = {}
+_regional_resources_lock = threading.Lock()
+
+
+def set_store_regions(regions, home_region=None, local_region=None):
+    '''Replaces the replica regions (nearest first), e.g. in tests. An empty list turns routing off'''
+
+    global STORE_REGIONS, STORE_HOME_REGION, STORE_LOCAL_REGION
+
+    STORE_REGIONS = list(regions)
+    STORE_HOME_REGION = home_region or (STORE_REGIONS[0] if STORE_REGIONS else None)
+    STORE_LOCAL_REGION = local_region or STORE_LOCAL_REGION
+
+    with _regional_resources_lock:
+        _regional_resources.clear()
+
+
+def read_regions():
+    '''Replica regions in the order reads try them: this function's own region first, then nearest first'''
+
+    if not STORE_REGIONS:
+        return [None]
+    if STORE_LOCAL_REGION in STORE_REGIONS:
+        return [STORE_LOCAL_REGION] + [region for region in STORE_REGIONS if region != STORE_LOCAL_REGION]
+
+    return list(STORE_REGIONS)
+
+
+def write_regions():
+    '''The home region, then the other replicas in read order for failover'''
+
+    if not STORE_REGIONS:
+        return [None]
+
+    return [STORE_HOME_REGION] + [region for region in read_regions() if region != STORE_HOME_REGION]
+
+
+def replica_name(table_name, region):
+    '''Breaker name for one region's replica, so a failing region is shed without shedding the others'''
+
+    return table_name if region is None else f'{table_name}@{region}'
+
+
+def parse_region_latency(spec):
+    '''{region: distribution} from 'region=latency spec,...' (see parse_latency)'''
+
+    latencies = {}
+    for entry in (spec or '').split(','):
+        if entry.strip():
+            region, _, latency = entry.partition('=')
+            latencies[region.strip()] = parse_latency(latency.strip())
+
+    return latencies
+
+
+def get_regional_resource(region):
+    '''The resource (own client, own connection pool) for one region's replicas. None is the default resource'''
+
+    if region is None:
+        return get_resource()
+
+    with _regional_resources_lock:
+        resource = _regional_resources.get(region)
+        if resource is not None:
+            return resource
+
+    if STORE_BACKEND == 'local' or isinstance(_resource, LocalResource):
+        #Stand-in replicas share the backend's items, each with its own latency, faults and call counts
+        resource = LocalResource(replica_of=get_resource(), latency=parse_region_latency(LOCAL_REGION_LATENCY).get(region))
+    else:
+        resource = _dynamodb_resource(region)
+
+    with _regional_resources_lock:
+        return _regional_resources.setdefault(region, resource)
+
+
+def call_with_failover(table_name, regions, call):
+    '''call(resource, breaker) against each region's replica in turn until one answers.
+
+    Only store failures (throttling, service errors, an open breaker) move on to
+    the next region. Refusals such as a failed condition are the answer, and a
+    call out of invocation time has no time left to fail over with.
+    '''
+
+    for index, region in enumerate(regions):
+        try:
+            return call(get_regional_resource(region), get_breaker(replica_name(table_name, region)))
+        except Exception as err:
+            if isinstance(err, DeadlineExceeded) or not is_store_failure(err) or index == len(regions) - 1:
+                raise
+            logger.info(f'{table_name}: {region} failed ({err!r}), failing over to {regions[index + 1]}')
+
+
+class RoutedTable(object):
+    '''Table proxy for a global table: reads go to the nearest replica, writes (and strongly
+    consistent reads) to the home region, each failing over to the next-nearest replica'''
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+
+
+    def __getattr__(self, name):
+        if name not in GUARDED_OPERATIONS:
+            #batch_writer and the like stay with the home region
+            return getattr(get_regional_resource(write_regions()[0]).Table(self.table_name), name)
+
+        def routed(*args, **kwargs):
+            regions = read_regions() if name in READ_OPERATIONS and not kwargs.get('ConsistentRead') else write_regions()
+
+            return call_with_failover(
+                self.table_name,
+                regions,
+                lambda resource, breaker: call_within_deadline(breaker, name, getattr(resource.Table(self.table_name), name), *args, **kwargs)
+            )
+
+        return routed
+
+
+
+""" --- Local DynamoDB stand-in --- """
+
+
+def client_error(code, message, operation_name):
+    '''Builds the same ClientError botocore raises for a failed DynamoDB call'''
+
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation_name)
+
+
+def evaluate_condition(condition, item):
+    '''Evaluates a boto3 Key()/Attr() condition against a plain item dict'''
+
+    expression = condition.get_expression()
+    operator = expression['operator']
+    values = expression['values']
+
+    if operator == 'AND':
+        return all(evaluate_condition(value, item) for value in values)
+    if operator == 'OR':
+        return any(evaluate_condition(value, item) for value in values)
+    if operator == 'NOT':
+        return not evaluate_condition(values[0], item)
+
+    name = values[0].name
+    present = name in item
+    current = item.get(name)
+
+    if operator == 'attribute_exists':
+        return present
+    if operator == 'attribute_not_exists':
+        return not present
+    if not present:
+        return operator == '<>'
+    if operator == '=':
+        return current == values[1]
+    if operator == '<>':
+        return current != values[1]
+    if operator == '<':
+        return current < values[1]
+    if operator == '<=':
+        return current <= values[1]
+    if operator == '>':
+        return current > values[1]
+    if operator == '>=':
+        return current >= values[1]
+    if operator == 'BETWEEN':
+        return values[1] <= current <= values[2]
+    if operator == 'begins_with':
+        return str(current).startswith(values[1])
+    if operator == 'contains':
+        return values[1] in current
+    if operator == 'IN':
+        return current in values[1]
+
+    raise ValueError('Condition operator ' + operator + ' not supported by the local store')
+
+
+def project_item(item, projection, attribute_names=None):
+    '''Applies a ProjectionExpression ("a, #b") to an item'''
+
+    if not projection:
+        return item
+
+    attribute_names = attribute_names or {}
+    names = [attribute_names.get(name.strip(), name.strip()) for name in projection.split(',')]
+
+    return {name: item[name] for name in names if name in item}
+
+
+def split_top_level(text, separator=','):
+    '''Splits on separator outside of parentheses ("a = if_not_exists(a, :z), b = :b")'''
+
+    parts, depth, current = [], 0, ''
+    for char in text:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        if char == separator and depth == 0:
+            parts.append(current.strip())
+            current = ''
+        else:
+            current += char
+
+    if current.strip():
+        parts.append(current.strip())
+
+    return parts
+
+
+def _update_operand(token, item, names, values):
+    token = token.strip()
+
+    if token.startswith(':'):
+        return copy.deepcopy(values[token])
+
+    if token.startswith('if_not_exists(') and token.endswith(')'):
+        path, default = split_top_level(token[len('if_not_exists('):-1])
+        name = names.get(path, path)
+        return copy.deepcopy(item[name]) if name in item else _update_operand(default, item, names, values)
+
+    name = names.get(token, token)
+    if name not in item:
+        raise client_error('ValidationException', f'The provided expression refers to an attribute that does not exist in the item: {name}', 'UpdateItem')
+
+    return copy.deepcopy(item[name])
+
+
+def _split_arithmetic(value):
+    '''"a + :b" -> ("a", "+", ":b"); no top-level + or - -> (value, None, None)'''
+
+    depth = 0
+    for index, char in enumerate(value):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char in '+-' and depth == 0 and index > 0:
+            return value[:index].strip(), char, value[index + 1:].strip()
+
+    return value, None, None
+
+
+def apply_update_expression(item, expression, names=None, values=None):
+    '''Applies the SET / ADD / REMOVE subset of UpdateExpression the bot uses to an item, in place'''
+
+    names = names or {}
+    values = values or {}
+
+    clauses = re.split(r'\b(SET|ADD|REMOVE|DELETE)\b', expression, flags=re.IGNORECASE)
+
+    for action, body in zip(clauses[1::2], clauses[2::2]):
+        action = action.upper()
+
+        for part in split_top_level(body):
+            if action == 'SET':
+                path, value = [side.strip() for side in part.split('=', 1)]
+                left, operator, right = _split_arithmetic(value)
+                if operator is None:
+                    item[names.get(path, path)] = _update_operand(value, item, names, values)
+                else:
+                    left = _update_operand(left, item, names, values)
+                    right = _update_operand(right, item, names, values)
+                    item[names.get(path, path)] = left + right if operator == '+' else left - right
+
+            elif action == 'ADD':
+                path, value = part.split(None, 1)
+                name = names.get(path, path)
+                increment = _update_operand(value, item, names, values)
+                if isinstance(increment, set):
+                    item[name] = set(item.get(name, set())) | increment
+                else:
+                    item[name] = item.get(name, 0) + increment
+
+            elif action == 'REMOVE':
+                item.pop(names.get(part, part), None)
+
+            else:
+                name = names.get(part.split(None, 1)[0], part.split(None, 1)[0])
+                item[name] = set(item.get(name, set())) - _update_operand(part.split(None, 1)[1], item, names, values)
+
+    return item
+
+
+""" --- Simulated latency and faults for the local stand-in --- """
+
+
+class FixedLatency(object):
+    '''Every call takes ms milliseconds'''
+
+    def __init__(self, ms):
+        self.seconds = ms / 1000.0
+
+
+    def sample(self):
+        return self.seconds
+
+
+
+class LognormalLatency(object):
+    '''Right-skewed round trips like real DynamoDB calls: median_ms is the typical call, sigma sets how long the tail is.
+
+    Seeded, so a run draws the same latencies every time.
+    '''
+
+    def __init__(self, median_ms, sigma=0.5, seed=0):
+        self.mu = math.log(median_ms / 1000.0)
+        self.sigma = sigma
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+
+    def sample(self):
+        with self.lock:
+            return self.random.lognormvariate(self.mu, self.sigma)
+
+
+
+class TraceLatency(object):
+    '''Replays latencies measured in production (milliseconds) in order, wrapping round at the end'''
+
+    def __init__(self, samples_ms):
+        if not samples_ms:
+            raise ValueError('A latency trace needs at least one sample')
+
+        self.samples = [sample / 1000.0 for sample in samples_ms]
+        self.position = 0
+        self.lock = threading.Lock()
+
+
+    @classmethod
+    def from_file(cls, path):
+        '''One latency in milliseconds per line, e.g. exported SuccessfulRequestLatency samples'''
+
+        with open(path) as trace_file:
+            return cls([float(line) for line in trace_file if line.strip()])
+
+
+    def sample(self):
+        with self.lock:
+            seconds = self.samples[self.position]
+            self.position = (self.position + 1) % len(self.samples)
+
+        return seconds
+
+
+def parse_latency(spec):
+    '''Latency distribution from a spec: fixed:MS, lognormal:MEDIAN_MS[:SIGMA[:SEED]] or trace:PATH'''
+
+    kind, _, arguments = spec.partition(':')
+
+    if kind == 'fixed':
+        return FixedLatency(float(arguments))
+    if kind == 'lognormal':
+        parts = arguments.split(':')
+        sigma = float(parts[1]) if len(parts) > 1 else 0.5
+        seed = int(parts[2]) if len(parts) > 2 else 0
+        return LognormalLatency(float(parts[0]), sigma, seed)
+    if kind == 'trace':
+        return TraceLatency.from_file(arguments)
+
+    raise ValueError(f'Unknown latency distribution {spec!r}')
+
+
+WRITE_OPERATIONS = ('PutItem', 'UpdateItem', 'DeleteItem', 'BatchWriteItem', 'TransactWriteItems')
+
+#Latency every local table starts with, e.g. BANK_LOCAL_LATENCY=lognormal:12:0.6 for benchmarks
+LOCAL_LATENCY = os.environ.get('BANK_LOCAL_LATENCY')
+
+
+
+class LocalTable(object):
+    '''In-memory stand-in for a boto3 DynamoDB Table.
+
+    partition_wcu / partition_rcu cap the writes / reads one partition key
+    accepts per second, the same way a hot DynamoDB partition throttles.
+    inject_throttling() makes the next calls fail as throttled outright,
+    inject_faults() fails calls with any error code, set_latency() slows
+    calls down and inject_unprocessed() makes batch writes come back partial.
+    '''
+
+    def __init__(self, name, partition_key=None, sort_key=None, partition_wcu=None, partition_rcu=None, clock=time.monotonic):
+        default_partition_key, default_sort_key = get_table_keys(name)
+
+        self.name = name
+        self.partition_key = partition_key or default_partition_key
+        self.sort_key = sort_key if partition_key else default_sort_key
+        self.indexes = dict(TABLE_INDEXES.get(name, {}))
+        self.ttl_attribute = get_ttl_attribute(name)
+        self.partition_wcu = partition_wcu
+        self.partition_rcu = partition_rcu
+        self.clock = clock
+        self.items = {}
+        self.consumed = {}
+        self.throttled = {'read': 0, 'write': 0}
+        self.calls = {}
+        self.throttle_next = 0
+        self.latency = {None: parse_latency(LOCAL_LATENCY)} if LOCAL_LATENCY else {}
+        self.faults = []
+        self.unprocessed_rate = 0.0
+        self.random = random.Random(0)
+        self.lock = threading.RLock()
+
+
+    def inject_throttling(self, count):
+        '''The next count calls raise ProvisionedThroughputExceededException'''
+
+        with self.lock:
+            self.throttle_next = count
+
+
+    def set_latency(self, distribution, *operation_names):
+        '''Every call (or only the named operations, e.g. 'GetItem') waits a sample from distribution. None removes it'''
+
+        for operation_name in operation_names or (None,):
+            if distribution is None:
+                self.latency.pop(operation_name, None)
+            else:
+                self.latency[operation_name] = distribution
+
+
+    def inject_faults(self, code, count=None, rate=None, operation_names=None, seed=0):
+        '''Fails the next count calls, or a seeded rate of all calls, with a ClientError carrying code.
+
+        operation_names limits the fault to some operations. InternalError and
+        ServiceUnavailable are what DynamoDB returns when it is failing rather than throttling.
+        '''
+
+        with self.lock:
+            self.faults.append({
+                'code': code,
+                'remaining': count,
+                'rate': rate,
+                'operation_names': set(operation_names) if operation_names else None,
+                'random': random.Random(seed)
+            })
+
+
+    def inject_unprocessed(self, rate, seed=0):
+        '''Leaves a seeded rate of every BatchWriteItem's requests in UnprocessedItems, as a throttled table does'''
+
+        with self.lock:
+            self.unprocessed_rate = rate
+            self.random = random.Random(seed)
+
+
+    def clear_faults(self):
+        with self.lock:
+            self.throttle_next = 0
+            self.faults = []
+            self.unprocessed_rate = 0.0
+
+
+    def sweep_expired(self, now=None):
+        '''Deletes expired items the way DynamoDB's TTL process does (eventually, unlike reads). Returns how many'''
+
+        if self.ttl_attribute is None:
+            return 0
+
+        now = time.time() if now is None else now
+
+        with self.lock:
+            expired = [
+                key for key, item in self.items.items()
+                if isinstance(item.get(self.ttl_attribute), (int, float, Decimal)) and item[self.ttl_attribute] < now
+            ]
+            for key in expired:
+                del self.items[key]
+
+        return len(expired)
+
+
+    def _simulate_latency(self, operation_name):
+        #Sleeps outside the table lock, so concurrent calls overlap as they would on the network
+        distribution = self.latency.get(operation_name) or self.latency.get(None)
+        if distribution is not None:
+            time.sleep(distribution.sample())
+
+
+    def _item_key(self, item):
+        partition = item[self.partition_key]
+        sort = item[self.sort_key] if self.sort_key else None
+        return (partition, sort)
+
+
+    def _count_call(self, operation_name):
+        self.calls[operation_name] = self.calls.get(operation_name, 0) + 1
+
+        if self.throttle_next:
+            self.throttle_next -= 1
+            self.throttled['write' if operation_name in WRITE_OPERATIONS else 'read'] += 1
+            raise client_error('ProvisionedThroughputExceededException', f'Injected throttling on {self.name}', operation_name)
+
+        for fault in self.faults:
+            if fault['operation_names'] is not None and operation_name not in fault['operation_names']:
+                continue
+            if fault['remaining'] is not None:
+                if fault['remaining'] <= 0:
+                    continue
+                fault['remaining'] -= 1
+            elif fault['random'].random() >= fault['rate']:
+                continue
+
+            if fault['code'] == 'ProvisionedThroughputExceededException':
+                self.throttled['write' if operation_name in WRITE_OPERATIONS else 'read'] += 1
+            raise client_error(fault['code'], f"Injected {fault['code']} on {self.name}", operation_name)
+
+
+    def _consume(self, kind, partition, operation_name, units=1):
+        '''Charges capacity to a partition and throttles it once its per-second budget is spent'''
+
+        limit = self.partition_wcu if kind == 'write' else self.partition_rcu
+        if limit is None: return
+
+        window = int(self.clock())
+        bucket_window, used = self.consumed.get((kind, partition), (window, 0))
+        if bucket_window != window:
+            used = 0
+
+        if used + units > limit:
+            self.throttled[kind] += 1
+            raise client_error(
+                'ProvisionedThroughputExceededException',
+                f'Partition {partition} of {self.name} exceeded {limit} {kind}s per second',
+                operation_name
+            )
+
+        self.consumed[(kind, partition)] = (window, used + units)
+
+
+    def get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None, ConsistentRead=False):
+        self._simulate_latency('GetItem')
+
+        with self.lock:
+            self._count_call('GetItem')
+            self._consume('read', Key[self.partition_key], 'GetItem')
+            item = self.items.get(self._item_key(Key))
+
+        if item is None:
+            return {}
+
+        return {'Item': project_item(copy.deepcopy(item), ProjectionExpression, ExpressionAttributeNames)}
+
+
+    def put_item(self, Item, ConditionExpression=None):
+        self._simulate_latency('PutItem')
+
+        with self.lock:
+            self._count_call('PutItem')
+            self._consume('write', Item[self.partition_key], 'PutItem')
+
+            key = self._item_key(Item)
+            if ConditionExpression is not None and not evaluate_condition(ConditionExpression, self.items.get(key, {})):
+                raise client_error('ConditionalCheckFailedException', 'The conditional request failed', 'PutItem')
+
+            self.items[key] = copy.deepcopy(Item)
+
+        return {}
+
+
+    def delete_item(self, Key, ConditionExpression=None):
+        self._simulate_latency('DeleteItem')
+
+        with self.lock:
+            self._count_call('DeleteItem')
+            self._consume('write', Key[self.partition_key], 'DeleteItem')
+
+            key = self._item_key(Key)
+            if ConditionExpression is not None and not evaluate_condition(ConditionExpression, self.items.get(key, {})):
+                raise client_error('ConditionalCheckFailedException', 'The conditional request failed', 'DeleteItem')
+
+            self.items.pop(key, None)
+
+        return {}
+
+
+    def query(self, KeyConditionExpression, IndexName=None, FilterExpression=None, ScanIndexForward=True, Limit=None,
+              ExclusiveStartKey=None, ProjectionExpression=None, ExpressionAttributeNames=None, ConsistentRead=False):
+        partition_key, sort_key = self.partition_key, self.sort_key
+        if IndexName is not None:
+            if IndexName not in self.indexes:
+                raise client_error('ValidationException', f'The table does not have the specified index: {IndexName}', 'Query')
+            partition_key, sort_key = self.indexes[IndexName]
+
+        self._simulate_latency('Query')
+
+        with self.lock:
+            self._count_call('Query')
+            #Like a sparse GSI, items without the index keys are simply not in it
+            matched = [
+                item for item in self.items.values()
+                if partition_key in item and (sort_key is None or sort_key in item)
+                and evaluate_condition(KeyConditionExpression, item)
+            ]
+            for partition in set(item[partition_key] for item in matched):
+                self._consume('read', partition, 'Query')
+
+        if sort_key:
+            matched.sort(key=lambda item: item[sort_key], reverse=not ScanIndexForward)
+
+        if ExclusiveStartKey is not None:
+            start = self._item_key(ExclusiveStartKey)
+            keys = [self._item_key(item) for item in matched]
+            matched = matched[keys.index(start) + 1:] if start in keys else matched
+
+        last_evaluated_key = None
+        if Limit is not None and len(matched) > Limit:
+            matched = matched[:Limit]
+            last = matched[-1]
+            last_evaluated_key = {
+                name: last[name] for name in (self.partition_key, self.sort_key, partition_key, sort_key) if name
+            }
+
+        scanned = len(matched)
+        if FilterExpression is not None:
+            matched = [item for item in matched if evaluate_condition(FilterExpression, item)]
+
+        response = {
+            'Items': [project_item(copy.deepcopy(item), ProjectionExpression, ExpressionAttributeNames) for item in matched],
+            'Count': len(matched),
+            'ScannedCount': scanned
+        }
+        if last_evaluated_key is not None:
+            response['LastEvaluatedKey'] = last_evaluated_key
+
+        return response
+
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+                    ConditionExpression=None, ReturnValues='NONE'):
+        self._simulate_latency('UpdateItem')
+
+        with self.lock:
+            self._count_call('UpdateItem')
+            self._consume('write', Key[self.partition_key], 'UpdateItem')
+
+            key = self._item_key(Key)
+            old_item = self.items.get(key)
+            if ConditionExpression is not None and not evaluate_condition(ConditionExpression, old_item or {}):
+                raise client_error('ConditionalCheckFailedException', 'The conditional request failed', 'UpdateItem')
+
+            item = copy.deepcopy(old_item) if old_item is not None else dict(Key)
+            apply_update_expression(item, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+            self.items[key] = item
+
+        if ReturnValues == 'ALL_NEW':
+            return {'Attributes': copy.deepcopy(item)}
+        if ReturnValues == 'ALL_OLD':
+            return {'Attributes': copy.deepcopy(old_item)} if old_item is not None else {}
+        if ReturnValues == 'UPDATED_NEW':
+            return {'Attributes': {name: copy.deepcopy(value) for name, value in item.items() if (old_item or {}).get(name) != value}}
+
+        return {}
+
+
+    def scan(self, FilterExpression=None, Limit=None, ExclusiveStartKey=None, ProjectionExpression=None,
+             ExpressionAttributeNames=None, Segment=None, TotalSegments=None, ConsistentRead=False):
+        self._simulate_latency('Scan')
+
+        with self.lock:
+            self._count_call('Scan')
+            keys = sorted(self.items, key=repr)
+            if TotalSegments:
+                keys = [key for key in keys if shard_suffix(TotalSegments, repr(key)) == Segment]
+            if ExclusiveStartKey is not None:
+                start = self._item_key(ExclusiveStartKey)
+                keys = keys[keys.index(start) + 1:] if start in keys else keys
+
+            last_evaluated_key = None
+            if Limit is not None and len(keys) > Limit:
+                keys = keys[:Limit]
+                last = self.items[keys[-1]]
+                last_evaluated_key = {name: last[name] for name in (self.partition_key, self.sort_key) if name}
+
+            scanned = [copy.deepcopy(self.items[key]) for key in keys]
+
+        matched = [item for item in scanned if FilterExpression is None or evaluate_condition(FilterExpression, item)]
+
+        response = {
+            'Items': [project_item(item, ProjectionExpression, ExpressionAttributeNames) for item in matched],
+            'Count': len(matched),
+            'ScannedCount': len(scanned)
+        }
+        if last_evaluated_key is not None:
+            response['LastEvaluatedKey'] = last_evaluated_key
+
+        return response
+
+
+    def batch_write(self, requests):
+        '''One BatchWriteItem call for up to 25 ('put', item) / ('delete', key) requests.
+
+        Returns the requests left unprocessed, the way DynamoDB hands back
+        UnprocessedItems instead of failing the call when partitions throttle.
+        '''
+
+        self._simulate_latency('BatchWriteItem')
+
+        unprocessed = []
+
+        with self.lock:
+            self._count_call('BatchWriteItem')
+
+            for kind, value in requests:
+                if self.unprocessed_rate and self.random.random() < self.unprocessed_rate:
+                    unprocessed.append((kind, value))
+                    continue
+                try:
+                    self._consume('write', value[self.partition_key], 'BatchWriteItem')
+                except ClientError:
+                    unprocessed.append((kind, value))
+                    continue
+
+                if kind == 'put':
+                    self.items[self._item_key(value)] = copy.deepcopy(value)
+                else:
+                    self.items.pop(self._item_key(value), None)
+
+        return unprocessed
+
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return LocalBatchWriter(self)
+
+
+
+class LocalBatchWriter(object):
+    '''Stand-in for Table.batch_writer(): buffers puts/deletes and flushes them 25 at a time'''
+
+    def __init__(self, table):
+        self.table = table
+        self.pending = []
+
+
+    def put_item(self, Item):
+        self.pending.append(('put', Item))
+        if len(self.pending) >= 25:
+            self.flush()
+
+
+    def delete_item(self, Key):
+        self.pending.append(('delete', Key))
+        if len(self.pending) >= 25:
+            self.flush()
+
+
+    def flush(self):
+        #Like boto3, unprocessed requests are sent again until everything is written
+        pending, self.pending = self.pending, []
+        while pending:
+            batch, pending = pending[:25], pending[25:]
+            pending = self.table.batch_write(batch) + pending
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+
+
+class LocalResource(object):
+    '''In-memory stand-in for boto3.resource('dynamodb').
+
+    replica_of makes it another region's replica of that resource's tables:
+    the same items (replication is instant), but its own latency, faults and
+    call counts. latency is a distribution every table's calls wait.
+    '''
+
+    def __init__(self, replica_of=None, latency=None, **table_defaults):
+        self.tables = {}
+        self.table_defaults = table_defaults
+        self.replica_of = replica_of
+        self.latency = latency
+        self.request_tokens = replica_of.request_tokens if replica_of is not None else {}
+        self.lock = threading.RLock()
+
+
+    def _new_table(self, name, partition_key=None, sort_key=None, **settings):
+        table = LocalTable(name, partition_key, sort_key, **settings)
+
+        if self.replica_of is not None:
+            primary = self.replica_of.Table(name)
+            table.partition_key, table.sort_key, table.indexes = primary.partition_key, primary.sort_key, primary.indexes
+            table.items, table.lock = primary.items, primary.lock
+        if self.latency is not None:
+            table.set_latency(self.latency)
+
+        return table
+
+
+    def create_table(self, name, partition_key=None, sort_key=None, **options):
+        settings = dict(self.table_defaults)
+        settings.update(options)
+
+        with self.lock:
+            self.tables[name] = self._new_table(name, partition_key, sort_key, **settings)
+
+        return self.tables[name]
+
+
+    def Table(self, name):
+        with self.lock:
+            if name not in self.tables:
+                self.tables[name] = self._new_table(name, **self.table_defaults)
+
+            return self.tables[name]
+
+
+    def transact_write(self, actions, client_request_token=None):
+        '''All-or-nothing Put/Update/Delete/ConditionCheck across tables, see transact_write() below'''
+
+        fingerprint = repr([
+            (kind, params.get('TableName'), params.get('Item'), params.get('Key'), params.get('ExpressionAttributeValues'))
+            for action in actions for kind, params in action.items()
+        ])
+
+        with self.lock:
+            if client_request_token is not None and client_request_token in self.request_tokens:
+                if self.request_tokens[client_request_token] != fingerprint:
+                    raise client_error('IdempotentParameterMismatchException', 'Request token reused with different parameters', 'TransactWriteItems')
+                return {}
+
+        tables = sorted(set(params['TableName'] for action in actions for params in action.values()))
+        locks = [self.Table(name).lock for name in tables]
+
+        self.Table(tables[0])._simulate_latency('TransactWriteItems')
+
+        for lock in locks:
+            lock.acquire()
+        try:
+            reasons = []
+            for action in actions:
+                (kind, params), = action.items()
+                table = self.Table(params['TableName'])
+                table._count_call('TransactWriteItems')
+                key = table._item_key(params['Item'] if kind == 'Put' else params['Key'])
+                if kind != 'ConditionCheck':
+                    table._consume('write', key[0], 'TransactWriteItems', 2)
+                condition = params.get('ConditionExpression')
+                if condition is not None and not evaluate_condition(condition, table.items.get(key, {})):
+                    reasons.append({'Code': 'ConditionalCheckFailed', 'Message': 'The conditional request failed'})
+                else:
+                    reasons.append({'Code': 'None'})
+
+            if any(reason['Code'] != 'None' for reason in reasons):
+                error = client_error('TransactionCanceledException', 'Transaction cancelled', 'TransactWriteItems')
+                error.response['CancellationReasons'] = reasons
+                raise error
+
+            for action in actions:
+                (kind, params), = action.items()
+                table = self.Table(params['TableName'])
+                if kind == 'Put':
+                    table.items[table._item_key(params['Item'])] = copy.deepcopy(params['Item'])
+                elif kind == 'Update':
+                    key = table._item_key(params['Key'])
+                    item = copy.deepcopy(table.items[key]) if key in table.items else dict(params['Key'])
+                    apply_update_expression(
+                        item, params['UpdateExpression'], params.get('ExpressionAttributeNames'), params.get('ExpressionAttributeValues')
+                    )
+                    table.items[key] = item
+                elif kind == 'Delete':
+                    table.items.pop(table._item_key(params['Key']), None)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+        if client_request_token is not None:
+            with self.lock:
+                self.request_tokens[client_request_token] = fingerprint
+
+        return {}
+
+
+
+def transact_write(actions, client_request_token=None):
+    '''TransactWriteItems written the resource way: native values and boto3 Attr() conditions.
+
+    actions look like [{'Put': {'TableName': ..., 'Item': {...}, 'ConditionExpression': Attr(...)}}]
+    ('Delete' / 'ConditionCheck' take 'Key', 'Update' adds UpdateExpression and its
+    ExpressionAttributeNames / Values). Failed conditions raise the usual
+    TransactionCanceledException ClientError with its CancellationReasons.
+    '''
+
+    def attempt(resource, breaker):
+        if isinstance(resource, LocalResource):
+            return breaker.call(resource.transact_write, actions, client_request_token)
+
+        return breaker.call(resource.meta.client.transact_write_items, **transact_write_params(actions, client_request_token))
+
+    #A transaction is only atomic within the region that applies it, so it goes where the other writes go
+    return call_with_failover(next(iter(actions[0].values()))['TableName'], write_regions(), attempt)
+
+
+def transact_write_params(actions, client_request_token=None):
+    '''transact_write() actions as low-level TransactWriteItems parameters'''
+
+    from boto3.dynamodb.types import TypeSerializer
+    from boto3.dynamodb.conditions import ConditionExpressionBuilder
+
+    serializer = TypeSerializer()
+    builder = ConditionExpressionBuilder()
+
+    transact_items = []
+    for action in actions:
+        (kind, params), = action.items()
+        request = {'TableName': params['TableName']}
+        for name in ('Item', 'Key'):
+            if name in params:
+                request[name] = {attribute: serializer.serialize(value) for attribute, value in params[name].items()}
+
+        names = dict(params.get('ExpressionAttributeNames') or {})
+        values = dict(params.get('ExpressionAttributeValues') or {})
+        if 'UpdateExpression' in params:
+            request['UpdateExpression'] = params['UpdateExpression']
+        if params.get('ConditionExpression') is not None:
+            expression = builder.build_expression(params['ConditionExpression'])
+            request['ConditionExpression'] = expression.condition_expression
+            names.update(expression.attribute_name_placeholders)
+            values.update(expression.attribute_value_placeholders)
+        if names:
+            request['ExpressionAttributeNames'] = names
+        if values:
+            request['ExpressionAttributeValues'] = {placeholder: serializer.serialize(value) for placeholder, value in values.items()}
+        transact_items.append({kind: request})
+
+    params = {'TransactItems': transact_items}
+    if client_request_token is not None:
+        params['ClientRequestToken'] = client_request_token
+
+    return params
+
+
+
+""" --- Concurrent store calls --- """
+
+#One pool per container, shared by every handler that fans out independent store calls
+IO_WORKERS = int(os.environ.get('BANK_IO_WORKERS', '8'))
+
+_io_executor = None
+_io_executor_lock = threading.Lock()
+_io_thread = threading.local()
+
+
+def get_io_executor():
+    global _io_executor
+
+    with _io_executor_lock:
+        if _io_executor is None:
+            _io_executor = ThreadPoolExecutor(
+                max_workers=IO_WORKERS,
+                thread_name_prefix='bank-io',
+                initializer=_mark_io_thread
+            )
+
+    return _io_executor
+
+
+def _mark_io_thread():
+    _io_thread.active = True
+
+
+def submit_io(func, *args, **kwargs):
+    '''Starts one store call on the shared executor and returns its Future'''
+
+    #Carries the caller's invocation deadline into the worker thread
+    context = contextvars.copy_context()
+
+    return get_io_executor().submit(context.run, func, *args, **kwargs)
+
+
+def run_concurrently(*calls):
+    '''Runs independent zero-argument store calls at once and returns their results in order.
+
+    Wall time is the slowest call rather than the sum of them. If any call
+    raises, the first exception (in call order) is re-raised once all have
+    finished. Calls made from inside an executor thread run inline so nested
+    fan-outs can never starve the pool.
+    '''
+
+    if len(calls) < 2 or getattr(_io_thread, 'active', False):
+        return [call() for call in calls]
+
+    futures = [submit_io(call) for call in calls]
+
+    return [future.result() for future in futures]
+
+
+
+""" --- Invocation deadline --- """
+
+#Kept back from the Lambda's remaining time so there is always room to build a reply for Lex
+DEADLINE_MARGIN = float(os.environ.get('BANK_DEADLINE_MARGIN_MS', '500')) / 1000
+
+#Optional work (caller lookup) is skipped once less than this is left
+OPTIONAL_WORK_MIN = float(os.environ.get('BANK_OPTIONAL_WORK_MIN_MS', '1000')) / 1000
+
+_deadline = contextvars.ContextVar('bank_deadline', default=None)
+
+
+@contextmanager
+def invocation_deadline(context, margin=None):
+    '''Sets the deadline for everything the invocation does from the Lambda context.
+
+    No context (scripts, benchmarks) means no deadline.
+    '''
+
+    margin = DEADLINE_MARGIN if margin is None else margin
+
+    deadline = None
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - margin
+
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_time():
+    '''Seconds left before the invocation deadline, None if there is none'''
+
+    deadline = _deadline.get()
+
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def has_time_for(seconds=None):
+    '''Whether optional work taking about seconds still fits before the deadline'''
+
+    remaining = remaining_time()
+
+    return remaining is None or remaining >= (OPTIONAL_WORK_MIN if seconds is None else seconds)
+
+
+def bounded_wait(timeout):
+    '''timeout, cut short to what is left of the invocation'''
+
+    remaining = remaining_time()
+
+    return timeout if remaining is None else max(0.0, min(timeout, remaining))
+
+
+#Store calls that may be left running when the deadline passes: reads, and deletes, which land the same however late.
+#put_item / update_item are not (an ADD, or an item with a generated key, would apply twice), nor is transact_write,
+#which never goes through here and carries a ClientRequestToken where it matters
+ABANDONABLE_OPERATIONS = {'get_item', 'query', 'scan', 'delete_item'}
+
+
+def call_within_deadline(breaker, operation, func, *args, **kwargs):
+    '''One store call through its breaker, abandoned with DeadlineExceeded if it outlives the invocation.
+
+    botocore timeouts are fixed per client, so the per-call bound is enforced
+    by waiting on the executor for only the remaining time. The abandoned call
+    finishes in the background within the client's own read timeout, which is
+    why only ABANDONABLE_OPERATIONS are abandoned: a write that landed after the
+    caller was told to try again would be applied a second time by the retry.
+    Other writes are only refused before they start, then run to completion.
+    '''
+
+    remaining = remaining_time()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceeded(f'{breaker.name}: no time left for the call')
+
+    #Nested calls already run on a worker whose caller is waiting with the deadline
+    if remaining is None or operation not in ABANDONABLE_OPERATIONS or getattr(_io_thread, 'active', False):
+        return breaker.call(func, *args, **kwargs)
+
+    with breaker.guard():
+        future = submit_io(func, *args, **kwargs)
+        try:
+            return future.result(timeout=remaining)
+        except FutureTimeoutError:
+            raise DeadlineExceeded(f'{breaker.name}: call did not finish within {remaining:.3f}s')
+
+
+
+""" --- Sharded time-series keys --- """
+
+
+def shard_suffix(shard_count=None, hash_key=None):
+    '''Picks a shard, at random or by hashing hash_key so related writes land together'''
+
+    shard_count = shard_count or TIME_SERIES_SHARDS
+
+    if hash_key is None:
+        return random.randrange(shard_count)
+
+    digest = hashlib.md5(str(hash_key).encode('utf-8')).hexdigest()
+
+    return int(digest, 16) % shard_count
+
+
+def sharded_key(base_key, shard_count=None, hash_key=None):
+    return f'{base_key}#{shard_suffix(shard_count, hash_key)}'
+
+
+def all_sharded_keys(base_key, shard_count=None):
+    shard_count = shard_count or TIME_SERIES_SHARDS
+
+    return [f'{base_key}#{shard}' for shard in range(shard_count)]
+
+
+def write_time_series_item(table_name, items, day=None, shard_count=None, hash_key=None):
+    '''Writes a survey/audit record under a sharded day partition so one day never becomes one hot key'''
+
+    partition_key, sort_key = get_table_keys(table_name)
+
+    day = day or time.strftime('%Y-%m-%d')
+
+    items = dict(items)
+    items[partition_key] = sharded_key(day, shard_count, hash_key)
+    if sort_key and sort_key not in items:
+        #Timestamp first so records from all shards merge back in time order
+        items[sort_key] = '{}#{}'.format(time.strftime('%Y-%m-%dT%H:%M:%S'), uuid.uuid4().hex)
+
+    get_table(table_name).put_item(Item=items)
+
+    return items
+
+
+def query_partition(table_name, partition_value, **query_params):
+    '''Reads every page of a single partition'''
+
+    from boto3.dynamodb.conditions import Key
+
+    partition_key, sort_key = get_table_keys(table_name)
+    table = get_table(table_name)
+
+    items = []
+    params = dict(query_params)
+    params['KeyConditionExpression'] = Key(partition_key).eq(partition_value)
+
+    while True:
+        response = table.query(**params)
+        items.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return items
+        params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def query_time_series(table_name, day, shard_count=None, **query_params):
+    '''Scatter-gather read: queries every shard of a day in parallel and merges them by sort key'''
+
+    partition_key, sort_key = get_table_keys(table_name)
+    keys = all_sharded_keys(day, shard_count)
+
+    shards = run_concurrently(*[
+        (lambda key=key: query_partition(table_name, key, **query_params)) for key in keys
+    ])
+
+    if not sort_key:
+        return [item for shard in shards for item in shard]
+
+    return list(heapq.merge(*shards, key=lambda item: item[sort_key]))
+
+
+
+""" --- Warm cache --- """
+
+#Seconds an item read by this container may be served again without a DynamoDB round trip
+WARM_CACHE_TTL = float(os.environ.get('BANK_WARM_CACHE_TTL', '30'))
+
+#Most entries a container keeps. Past it the least recently used go first, so a busy container's memory stays flat
+WARM_CACHE_MAX_ENTRIES = int(os.environ.get('BANK_WARM_CACHE_MAX_ENTRIES', '4096'))
+
+#Least recently used first
+_warm_cache = OrderedDict()
+_inflight_reads = {}
+_warm_cache_lock = threading.Lock()
+
+
+def _cache_key(table_name, key):
+    return (table_name, tuple(sorted(key.items())))
+
+
+def warm_cache_get(table_name, key):
+    cache_key = _cache_key(table_name, key)
+
+    with _warm_cache_lock:
+        entry = _warm_cache.get(cache_key)
+        if entry is None:
+            return None
+
+        #Expired entries go as soon as they are looked up, not only on a warm-up sweep
+        if entry[0] < time.monotonic():
+            del _warm_cache[cache_key]
+            return None
+
+        _warm_cache.move_to_end(cache_key)
+
+    return entry[1]
+
+
+def warm_cache_put(table_name, key, item, ttl=None):
+    expires = time.monotonic() + (WARM_CACHE_TTL if ttl is None else ttl)
+    cache_key = _cache_key(table_name, key)
+
+    with _warm_cache_lock:
+        _warm_cache[cache_key] = (expires, item)
+        _warm_cache.move_to_end(cache_key)
+
+        while len(_warm_cache) > WARM_CACHE_MAX_ENTRIES:
+            _warm_cache.popitem(last=False)
+
+
+def warm_cache_invalidate(table_name, key):
+    with _warm_cache_lock:
+        _warm_cache.pop(_cache_key(table_name, key), None)
+
+
+def warm_cache_clear():
+    with _warm_cache_lock:
+        _warm_cache.clear()
+
+
+def warm_cache_sweep():
+    '''Drops expired entries and returns how many are still live'''
+
+    now = time.monotonic()
+
+    with _warm_cache_lock:
+        for key in [key for key, entry in _warm_cache.items() if entry[0] < now]:
+            del _warm_cache[key]
+
+        return len(_warm_cache)
+
+
+def breaker_states():
+    with _breakers_lock:
+        return {name: breaker.state for name, breaker in _breakers.items()}
+
+
+def get_cached_item(table_name, key, **get_params):
+    '''GetItem through the warm cache. Returns None if the item does not exist.
+
+    Concurrent misses on the same key share one GetItem instead of each
+    issuing their own.
+    '''
+
+    item = warm_cache_get(table_name, key)
+    if item is not None:
+        return item
+
+    #Only whole items are cached, a projected read would hide the other attributes
+    if 'ProjectionExpression' in get_params:
+        return get_table(table_name).get_item(Key=key, **get_params).get('Item')
+
+    cache_key = _cache_key(table_name, key)
+    with _warm_cache_lock:
+        inflight = _inflight_reads.get(cache_key)
+        leader = inflight is None
+        if leader:
+            inflight = _inflight_reads[cache_key] = {'done': threading.Event()}
+
+    if not leader:
+        if not inflight['done'].wait(bounded_wait(STORE_CALL_TIMEOUT)):
+            raise DeadlineExceeded(f'{table_name}: shared read did not finish in time')
+        if 'error' in inflight:
+            raise inflight['error']
+        return inflight['item']
+
+    try:
+        item = inflight['item'] = get_table(table_name).get_item(Key=key, **get_params).get('Item')
+        if item is not None:
+            warm_cache_put(table_name, key, item)
+    except Exception as err:
+        inflight['error'] = err
+        raise
+    finally:
+        with _warm_cache_lock:
+            _inflight_reads.pop(cache_key, None)
+        inflight['done'].set()
+
+    return item
@@ -0,0 +1,310 @@
+import asyncio
+import logging
+from decimal import Decimal
+
+import Bank_Store
+from Bank_Store import ABANDONABLE_OPERATIONS, LocalResource, DeadlineExceeded, get_resource, get_breaker, remaining_time, warm_cache_get, warm_cache_put
+
+
+#Configure logger
+logger = logging.getLogger()
+
+
+""" --- Async store interface --- """
+
+
+class AccountStore(object):
+    '''Async access to the bank tables. Backends implement _request, calls go through the table's circuit breaker'''
+
+    _inflight = None
+
+    async def request(self, table_name, operation, **params):
+        '''One table call with boto3 resource arguments and response, e.g. request(name, 'update_item', Key=...)'''
+
+        return await self._call(table_name, operation, self._request(table_name, operation, params))
+
+
+    async def get_item(self, table_name, key, consistent_read=False):
+        params = {'Key': key, 'ConsistentRead': True} if consistent_read else {'Key': key}
+
+        return (await self.request(table_name, 'get_item', **params)).get('Item')
+
+
+    async def put_item(self, table_name, item):
+        await self.request(table_name, 'put_item', Item=item)
+
+        return True
+
+
+    async def _call(self, table_name, operation, coroutine):
+        '''Awaits one store call through the table's breaker, giving up at the invocation deadline.
+        Like Bank_Store.call_within_deadline, only ABANDONABLE_OPERATIONS are given up once started'''
+
+        breaker = get_breaker(table_name)
+        remaining = remaining_time()
+
+        if remaining is not None and remaining <= 0:
+            coroutine.close()
+            raise DeadlineExceeded(f'{table_name}: no time left for the call')
+
+        try:
+            with breaker.guard():
+                try:
+                    return await asyncio.wait_for(coroutine, remaining if operation in ABANDONABLE_OPERATIONS else None)
+                except asyncio.TimeoutError:
+                    raise DeadlineExceeded(f'{table_name}: call did not finish within {remaining:.3f}s')
+        finally:
+            #An open circuit refuses the call before it starts, the unstarted coroutine is dropped
+            coroutine.close()
+
+
+    async def _request(self, table_name, operation, params):
+        raise NotImplementedError
+
+
+    async def get_cached_item(self, table_name, key):
+        '''get_item through the container warm cache shared with the sync handlers.
+
+        Concurrent misses on one key within an invocation await the same read.
+        '''
+
+        item = warm_cache_get(table_name, key)
+        if item is not None:
+            return item
+
+        if self._inflight is None:
+            self._inflight = {}
+        inflight = self._inflight
+        cache_key = (table_name, tuple(sorted(key.items())))
+
+        task = inflight.get(cache_key)
+        if task is None:
+            task = inflight[cache_key] = asyncio.ensure_future(self.get_item(table_name, key))
+            task.add_done_callback(lambda _: inflight.pop(cache_key, None))
+
+        item = await asyncio.shield(task)
+        if item is not None:
+            warm_cache_put(table_name, key, item)
+
+        return item
+
+
+    async def get_account_item(self, table_name, accountNumber):
+        if accountNumber is None:
+            return None
+
+        return await self.get_cached_item(table_name, {'AccountNumber': Decimal(accountNumber)})
+
+
+
+class LocalAsyncStore(AccountStore):
+    '''In-memory async stand-in backed by the sync LocalResource.
+
+    latency (seconds, or a distribution from Bank_Store such as LognormalLatency)
+    is awaited before every call to mimic a DynamoDB round trip. Leave latency off
+    the resource's tables, their sleeps would block the event loop.
+    '''
+
+    def __init__(self, resource=None, latency=0.0):
+        self.resource = resource or LocalResource()
+        self.latency = latency
+
+
+    async def _round_trip(self):
+        delay = self.latency.sample() if hasattr(self.latency, 'sample') else self.latency
+        if delay:
+            await asyncio.sleep(delay)
+
+
+    async def _request(self, table_name, operation, params):
+        await self._round_trip()
+
+        return getattr(self.resource.Table(table_name), operation)(**params)
+
+
+
+class AioDynamoStore(AccountStore):
+    '''aiobotocore backend. The client is opened lazily and reused while its event loop lives'''
+
+    def __init__(self, region_name=None):
+        self.region_name = region_name
+        self._client = None
+        self._client_context = None
+        self._loop = None
+
+
+    async def _get_client(self):
+        loop = asyncio.get_running_loop()
+
+        #A client is bound to the loop it was opened on. The async handler keeps one loop per container,
+        #so this only reopens when a caller brings its own loop (e.g. asyncio.run in a benchmark)
+        if self._client is not None and self._loop is not loop:
+            self._client = None
+
+        if self._client is None:
+            from aiobotocore.config import AioConfig
+            from aiobotocore.session import get_session
+
+            config = AioConfig(
+                retries={'max_attempts': Bank_Store.STORE_MAX_ATTEMPTS, 'mode': 'standard'},
+                connect_timeout=Bank_Store.STORE_CONNECT_TIMEOUT,
+                read_timeout=Bank_Store.STORE_READ_TIMEOUT
+            )
+            self._client_context = get_session().create_client('dynamodb', region_name=self.region_name, config=config)
+            self._client = await self._client_context.__aenter__()
+            self._loop = loop
+
+        return self._client
+
+
+    async def close(self):
+        if self._client_context is not None:
+            await self._client_context.__aexit__(None, None, None)
+        self._client = self._client_context = None
+
+
+    async def _request(self, table_name, operation, params):
+        client = await self._get_client()
+        response = await getattr(client, operation)(**client_params(table_name, params))
+
+        return resource_response(response)
+
+
+
+""" --- boto3 resource <-> client translation (what boto3's Table does for the sync handlers) --- """
+
+
+_CONDITION_PARAMS = ('KeyConditionExpression', 'ConditionExpression', 'FilterExpression')
+
+_ITEM_PARAMS = ('Key', 'Item', 'ExclusiveStartKey')
+
+_ITEM_RESPONSES = ('Item', 'Attributes', 'LastEvaluatedKey')
+
+
+def client_params(table_name, params):
+    '''Client-level arguments for resource-style ones: typed values, condition objects built into expressions'''
+
+    from boto3.dynamodb.conditions import ConditionExpressionBuilder
+    from boto3.dynamodb.types import TypeSerializer
+
+    serializer = TypeSerializer()
+    builder = ConditionExpressionBuilder()
+
+    request = {'TableName': table_name}
+    names = dict(params.get('ExpressionAttributeNames') or {})
+    values = dict(params.get('ExpressionAttributeValues') or {})
+
+    for name, value in params.items():
+        if name in ('ExpressionAttributeNames', 'ExpressionAttributeValues'):
+            continue
+
+        if name in _CONDITION_PARAMS and not isinstance(value, str):
+            built = builder.build_expression(value, is_key_condition=name == 'KeyConditionExpression')
+            names.update(built.attribute_name_placeholders)
+            values.update(built.attribute_value_placeholders)
+            value = built.condition_expression
+        elif name in _ITEM_PARAMS:
+            value = {attribute: serializer.serialize(attribute_value) for attribute, attribute_value in value.items()}
+
+        request[name] = value
+
+    if names:
+        request['ExpressionAttributeNames'] = names
+    if values:
+        request['ExpressionAttributeValues'] = {name: serializer.serialize(value) for name, value in values.items()}
+
+    return request
+
+
+def resource_response(response):
+    from boto3.dynamodb.types import TypeDeserializer
+
+    deserializer = TypeDeserializer()
+
+    def deserialize(item):
+        return {name: deserializer.deserialize(value) for name, value in item.items()}
+
+    for name in _ITEM_RESPONSES:
+        if name in response:
+            response[name] = deserialize(response[name])
+    if 'Items' in response:
+        response['Items'] = [deserialize(item) for item in response['Items']]
+
+    return response
+
+
+
+""" --- Write-behind --- """
+
+
+class WriteBehind(object):
+    '''Collects writes that don't affect the reply so they overlap with the rest of the turn'''
+
+    def __init__(self):
+        self.tasks = []
+
+
+    def submit(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.append(task)
+
+        return task
+
+
+    async def drain(self, timeout=None):
+        '''Waits for every pending write (at most timeout seconds, the rest are cancelled).
+
+        Failures are logged, never raised into the Lex reply.
+        '''
+
+        if not self.tasks:
+            return []
+
+        tasks, self.tasks = self.tasks, []
+
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            logger.info(f'write-behind cancelled at the deadline: {task!r}')
+            task.cancel()
+
+        results = []
+        for task in tasks:
+            if task in pending:
+                results.append(None)
+            elif task.cancelled():
+                results.append(None)
+            else:
+                results.append(task.exception() or task.result())
+
+        for result in results:
+            if isinstance(result, Exception):
+                logger.info(f'write-behind failed: {result!r}')
+
+        return results
+
+
+
+_store = None
+
+
+def get_async_store():
+    '''Async counterpart of Bank_Store.get_resource(): local stand-in or aiobotocore'''
+
+    global _store
+
+    if _store is None:
+        if Bank_Store.STORE_BACKEND == 'local':
+            _store = LocalAsyncStore(get_resource())
+        else:
+            _store = AioDynamoStore()
+
+    return _store
+
+
+def set_async_store(store):
+    global _store
+
+    previous = _store
+    _store = store
+
+    return previous
@@ -5,15 +5,27 @@ import boto3
 import logging
 from decimal import Decimal
 
+from Bank_Capture import capture_turns
+from Bank_Funnel import run_tracked
+from Bank_Fuzzy import SURVEY_RATINGS, YES_NO, normalize_choice_slots
+from Bank_Idempotency import run_idempotent, idempotency_tbl_name
+from Bank_Responses import close, delegate, message
+from Bank_Session import save_session_state
+from Bank_Store import get_table, write_time_series_item, query_time_series, is_store_failure, invocation_deadline
+from Bank_Warmup import handle_warmups
+
 
 #Configure logger
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
 
-#Initialize DynamoDB resource
-dyn_resource = boto3.resource('dynamodb')
+#DynamoDB tables (set BANK_STORE=local to use the in-memory stand-in from Bank_Store)
 tbl_name = 'BankAccountsNew'
+survey_tbl_name = 'BankSurveyResponses'
+
+#Survey answers, resolved to their canonical choice even when slightly misheard
+CHOICE_SLOTS = {'rating': SURVEY_RATINGS, 'recommend': YES_NO}
 
 
 
@@ -29,88 +41,30 @@ def get_slots(intent_request):
 #     else:
 #         return None 
 
-def get_session_attributes(intent_request):
-    sessionState = intent_request['sessionState']
-    if 'sessionAttributes' in sessionState:
-        return sessionState['sessionAttributes']
-    
-    return {}
-
-def elicit_slot(session_attributes, intent_name, slots, slot_to_elicit, message):
-    return {
-        'messages': [
-            message
-        ],
-        'sessionState': {
-            'sessionAttributes': session_attributes,
-            'dialogAction': {
-                'type': 'ElicitSlot',            
-                'slotToElicit': slot_to_elicit
-            },
-            'intent': {
-                'name': intent_name,
-                'slots': slots
-            }
-        }
-    }
+def get_slot_value(slots, slotName):
+    '''interpretedValue of a slot, or None if Lex has not filled it yet'''
 
+    slot = try_ex(lambda: slots[slotName])
+    if slot is None:
+        return None
 
-def confirm_intent(session_attributes, intent_name, slots, message):
-    return {
-        'messages': [
-            message
-        ],
-        'sessionState': {
-            'sessionAttributes': session_attributes,
-            'dialogAction': {
-                'type': 'ConfirmIntent'
-            },
-            'intent': {
-                'name': intent_name,
-                'slots': slots
-            }
-        }
-    }
+    return try_ex(lambda: slot['value']['interpretedValue'])
 
 
-def close(session_attributes, intent_name, fulfillment_state, message):
-    response = {
-        'messages': [
-            message
-        ],
-        'sessionState': {
-            'dialogAction': {
-                'type': 'Close'           
-            },
-            'sessionAttributes': session_attributes,
-            'intent': {
-                'name': intent_name,
-                'state': fulfillment_state
-            }
-        }
-    }
+def get_session_attributes(intent_request):
+    '''Flat Lex session attributes. Structured state lives in Bank_Session.get_session_state'''
 
-    return response
+    #setdefault so anything written here (e.g. the packed session state) reaches the response
+    return intent_request['sessionState'].setdefault('sessionAttributes', {})
 
+''' --- Validation Functions --- '''
 
-def delegate(session_attributes, intent_name, slots):
-    return {
-        'sessionState': {
-            'dialogAction': {
-                'type': 'Delegate'           
-            },
-            'sessionAttributes': session_attributes,
-            'intent': {
-                'name': intent_name,
-                'slots': slots
-            }
-        }
-    }
+def try_again_later(intent_request):
+    '''Degraded but valid reply for when the tables are shedding load'''
 
-''' --- Validation Functions --- '''
+    intent_name = intent_request['sessionState']['intent']['name']
 
-def build_validation_result():
-    pass 
+    return close(intent_name, get_session_attributes(intent_request), 'Failed', message('try_again_systems'))
 
 
 
@@ -137,15 +91,14 @@ def write_item_dynamodb(table_name, items):
 
     from botocore.exceptions import ClientError
 
-    table = dyn_resource.Table(table_name)
+    table = get_table(table_name)
 
     try:
         response = table.put_item(Item=items)
     except ClientError as err:
-        if err.response['Error']['Code'] == 'InternalError':
-            logger.info('Error Message: {}'.format(err.response['Error']['Message']))
-        else:
-            raise err
+        #InternalError included: botocore has already retried it, reporting the write as done would lose it
+        logger.info('Error Message: {}'.format(err.response['Error']['Message']))
+        raise err
 
     return True
     
@@ -155,7 +108,7 @@ def validate_account_dynamodb(table_name, accountNumber):
     
     if accountNumber is None: return False
 
-    table = dyn_resource.Table(table_name)
+    table = get_table(table_name)
 
     try:
         response = table.get_item(Key={
@@ -167,6 +120,19 @@ def validate_account_dynamodb(table_name, accountNumber):
     return True
 
 
+def write_survey_response(items, sessionId=None):
+    '''Stores a survey response under a sharded day partition (see Bank_Store.write_time_series_item)'''
+
+    #Hashing on the session keeps one caller's answers on the same shard
+    return write_time_series_item(survey_tbl_name, items, hash_key=sessionId)
+
+
+def get_survey_responses(day):
+    '''Returns every survey response for a day (YYYY-MM-DD), merged across shards in time order'''
+
+    return query_time_series(survey_tbl_name, day)
+
+
 def generate_account_number():
 
     import uuid
@@ -204,6 +170,27 @@ def OpenAccount(intent_request):
     
 
 
+def Survey(intent_request):
+
+    #Initialize required response parameters
+    intent_name = intent_request['sessionState']['intent']['name']
+    session_attributes = get_session_attributes(intent_request)
+    slots = get_slots(intent_request)
+
+    #Both answers are plain choices (normalized before dispatch), Lex elicits them itself
+    if intent_request['invocationSource'] == 'DialogCodeHook':
+        return delegate(intent_name, slots, session_attributes)
+
+    answers = {
+        'SessionId': intent_request['sessionId'],
+        'Rating': get_slot_value(slots, 'rating'),
+        'Recommend': get_slot_value(slots, 'recommend')
+    }
+    write_survey_response({name: value for name, value in answers.items() if value is not None}, intent_request['sessionId'])
+
+    return close(intent_name, session_attributes, 'Fulfilled', message('survey_thanks'))
+
+
 ''' --- INTENTS --- '''
 
 
@@ -214,11 +201,35 @@ def dispatch(intent_request):
     #Dispatch to bot's intent handlers
     if intent_name == 'OpenAccount':
         return OpenAccount(intent_request)
+    if intent_name == 'Survey':
+        return Survey(intent_request)
 
 
 ''' --- MAIN handler --- '''
 
 
+def handle_turn(intent_request):
+    '''One Lex turn: dispatch, then fold per-turn state back into the response'''
+
+    normalize_choice_slots(intent_request, CHOICE_SLOTS)
+
+    #Counts the turn (and any re-prompt) toward the call's funnel metrics
+    response = run_tracked(intent_request, dispatch)
+
+    #Only re-encodes the packed session state if a handler changed it
+    save_session_state(intent_request)
+
+    return response
+
+
+
+#Tables whose connections a keep-warm ping opens
+WARM_TABLES = (tbl_name, survey_tbl_name, idempotency_tbl_name)
+
+
+#Keep-warm pings are answered before anything reads the Lex fields
+@handle_warmups(WARM_TABLES)
+@capture_turns
 def lambda_handler(event, context):
     
     # By default, treat the user request as coming from the America/New_York time zone.
@@ -234,7 +245,17 @@ def lambda_handler(event, context):
     logger.info(f'event.bot.name={bot_name}, userMessage={userMessage}, inputType={inputType}')
 
 
-    return dispatch(event)
+    #Every store call below is bounded by the time Lambda has left
+    with invocation_deadline(context):
+        #Lex retries fulfillment on timeout, so a retried turn can't store the same answers twice
+        try:
+            return run_idempotent(event, handle_turn)
+        except Exception as err:
+            if not is_store_failure(err):
+                raise err
+            #Throttled, out of time, or the circuit is open: answer now rather than let Lex time out
+            logger.info(f'shedding turn: {err!r}')
+            return try_again_later(event)
 
 
 
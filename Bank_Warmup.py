@@ -0,0 +1,173 @@
+''' Keep-warm pings for the Lex handlers.
+
+A scheduled EventBridge rule (or any caller) invokes the function with
+{"warmer": true, "concurrency": N}. The handler answers without touching
+the Lex code path, opens DynamoDB connections for the tables it uses,
+starts the IO pool and sweeps the warm cache. With N > 1 the first
+container invokes the function N - 1 more times at once (each holding for
+delayMs so they can't share a container), so N containers are hot before
+a call-center peak. Fan-out needs lambda:InvokeFunction on the function itself.
+
+Every warm-up response reports the container's age and warm state, so the
+warmer can count how many distinct containers it reached.
+'''
+
+import os
+import json
+import time
+import uuid
+import logging
+import functools
+from decimal import Decimal
+
+from Bank_Store import (
+    GuardedTable, get_breaker, get_regional_resource, get_table_keys, get_io_executor, submit_io, run_concurrently,
+    read_regions, replica_name, warm_cache_sweep, breaker_states
+)
+
+
+#Configure logger
+logger = logging.getLogger()
+
+
+""" --- Warm-up configuration --- """
+
+#Containers a plain scheduled event keeps hot, a warmer event can ask for its own number
+WARM_CONCURRENCY = int(os.environ.get('BANK_WARM_CONCURRENCY', '1'))
+
+#How long each fanned-out warm-up holds its container, so the others can't land on it
+WARM_HOLD_MS = int(os.environ.get('BANK_WARM_HOLD_MS', '100'))
+
+CONTAINER_ID = uuid.uuid4().hex[:12]
+CONTAINER_STARTED = time.time()
+
+_stats = {'invocations': 0, 'warmups': 0, 'lastWarmup': None}
+
+
+
+""" --- Warm-up --- """
+
+
+def is_warmup_event(event):
+    '''Our own warmer payload, or a bare EventBridge scheduled event. Lex events always carry a bot'''
+
+    if not isinstance(event, dict) or 'bot' in event:
+        return False
+
+    return bool(event.get('warmer')) or event.get('detail-type') == 'Scheduled Event'
+
+
+def _sentinel_key(table_name):
+    '''A key no item has. Reading it costs half a read unit and opens a pooled connection'''
+
+    #Every key attribute is a string except the account number, so a table missing from
+    #Bank_Store.TABLE_KEYS would get a sentinel of the wrong shape and fail validation
+    key = {}
+    for name in get_table_keys(table_name):
+        if name is not None:
+            key[name] = Decimal('0') if name == 'AccountNumber' else 'WARMUP'
+
+    return key
+
+
+def touch_tables(table_names):
+    '''One GetItem per table and replica region, all at once, so every region's pool has connections
+    set up before a failover needs them. Returns failures'''
+
+    def touch(table_name, region):
+        try:
+            table = GuardedTable(get_regional_resource(region).Table(table_name), get_breaker(replica_name(table_name, region)))
+            table.get_item(Key=_sentinel_key(table_name))
+        except Exception as err:
+            logger.info(f'warm-up read of {replica_name(table_name, region)} failed: {err!r}')
+            return replica_name(table_name, region)
+
+    calls = [(lambda name=name, region=region: touch(name, region)) for name in table_names for region in read_regions()]
+
+    return [failed for failed in run_concurrently(*calls) if failed]
+
+
+def container_stats():
+    return {
+        'containerId': CONTAINER_ID,
+        'containerAgeSeconds': round(time.time() - CONTAINER_STARTED, 1),
+        'coldStart': _stats['invocations'] == 1,
+        'invocations': _stats['invocations'],
+        'warmupsBefore': _stats['warmups'],
+        'secondsSinceLastWarmup': round(time.time() - _stats['lastWarmup'], 1) if _stats['lastWarmup'] else None,
+        'breakers': breaker_states()
+    }
+
+
+def _invoke_self(context, payload):
+    import boto3
+
+    response = boto3.client('lambda').invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='RequestResponse',
+        Payload=json.dumps(payload).encode('utf-8')
+    )
+
+    return json.loads(response['Payload'].read())
+
+
+def warm_up(event, context, table_names=()):
+    '''Handles one warm-up ping and returns this container's (and any fanned-out containers') stats'''
+
+    start = time.perf_counter()
+
+    concurrency = int(event.get('concurrency', WARM_CONCURRENCY)) if event.get('warmer') else WARM_CONCURRENCY
+    hold_ms = int(event.get('delayMs', WARM_HOLD_MS))
+
+    #Fan out first, so the other containers warm up while this one does
+    fanned_out = []
+    if concurrency > 1 and context is not None:
+        payload = {'warmer': True, 'concurrency': 1, 'delayMs': hold_ms}
+        fanned_out = [submit_io(_invoke_self, context, payload) for _ in range(concurrency - 1)]
+
+    get_io_executor()
+    failed = touch_tables(table_names)
+    live_entries = warm_cache_sweep()
+
+    #A fanned-out ping holds its container, so the next one is routed to another
+    remaining = hold_ms / 1000.0 - (time.perf_counter() - start)
+    if concurrency == 1 and remaining > 0:
+        time.sleep(remaining)
+
+    stats = dict(container_stats(), warmCacheEntries=live_entries, tablesFailed=failed, warmupMs=round((time.perf_counter() - start) * 1000, 1))
+
+    _stats['warmups'] += 1
+    _stats['lastWarmup'] = time.time()
+
+    if fanned_out:
+        containers = [stats]
+        for future in fanned_out:
+            try:
+                containers.append(future.result())
+            except Exception as err:
+                logger.info(f'warm-up fan-out failed: {err!r}')
+        stats['containersWarmed'] = len({container.get('containerId') for container in containers})
+        stats['containers'] = containers[1:]
+
+    logger.info(f'warm-up {json.dumps(stats, default=str)}')
+
+    return stats
+
+
+def handle_warmups(table_names=()):
+    '''Decorates a lambda_handler: warm-up pings are answered here, everything else goes to the handler'''
+
+    def decorator(handler):
+
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            _stats['invocations'] += 1
+
+            if is_warmup_event(event):
+                return warm_up(event, context, table_names)
+
+            return handler(event, context)
+
+        return wrapper
+
+    return decorator
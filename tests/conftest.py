@@ -0,0 +1,44 @@
+import os
+import sys
+
+#The handlers read their settings at import, so the local store and test keys go in first
+os.environ.setdefault('BANK_STORE', 'local')
+os.environ.setdefault('BANK_SSN_HASH_KEY', 'test-ssn-hash-key')
+os.environ.setdefault('BANK_CARD_POOL_KEY', 'test-card-pool-key')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from Bank_Store import LocalResource, reset_breakers, set_resource, warm_cache_clear
+
+
+@pytest.fixture(autouse=True)
+def store():
+    '''A fresh local store (and empty warm cache) for every test'''
+
+    resource = LocalResource()
+    previous = set_resource(resource)
+    warm_cache_clear()
+    reset_breakers()
+
+    yield resource
+
+    set_resource(previous)
+    warm_cache_clear()
+    reset_breakers()
+
+
+def fulfillment_request(intent_name, session_id='session-1', slots=None):
+    return {
+        'sessionId': session_id,
+        'invocationSource': 'FulfillmentCodeHook',
+        'inputTranscript': '',
+        'inputMode': 'Text',
+        'bot': {'name': 'Bank'},
+        'sessionState': {
+            'intent': {'name': intent_name, 'slots': slots or {}, 'confirmationState': 'None'},
+            'sessionAttributes': {}
+        }
+    }
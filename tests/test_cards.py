@@ -0,0 +1,20 @@
+from Bank_Cards import card_pool_tbl_name, card_number, claim_block, generate_pool, isValid_CardNumber, CARD_BLOCK_SIZE
+
+
+def test_block_rows_hold_no_card_numbers(store):
+    generate_pool(2)
+
+    blocks = [item for key, item in store.Table(card_pool_tbl_name).items.items() if item['PoolKey'] != 'COUNTER']
+    assert len(blocks) == 2
+    assert all(set(item) == {'PoolKey', 'FirstSequence', 'Cards'} for item in blocks)
+
+
+def test_claimed_block_computes_its_numbers():
+    generate_pool(2)
+
+    first, second = claim_block(), claim_block()
+
+    assert [sequence for sequence, _ in second] == list(range(CARD_BLOCK_SIZE, 2 * CARD_BLOCK_SIZE))
+    assert all(cardNumber == card_number(sequence) for sequence, cardNumber in first + second)
+    assert all(isValid_CardNumber(cardNumber) for _, cardNumber in first + second)
+    assert len({cardNumber for _, cardNumber in first + second}) == 2 * CARD_BLOCK_SIZE
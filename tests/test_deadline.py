@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+from Bank_Store import DeadlineExceeded, FixedLatency, LocalResource, get_table, invocation_deadline, set_resource
+from Bank_Store_Async import LocalAsyncStore
+
+
+class Context(object):
+    '''Lambda context with ms left, just past the deadline margin'''
+
+    def __init__(self, ms):
+        self.ms = ms
+
+    def get_remaining_time_in_millis(self):
+        return self.ms
+
+
+@pytest.fixture
+def slow_store(store):
+    set_resource(LocalResource(replica_of=store, latency=FixedLatency(200)))
+
+
+def test_slow_reads_are_abandoned_at_the_deadline(slow_store):
+    with invocation_deadline(Context(550)):
+        with pytest.raises(DeadlineExceeded):
+            get_table('BankAccountsNew').get_item(Key={'AccountNumber': 1})
+
+
+def test_slow_writes_run_to_completion(slow_store):
+    with invocation_deadline(Context(550)):
+        get_table('BankAccountsNew').update_item(
+            Key={'AccountNumber': 1},
+            UpdateExpression='ADD Postings :one',
+            ExpressionAttributeValues={':one': 1}
+        )
+
+    assert get_table('BankAccountsNew').get_item(Key={'AccountNumber': 1})['Item']['Postings'] == 1
+
+
+def test_writes_are_refused_before_they_start_once_time_is_up(slow_store):
+    with invocation_deadline(Context(0)):
+        with pytest.raises(DeadlineExceeded):
+            get_table('BankAccountsNew').put_item(Item={'AccountNumber': 1})
+
+    assert 'Item' not in get_table('BankAccountsNew').get_item(Key={'AccountNumber': 1})
+
+
+def test_async_store_abandons_reads_but_not_writes(store):
+    async_store = LocalAsyncStore(store, latency=0.2)
+
+    async def turn():
+        with invocation_deadline(Context(550)):
+            await async_store.request('BankAccountsNew', 'update_item', Key={'AccountNumber': 1},
+                                      UpdateExpression='ADD Postings :one', ExpressionAttributeValues={':one': 1})
+            with pytest.raises(DeadlineExceeded):
+                await async_store.get_item('BankAccountsNew', {'AccountNumber': 1})
+
+    asyncio.run(turn())
+
+    assert get_table('BankAccountsNew').get_item(Key={'AccountNumber': 1})['Item']['Postings'] == 1
@@ -0,0 +1,27 @@
+import json
+import logging
+
+from conftest import fulfillment_request
+
+from Bank_Funnel import FUNNEL_PREFIX, filled_slots, record_turn
+from Bank_Responses import REASON_FIELD, build_validation_result, elicit_slot
+
+
+def funnel_lines(caplog):
+    return [json.loads(record.getMessage().split(FUNNEL_PREFIX, 1)[1]) for record in caplog.records if FUNNEL_PREFIX in record.getMessage()]
+
+
+def test_reprompt_is_counted_under_its_catalog_key(caplog):
+    caplog.set_level(logging.INFO)
+    slot = {'value': {'originalValue': '111122223333', 'interpretedValue': '111122223333', 'resolvedValues': []}}
+    request = fulfillment_request('CheckBalance', slots={'accountNumber': slot})
+    request['invocationSource'] = 'DialogCodeHook'
+
+    result = build_validation_result(False, 'accountNumber', 'account_number_unknown', accountNumber='111122223333')
+    response = elicit_slot('CheckBalance', {}, 'accountNumber', {}, result['message'], reason=result['reason'])
+    record_turn(request, response, filled_slots(request))
+
+    [line] = funnel_lines(caplog)
+    assert line['reprompt'] == 'CheckBalance/accountNumber/account_number_unknown'
+    #The funnel field never reaches Lex
+    assert REASON_FIELD not in response
@@ -0,0 +1,37 @@
+import asyncio
+from decimal import Decimal
+
+from conftest import fulfillment_request
+
+from Bank_Store import accounts_tbl_name, get_table
+from Bank_Store_Async import LocalAsyncStore
+from Bank_Session import get_session_state
+import Bank_Balance_Replace_V2 as sync_handlers
+import Bank_Balance_Replace_Async as async_handlers
+
+
+def greeting_request():
+    get_table(accounts_tbl_name).put_item(Item={
+        'AccountNumber': Decimal('123456789012'), 'Pin': Decimal('1234'), 'Phone Number': '+15551234567'
+    })
+    request = fulfillment_request('Greeting')
+    request['invocationSource'] = 'DialogCodeHook'
+    request['sessionState']['sessionAttributes'] = {'callerPhoneNumber': '(555) 123-4567'}
+
+    return request
+
+
+def test_greeting_looks_the_caller_up():
+    request = greeting_request()
+
+    sync_handlers.Greeting(request)
+
+    assert get_session_state(request)['callerLookup']['accountNumber'] == '123456789012'
+
+
+def test_async_greeting_looks_the_caller_up(store):
+    request = greeting_request()
+
+    asyncio.run(async_handlers.Greeting(request, LocalAsyncStore(store), None))
+
+    assert get_session_state(request)['callerLookup']['accountNumber'] == '123456789012'
@@ -0,0 +1,110 @@
+import copy
+import time
+
+import pytest
+
+import Bank_Idempotency
+from conftest import fulfillment_request
+from Bank_Idempotency import FulfillmentInProgress, idempotency_tbl_name, run_idempotent
+from Bank_Responses import render
+from Bank_Store import get_table
+
+
+def test_retried_fulfillment_returns_stored_response():
+    calls = []
+
+    def handler(intent_request):
+        calls.append(intent_request['sessionId'])
+        return {'messages': [{'contentType': 'PlainText', 'content': f'done {len(calls)}'}]}
+
+    request = fulfillment_request('ReplaceCard')
+    retry = copy.deepcopy(request)
+
+    first = run_idempotent(request, handler)
+    second = run_idempotent(retry, handler)
+
+    assert calls == ['session-1']
+    assert second == first
+
+
+def test_replay_is_per_session():
+    calls = []
+
+    def handler(intent_request):
+        calls.append(intent_request['sessionId'])
+        return {'messages': []}
+
+    run_idempotent(fulfillment_request('ReplaceCard', 'session-1'), handler)
+    run_idempotent(fulfillment_request('ReplaceCard', 'session-2'), handler)
+
+    assert calls == ['session-1', 'session-2']
+
+
+def test_failed_fulfillment_runs_again_on_retry():
+    calls = []
+
+    def handler(intent_request):
+        calls.append(intent_request['sessionId'])
+        if len(calls) == 1:
+            raise Exception('store unavailable')
+        return {'messages': []}
+
+    request = fulfillment_request('ReplaceCard')
+    retry = copy.deepcopy(request)
+
+    with pytest.raises(Exception):
+        run_idempotent(request, handler)
+    run_idempotent(retry, handler)
+
+    assert len(calls) == 2
+
+
+def test_dialog_turns_are_not_recorded():
+    calls = []
+
+    def handler(intent_request):
+        calls.append(intent_request['sessionId'])
+        return {'messages': []}
+
+    request = fulfillment_request('ReplaceCard')
+    request['invocationSource'] = 'DialogCodeHook'
+
+    run_idempotent(copy.deepcopy(request), handler)
+    run_idempotent(copy.deepcopy(request), handler)
+
+    assert len(calls) == 2
+
+
+def test_retry_during_the_first_attempt_gets_the_try_again_reply(monkeypatch):
+    import Bank_Balance_Replace_V2
+
+    monkeypatch.setattr(Bank_Idempotency, 'IDEMPOTENCY_WAIT', 0.1)
+    monkeypatch.setenv('TZ', 'America/New_York')
+    monkeypatch.setattr(Bank_Balance_Replace_V2.time, 'tzset', lambda: None)
+
+    request = fulfillment_request('ReplaceCard')
+    get_table(idempotency_tbl_name).put_item(Item={
+        'IdempotencyKey': 'session-1#ReplaceCard#0', 'Status': 'PENDING', 'ExpiresAt': int(time.time()) + 60
+    })
+
+    with pytest.raises(FulfillmentInProgress):
+        run_idempotent(copy.deepcopy(request), lambda intent_request: {})
+
+    response = Bank_Balance_Replace_V2.lambda_handler(copy.deepcopy(request), None)
+    assert response['sessionState']['intent']['state'] == 'Failed'
+    assert response['messages'][0]['content'] == render('try_again_account', 'PlainText')
+
+
+def test_losing_the_reclaim_race_waits_for_the_winner(monkeypatch):
+    stored = {'messages': [{'contentType': 'PlainText', 'content': 'first'}]}
+    claims = iter([False, False])
+    waits = iter([None, stored])
+
+    monkeypatch.setattr(Bank_Idempotency, '_claim', lambda key: next(claims))
+    monkeypatch.setattr(Bank_Idempotency, '_wait_for_response', lambda key: next(waits))
+
+    calls = []
+    response = run_idempotent(fulfillment_request('ReplaceCard'), lambda intent_request: calls.append(1))
+
+    assert response == stored
+    assert not calls
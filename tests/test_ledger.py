@@ -0,0 +1,62 @@
+from decimal import Decimal
+
+from Bank_Store import accounts_tbl_name, customer_tbl_name, get_table
+from Bank_Ledger import get_balance, post_transaction, posting_time
+
+
+ACCOUNT = Decimal('123456789012')
+CUSTOMER_KEY = {'CustomerId': 'CUST#1', 'AccountKey': f'checking#{ACCOUNT}'}
+
+
+def open_account(customerId=None):
+    account = {'AccountNumber': ACCOUNT, 'Pin': Decimal('1234'), 'Account Balance': Decimal('100')}
+    if customerId is not None:
+        account.update(CustomerId=customerId, AccountType='checking')
+        get_table(customer_tbl_name).put_item(Item=dict(
+            CUSTOMER_KEY, AccountType='checking', AccountNumber=ACCOUNT, **{'Account Balance': Decimal('100')}
+        ))
+    get_table(accounts_tbl_name).put_item(Item=account)
+
+
+def test_posting_updates_the_customer_summary():
+    open_account('CUST#1')
+
+    post_transaction(ACCOUNT, '-25.50', 'Coffee')
+
+    summary = get_table(customer_tbl_name).get_item(Key=CUSTOMER_KEY)['Item']
+    assert get_balance(ACCOUNT) == Decimal('74.50')
+    assert summary['Account Balance'] == Decimal('74.50')
+    assert summary['BalanceVersion'] == 1
+
+
+def test_posting_without_customer_only_touches_the_account(store):
+    open_account()
+
+    post_transaction(ACCOUNT, '10', 'Deposit')
+
+    assert get_balance(ACCOUNT) == Decimal('110')
+    assert not store.Table(customer_tbl_name).items
+
+
+def test_retried_posting_is_applied_once():
+    open_account('CUST#1')
+    postedAt = posting_time()
+
+    post_transaction(ACCOUNT, '5', 'Refund', postingId='refund-1', postedAt=postedAt)
+    post_transaction(ACCOUNT, '5', 'Refund', postingId='refund-1', postedAt=postedAt)
+
+    summary = get_table(customer_tbl_name).get_item(Key=CUSTOMER_KEY)['Item']
+    assert get_balance(ACCOUNT) == Decimal('105')
+    assert summary['Account Balance'] == Decimal('105')
+
+
+def test_posting_before_the_summary_row_is_migrated(store):
+    get_table(accounts_tbl_name).put_item(Item={
+        'AccountNumber': ACCOUNT, 'Pin': Decimal('1234'), 'Account Balance': Decimal('100'),
+        'CustomerId': 'CUST#1', 'AccountType': 'checking'
+    })
+
+    post_transaction(ACCOUNT, '-40', 'Rent')
+
+    assert get_balance(ACCOUNT) == Decimal('60')
+    assert not store.Table(customer_tbl_name).items
@@ -0,0 +1,111 @@
+import hmac
+import hashlib
+from decimal import Decimal
+
+from Bank_Store import customer_tbl_name, get_table
+from Bank_OpenAccount_V2_Lambda import SSN_HASH_KEY, create_account, customer_id_for_ssn
+from Bank_Migrate_Customers import migrate
+
+
+SSN = '123456789'
+
+
+def account_entry(accountType, ssn=SSN):
+    return {
+        'Pin': Decimal('1234'),
+        'AccountType': accountType,
+        'CustomerId': customer_id_for_ssn(ssn),
+        'FirstName': 'Ann',
+        'LastName': 'Lee',
+        'SSN': Decimal(ssn),
+        'Account Balance': Decimal('0')
+    }
+
+
+def customer_rows(customerId, store):
+    table = store.Table(customer_tbl_name)
+    return sorted(row['AccountKey'] for row in table.items.values() if row['CustomerId'] == customerId)
+
+
+def test_two_accounts_in_one_session(store):
+    checking, checking_outcome = create_account('session-1', account_entry('checking'), SSN)
+    savings, savings_outcome = create_account('session-1', account_entry('savings'), SSN)
+
+    assert (checking_outcome, savings_outcome) == ('created', 'created')
+    assert checking != savings
+
+    for accountNumber, accountType in ((checking, 'checking'), (savings, 'savings')):
+        item = get_table('BankAccountsNew').get_item(Key={'AccountNumber': accountNumber})['Item']
+        assert item['AccountType'] == accountType
+
+    assert customer_rows(customer_id_for_ssn(SSN), store) == [f'checking#{checking}', f'savings#{savings}']
+
+
+def test_retried_fulfillment_returns_the_same_account(store):
+    accountNumber, _ = create_account('session-1', account_entry('checking'), SSN)
+
+    #Within the token window DynamoDB answers the retry as the first call, after it the marker does
+    assert create_account('session-1', account_entry('checking'), SSN)[0] == accountNumber
+    assert len(store.Table('BankAccountsNew').items) == 1
+    assert customer_rows(customer_id_for_ssn(SSN), store) == [f'checking#{accountNumber}']
+
+
+def test_second_account_of_a_type_is_refused():
+    create_account('session-1', account_entry('checking'), SSN)
+
+    assert create_account('session-2', account_entry('checking'), SSN) == (None, 'duplicate')
+
+
+def legacy_account(accountNumber, accountType='checking', ssn=SSN):
+    get_table('BankAccountsNew').put_item(Item={
+        'AccountNumber': Decimal(accountNumber), 'Pin': Decimal('1234'), 'AccountType': accountType,
+        'SSN': Decimal(ssn), 'Account Balance': Decimal('10')
+    })
+
+
+def test_migrated_accounts_block_a_second_account_of_their_type():
+    legacy_account('100000000001')
+
+    assert migrate(total_segments=2) == (1, 1, 0)
+
+    assert create_account('session-1', account_entry('checking'), SSN) == (None, 'duplicate')
+    assert create_account('session-1', account_entry('savings'), SSN)[1] == 'created'
+
+
+def test_migration_reruns_keep_their_markers():
+    legacy_account('100000000001')
+
+    migrate(total_segments=2)
+
+    assert migrate(total_segments=2) == (1, 0, 0)
+
+
+def test_migration_counts_customers_with_two_accounts_of_one_type():
+    legacy_account('100000000001')
+    legacy_account('100000000002')
+
+    assert migrate(total_segments=1) == (2, 2, 1)
+
+
+LEADING_ZERO_SSN = '012345678901'
+
+
+def test_leading_zero_ssn_hashes_the_same_from_slot_and_table():
+    assert customer_id_for_ssn(LEADING_ZERO_SSN) == customer_id_for_ssn(Decimal(LEADING_ZERO_SSN))
+
+
+def test_migration_moves_accounts_linked_under_an_unpadded_ssn(store):
+    unpadded = 'CUST#' + hmac.new(SSN_HASH_KEY.encode('utf-8'), str(Decimal(LEADING_ZERO_SSN)).encode('utf-8'), hashlib.sha256).hexdigest()
+    legacy_account('100000000001', 'savings', LEADING_ZERO_SSN)
+    get_table('BankAccountsNew').update_item(
+        Key={'AccountNumber': Decimal('100000000001')},
+        UpdateExpression='SET CustomerId = :customerId',
+        ExpressionAttributeValues={':customerId': unpadded}
+    )
+    get_table(customer_tbl_name).put_item(Item={'CustomerId': unpadded, 'AccountKey': 'savings#100000000001'})
+
+    checking, _ = create_account('session-1', account_entry('checking', LEADING_ZERO_SSN), LEADING_ZERO_SSN)
+    migrate(total_segments=1)
+
+    assert customer_rows(customer_id_for_ssn(LEADING_ZERO_SSN), store) == ['checking#{}'.format(checking), 'savings#100000000001']
+    assert customer_rows(unpadded, store) == []
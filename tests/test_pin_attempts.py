@@ -0,0 +1,61 @@
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from Bank_Pin_Attempts import (
+    PIN_MAX_ACCOUNT_FAILURES, PIN_MAX_SESSION_FAILURES, pin_attempt_failed, pin_attempts_tbl_name,
+    release_pin_attempt, reserve_pin_attempt
+)
+from Bank_Store import get_table, warm_cache_clear
+
+
+ACCOUNT = '123456789012'
+
+
+def counter(attempt_key):
+    return get_table(pin_attempts_tbl_name).get_item(Key={'AttemptKey': attempt_key}).get('Item')
+
+
+def test_concurrent_attempts_never_exceed_the_cap():
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        attempts = list(pool.map(lambda _: reserve_pin_attempt(ACCOUNT), range(3 * PIN_MAX_ACCOUNT_FAILURES)))
+
+    assert sum(attempt is not None for attempt in attempts) == PIN_MAX_ACCOUNT_FAILURES
+    assert counter(f'ACCOUNT#{ACCOUNT}')['Failures'] == PIN_MAX_ACCOUNT_FAILURES
+
+
+def test_last_wrong_pin_locks_out():
+    for _ in range(PIN_MAX_SESSION_FAILURES - 1):
+        assert not pin_attempt_failed(reserve_pin_attempt(ACCOUNT, 'session-1'))
+
+    assert pin_attempt_failed(reserve_pin_attempt(ACCOUNT, 'session-1'))
+    assert reserve_pin_attempt(ACCOUNT, 'session-1') is None
+
+
+def test_refused_session_gives_the_account_charge_back():
+    for _ in range(PIN_MAX_SESSION_FAILURES):
+        pin_attempt_failed(reserve_pin_attempt(ACCOUNT, 'session-1'))
+    #Another container, which has not seen the lockout
+    warm_cache_clear()
+
+    assert reserve_pin_attempt(ACCOUNT, 'session-1') is None
+    assert counter(f'ACCOUNT#{ACCOUNT}')['Failures'] == PIN_MAX_SESSION_FAILURES
+
+
+def test_correct_pin_clears_the_account_counter():
+    pin_attempt_failed(reserve_pin_attempt(ACCOUNT, 'session-1'))
+
+    release_pin_attempt(reserve_pin_attempt(ACCOUNT, 'session-1'))
+
+    assert counter(f'ACCOUNT#{ACCOUNT}') is None
+    assert counter('SESSION#session-1')['Failures'] == 1
+
+
+def test_expired_counter_starts_over():
+    get_table(pin_attempts_tbl_name).put_item(Item={
+        'AttemptKey': f'ACCOUNT#{ACCOUNT}', 'Failures': Decimal(PIN_MAX_ACCOUNT_FAILURES), 'ExpiresAt': Decimal(1)
+    })
+
+    attempt = reserve_pin_attempt(ACCOUNT)
+
+    assert attempt is not None
+    assert counter(f'ACCOUNT#{ACCOUNT}')['Failures'] == 1
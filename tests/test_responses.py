@@ -0,0 +1,20 @@
+from Bank_Responses import close, elicit_slot
+
+
+def test_patching_a_response_leaves_the_next_one_alone():
+    first = close('ReplaceCard', {}, 'Fulfilled', None)
+    first['sessionState']['intent']['state'] = 'Failed'
+    first['sessionState']['dialogAction']['type'] = 'Delegate'
+
+    second = close('ReplaceCard', {}, 'Fulfilled', None)
+
+    assert second['sessionState']['intent']['state'] == 'Fulfilled'
+    assert second['sessionState']['dialogAction']['type'] == 'Close'
+
+
+def test_responses_do_not_share_dicts():
+    first = elicit_slot('ReplaceCard', {}, 'pin', {}, None)
+    second = elicit_slot('ReplaceCard', {}, 'pin', {}, None)
+
+    assert first['sessionState']['dialogAction'] is not second['sessionState']['dialogAction']
+    assert first['sessionState']['intent'] is not second['sessionState']['intent']
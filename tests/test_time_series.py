@@ -0,0 +1,68 @@
+import copy
+import time
+from collections import Counter
+
+from conftest import fulfillment_request
+from Bank_Store import all_sharded_keys, query_time_series, write_time_series_item
+import Bank_Survey_V2
+from Bank_Survey_V2 import get_survey_responses, survey_tbl_name
+
+
+DAY = '2026-10-19'
+SHARDS = 8
+
+
+def shards_used(store, table_name):
+    return Counter(item['SurveyDay'] for item in store.Table(table_name).items.values())
+
+
+def test_random_writes_spread_over_every_shard(store):
+    for index in range(200):
+        write_time_series_item(survey_tbl_name, {'Rating': 'good'}, day=DAY, shard_count=SHARDS)
+
+    used = shards_used(store, survey_tbl_name)
+    assert set(used) == set(all_sharded_keys(DAY, SHARDS))
+    assert max(used.values()) < 200 / 2
+
+
+def test_hashed_writes_stay_on_one_shard(store):
+    for index in range(20):
+        write_time_series_item(survey_tbl_name, {'Rating': 'good'}, day=DAY, shard_count=SHARDS, hash_key='session-1')
+
+    assert len(shards_used(store, survey_tbl_name)) == 1
+
+
+def test_scatter_gather_merges_shards_in_sort_key_order():
+    written = []
+    for index in range(50):
+        item = write_time_series_item(
+            survey_tbl_name, {'ResponseId': f'{DAY}T10:{index:02d}:00#{index}'}, day=DAY, shard_count=SHARDS
+        )
+        written.append(item['ResponseId'])
+
+    responses = query_time_series(survey_tbl_name, DAY, SHARDS)
+
+    assert [item['ResponseId'] for item in responses] == sorted(written)
+
+
+def test_other_days_are_not_read():
+    write_time_series_item(survey_tbl_name, {'Rating': 'good'}, day=DAY, shard_count=SHARDS)
+    write_time_series_item(survey_tbl_name, {'Rating': 'poor'}, day='2026-10-20', shard_count=SHARDS)
+
+    assert [item['Rating'] for item in query_time_series(survey_tbl_name, DAY, SHARDS)] == ['good']
+
+
+def test_survey_answers_are_stored_once_per_fulfillment(monkeypatch):
+    #The handler sets TZ for the process, the stored day then follows the same clock as time.strftime below
+    monkeypatch.setenv('TZ', 'America/New_York')
+    monkeypatch.setattr(Bank_Survey_V2.time, 'tzset', lambda: None)
+
+    slots = {name: {'value': {'interpretedValue': value, 'originalValue': value}} for name, value in (('rating', 'good'), ('recommend', 'yes'))}
+    request = fulfillment_request('Survey', slots=slots)
+
+    first = Bank_Survey_V2.lambda_handler(copy.deepcopy(request), None)
+    retry = Bank_Survey_V2.lambda_handler(copy.deepcopy(request), None)
+
+    responses = get_survey_responses(time.strftime('%Y-%m-%d'))
+    assert retry == first
+    assert [(item['Rating'], item['Recommend'], item['SessionId']) for item in responses] == [('good', 'yes', 'session-1')]
@@ -0,0 +1,22 @@
+import Bank_Store
+from Bank_Store import warm_cache_get, warm_cache_put
+
+
+def test_least_recently_used_entries_are_evicted(monkeypatch):
+    monkeypatch.setattr(Bank_Store, 'WARM_CACHE_MAX_ENTRIES', 3)
+
+    for number in range(3):
+        warm_cache_put('BankAccountsNew', {'AccountNumber': number}, {'AccountNumber': number})
+    warm_cache_get('BankAccountsNew', {'AccountNumber': 0})
+    warm_cache_put('BankAccountsNew', {'AccountNumber': 3}, {'AccountNumber': 3})
+
+    assert len(Bank_Store._warm_cache) == 3
+    assert warm_cache_get('BankAccountsNew', {'AccountNumber': 1}) is None
+    assert warm_cache_get('BankAccountsNew', {'AccountNumber': 0}) == {'AccountNumber': 0}
+
+
+def test_expired_entries_are_dropped_on_get():
+    warm_cache_put('BankAccountsNew', {'AccountNumber': 1}, {'AccountNumber': 1}, ttl=-1)
+
+    assert warm_cache_get('BankAccountsNew', {'AccountNumber': 1}) is None
+    assert not Bank_Store._warm_cache